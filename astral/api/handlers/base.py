@@ -16,6 +16,18 @@ class BaseHandler(tornado.web.RequestHandler):
     def is_localhost(self):
         return self.request.remote_ip == "127.0.0.1"
 
+    @property
+    def tunnel_control(self):
+        """The TunnelControlThread of the node running this API, or None if
+        the API runs without a node, e.g. in tests.
+        """
+        return getattr(self.application.node, 'tunnel_control', None)
+
+    @property
+    def streaming(self):
+        """The StreamingThread of the node running this API, or None."""
+        return getattr(self.application.node, 'streaming', None)
+
     def load_json(self):
         """Load JSON from the request body and store them in
         self.request.arguments, like Tornado does by default for POSTed form
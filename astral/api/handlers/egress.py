@@ -0,0 +1,19 @@
+from astral.api.handlers.base import BaseHandler
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class EgressHandler(BaseHandler):
+    def get(self):
+        """Return the rate limit (bytes/s) of the egress scheduler, and the
+        outgoing rate, queued bytes and estimated queueing delay of each ticket
+        or stream we are sending to other nodes.
+        """
+        if not self.tunnel_control:
+            self.write({'rate': None, 'tunnels': {}})
+            return
+        egress = self.tunnel_control.egress
+        self.write({'rate': egress.rate,
+            'tunnels': dict((str(key), stats) for key, stats
+                in egress.stats().items())})
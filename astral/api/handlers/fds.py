@@ -0,0 +1,28 @@
+from astral.api.handlers.base import BaseHandler
+from astral.conf import settings
+from astral.net.fds import fd_limit, open_fds, socket_ports
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class FdsHandler(BaseHandler):
+    def get(self):
+        """Return the number of file descriptors this node has open, split up
+        into tunnel listeners, tunnel connections, RTMP clients, API sockets
+        and everything else, along with the open files limit and the budget
+        tunnels are admitted against.
+        """
+        ports = socket_ports()
+        categories = {'tunnel_listeners': 0, 'tunnel_connections': 0,
+                'rtmp_clients': ports.get(settings.RTMP_PORT, 0),
+                'api_sockets': ports.get(settings.TORNADO_SETTINGS['port'], 0)}
+        budget = {'limit': None, 'open': None, 'rejected': 0}
+        if self.tunnel_control:
+            categories.update(self.tunnel_control.fd_usage())
+            budget = self.tunnel_control.fd_budget.to_dict()
+        total = open_fds()
+        if total is not None:
+            categories['other'] = max(total - sum(categories.values()), 0)
+        self.write({'open': total, 'limit': fd_limit(), 'budget': budget,
+            'categories': categories})
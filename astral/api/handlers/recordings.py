@@ -0,0 +1,16 @@
+from astral.api.handlers.base import BaseHandler
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class RecordingsHandler(BaseHandler):
+    def get(self):
+        """Return the counters of the recorder of every stream the RTMP server
+        is recording, by stream name: messages written, dropped and queued,
+        write batches and seconds spent writing, in all and at most in one.
+        """
+        if not self.streaming:
+            self.write({'streams': {}})
+            return
+        self.write({'streams': self.streaming.recording_stats()})
@@ -1,10 +1,12 @@
-from tornado.web import HTTPError
+from tornado.web import HTTPError, asynchronous
 import datetime
 import threading
+import time
 
 from astral.api.client import TicketsAPI
 from astral.api.handlers.base import BaseHandler
 from astral.api.handlers.tickets import TicketsHandler
+from astral.conf import settings
 from astral.models import Ticket, Node, Stream, session
 
 import logging
@@ -29,6 +31,11 @@ class TicketHandler(BaseHandler):
         session.commit()
         TicketDeletionPropagationThread(ticket, self.request).start()
 
+    def _tunnel_future(self, ticket):
+        if self.tunnel_control and ticket.needs_tunnel():
+            return self.tunnel_control.tunnel_future(ticket.id)
+
+    @asynchronous
     def get(self, stream_slug, destination_uuid=None):
         ticket = self._load_ticket(stream_slug, destination_uuid)
         if ticket:
@@ -41,16 +48,41 @@ class TicketHandler(BaseHandler):
                         existing_ticket=ticket)
             if ticket:
                 ticket.refreshed = datetime.datetime.now()
-                # In case we lost the tunnel, just make sure it exists
+                # In case we lost the tunnel, just make sure it exists. The
+                # port may change, so wait for the tunnel before answering.
+                future = self._tunnel_future(ticket)
                 ticket.queue_tunnel_creation()
                 session.commit()
-                # TODO this is unideal, but we need to get the new port if it
-                # changed. combination of sleep and db flush seems to do it
-                # somewhat reliably, but it's still a race condition.
-                import time
-                time.sleep(0.5)
-            ticket = self._load_ticket(stream_slug, destination_uuid)
+                if future:
+                    self._wait_for_tunnel(future, stream_slug,
+                            destination_uuid)
+                    return
+        self._write_ticket(stream_slug, destination_uuid)
+
+    def _wait_for_tunnel(self, future, stream_slug, destination_uuid):
+        io_loop = self.request.connection.stream.io_loop
+        def done(future):
+            if self._finished:
+                return
+            io_loop.remove_timeout(timeout)
+            if future.error:
+                log.warning("No tunnel for %s: %s", stream_slug, future.error)
+            self._write_ticket(stream_slug, destination_uuid)
+        def expired():
+            log.warning("Timed out waiting for the tunnel for %s",
+                    stream_slug)
+            self._write_ticket(stream_slug, destination_uuid)
+        timeout = io_loop.add_timeout(time.time()
+                + settings.TUNNEL_READY_TIMEOUT, self.async_callback(expired))
+        future.add_done_callback(self.async_callback(done), io_loop)
+
+    def _write_ticket(self, stream_slug, destination_uuid):
+        ticket = self._load_ticket(stream_slug, destination_uuid)
+        if ticket:
+            # the tunnel control thread may have changed it in the meantime
+            session.refresh(ticket)
             self.write({'ticket': ticket.to_dict()})
+        self.finish()
 
     def put(self, stream_slug, destination_uuid=None):
         """Edit tickets, most likely just confirming them."""
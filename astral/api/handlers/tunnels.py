@@ -0,0 +1,16 @@
+from astral.api.handlers.base import BaseHandler
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class TunnelsHandler(BaseHandler):
+    def get(self):
+        """Return the traffic counters of every tunnel on this node: bytes and
+        socket calls in each direction, current rates (bytes/s), last activity
+        and peak buffer size, keyed by ticket id or stream slug.
+        """
+        if not self.tunnel_control:
+            self.write({'tickets': {}, 'streams': {}})
+            return
+        self.write(self.tunnel_control.stats())
@@ -2,6 +2,17 @@ import tornado.testing
 
 from astral.api.app import NodeWebAPI
 from astral.models import drop_all, setup_all, create_all, session
+from astral.node.stream import StreamingThread
+from astral.node.tunnel import TunnelControlThread
+
+
+class FakeNode(object):
+    """Stands in for the node running the API, with a TunnelControlThread on
+    the IOLoop of the test and a StreamingThread, neither of them started.
+    """
+    def __init__(self, io_loop):
+        self.tunnel_control = TunnelControlThread(io_loop=io_loop)
+        self.streaming = StreamingThread()
 
 
 class BaseTest(tornado.testing.AsyncHTTPTestCase):
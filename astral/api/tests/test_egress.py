@@ -0,0 +1,28 @@
+from nose.tools import eq_
+import json
+
+from astral.api.tests import BaseTest, FakeNode
+
+
+class FakeConnection(object):
+    def queued(self):
+        return 1024
+
+
+class EgressHandlerTest(BaseTest):
+    def test_no_tunnels(self):
+        response = self.fetch('/egress')
+        eq_(response.code, 200)
+        result = json.loads(response.body)
+        eq_(result['tunnels'], {})
+
+    def test_tunnel_stats(self):
+        node = FakeNode(self.io_loop)
+        node.tunnel_control.egress.rate = 1024 * 1024
+        node.tunnel_control.egress.add(42, FakeConnection())
+        self._app.node = node
+        response = self.fetch('/egress')
+        eq_(response.code, 200)
+        result = json.loads(response.body)
+        eq_(result['rate'], 1024 * 1024)
+        eq_(result['tunnels']['42']['queued'], 1024)
@@ -0,0 +1,27 @@
+from nose.tools import eq_, ok_
+import json
+
+from astral.api.tests import BaseTest, FakeNode
+from astral.net.tunnel import Tunnel
+
+
+class FdsHandlerTest(BaseTest):
+    def test_no_tunnels(self):
+        response = self.fetch('/fds')
+        eq_(response.code, 200)
+        result = json.loads(response.body)
+        eq_(result['categories']['tunnel_listeners'], 0)
+        eq_(result['categories']['tunnel_connections'], 0)
+        eq_(result['budget']['rejected'], 0)
+
+    def test_tunnel_listeners(self):
+        node = FakeNode(self.io_loop)
+        tunnel = Tunnel('127.0.0.1', 1935, io_loop=self.io_loop)
+        node.tunnel_control.tunnels[42] = tunnel
+        self._app.node = node
+        response = self.fetch('/fds')
+        eq_(response.code, 200)
+        result = json.loads(response.body)
+        eq_(result['categories']['tunnel_listeners'], 1)
+        ok_(result['budget']['limit'] > 0)
+        tunnel.handle_close()
@@ -0,0 +1,32 @@
+from nose.tools import eq_
+import json
+
+from astral.api.tests import BaseTest, FakeNode
+from astral.rtmp.rtmp import App, FLVRecorder, Stream
+
+
+class RecordingsHandlerTest(BaseTest):
+    def test_no_node(self):
+        response = self.fetch('/recordings')
+        eq_(response.code, 200)
+        eq_(json.loads(response.body), {'streams': {}})
+
+    def test_recorded_stream(self):
+        node = FakeNode(self.io_loop)
+        app = App()
+        for name in ('recorded', 'live'):
+            stream = app.publishers[name] = Stream(None)
+            stream.name = name
+        recorder = app.publishers['recorded'].recordfile = FLVRecorder()
+        recorder.written, recorder.dropped = 100, 3
+        recorder.maxWriteTime = 0.5
+        node.streaming.agent.clients['astral'] = [app]
+        self._app.node = node
+        response = self.fetch('/recordings')
+        eq_(response.code, 200)
+        streams = json.loads(response.body)['streams']
+        eq_(streams.keys(), ['recorded'])
+        eq_(streams['recorded']['written'], 100)
+        eq_(streams['recorded']['dropped'], 3)
+        eq_(streams['recorded']['queued'], 0)
+        eq_(streams['recorded']['max_write_time'], 0.5)
@@ -2,10 +2,12 @@ from nose.tools import eq_, ok_
 from tornado.httpclient import HTTPRequest
 import json
 import mockito
+import time
 
 from astral.api.client import TicketsAPI
-from astral.api.tests import BaseTest
-from astral.models import Ticket, Stream, Node
+from astral.api.tests import BaseTest, FakeNode
+from astral.conf import settings
+from astral.models import Ticket, Stream, Node, session
 from astral.models.tests.factories import TicketFactory
 
 class TicketHandlerTest(BaseTest):
@@ -44,3 +46,54 @@ class TicketHandlerTest(BaseTest):
         response = self.wait()
         eq_(response.code, 200)
         eq_(ticket.confirmed, True)
+
+
+class TicketTunnelTest(BaseTest):
+    """Refreshing a ticket that needs a tunnel answers once the tunnel control
+    thread has (re)created it.
+    """
+    def setUp(self):
+        super(TicketTunnelTest, self).setUp()
+        self._app.node = FakeNode(self.io_loop)
+        self.tunnel_control = self._app.node.tunnel_control
+        node = Node.me()
+        self.ticket = TicketFactory(source=node, destination=node,
+                confirmed=True)
+        session.commit()
+
+    def fetch_ticket(self):
+        self.http_client.fetch(self.get_url(self.ticket.absolute_url()),
+                self.stop)
+        response = self.wait()
+        eq_(response.code, 200)
+        return json.loads(response.body)['ticket']
+
+    def resolve_later(self, port=None, error=None):
+        def resolve():
+            if port:
+                self.ticket.destination_port = port
+                session.commit()
+            self.tunnel_control._resolve_future(self.ticket.id, port, error)
+        self.io_loop.add_timeout(time.time() + 0.05, resolve)
+
+    def test_get_waits_for_tunnel(self):
+        self.resolve_later(port=5000)
+        eq_(self.fetch_ticket()['destination_port'], 5000)
+        ok_(self.ticket.id not in self.tunnel_control.futures)
+
+    def test_get_tunnel_error(self):
+        self.resolve_later(error="No listener")
+        eq_(self.fetch_ticket()['destination_port'], None)
+
+    def test_get_tunnel_timeout(self):
+        timeout = settings.TUNNEL_READY_TIMEOUT
+        settings.TUNNEL_READY_TIMEOUT = 0.05
+        try:
+            start = time.time()
+            ticket = self.fetch_ticket()
+        finally:
+            settings.TUNNEL_READY_TIMEOUT = timeout
+        eq_(ticket['stream'], self.ticket.stream.slug)
+        eq_(ticket['destination_port'], None)
+        ok_(time.time() - start < 1)
+        ok_(not self.tunnel_control.tunnel_future(self.ticket.id).done())
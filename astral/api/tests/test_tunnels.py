@@ -0,0 +1,26 @@
+from nose.tools import eq_
+import json
+
+from astral.api.tests import BaseTest, FakeNode
+from astral.net.tunnel import Tunnel
+
+
+class TunnelsHandlerTest(BaseTest):
+    def test_no_tunnels(self):
+        response = self.fetch('/tunnels')
+        eq_(response.code, 200)
+        eq_(json.loads(response.body), {'tickets': {}, 'streams': {}})
+
+    def test_tunnel_counters(self):
+        node = FakeNode(self.io_loop)
+        tunnel = Tunnel('127.0.0.1', 1935, io_loop=self.io_loop)
+        node.tunnel_control.tunnels[42] = tunnel
+        node.tunnel_control.stream_tunnels['a-stream'] = tunnel
+        self._app.node = node
+        response = self.fetch('/tunnels')
+        eq_(response.code, 200)
+        result = json.loads(response.body)
+        eq_(result['tickets']['42']['bind_port'], tunnel.bind_port)
+        eq_(result['tickets']['42']['bytes_in'], 0)
+        eq_(result['streams']['a-stream']['connections'], [])
+        tunnel.handle_close()
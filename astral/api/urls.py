@@ -7,6 +7,10 @@ from handlers.events import EventHandler
 from handlers.ticket import TicketHandler
 from handlers.tickets import TicketsHandler
 from handlers.settings import SettingsHandler
+from handlers.egress import EgressHandler
+from handlers.tunnels import TunnelsHandler
+from handlers.fds import FdsHandler
+from handlers.recordings import RecordingsHandler
 
 
 url_patterns = [
@@ -22,4 +26,8 @@ url_patterns = [
     (r"/ping", PingHandler),
     (r"/settings", SettingsHandler),
     (r"/events", EventHandler),
+    (r"/egress", EgressHandler),
+    (r"/tunnels", TunnelsHandler),
+    (r"/fds", FdsHandler),
+    (r"/recordings", RecordingsHandler),
 ]
@@ -55,3 +55,85 @@ SUPERNODE_MAX_CHILDREN = 100
 RTMP_PORT = 1935
 RTMP_TUNNEL_PORT = 5000
 RTMP_APP_NAME = "astral"
+# What the RTMP server runs on: 'multitask', its own scheduler in a thread of
+# its own, or 'ioloop', the Tornado IOLoop the API and the tunnels run on,
+# which takes less CPU per player. Relays (RTMP_RELAY) only run on 'multitask';
+# with 'ioloop', streams from other nodes are played through their tunnels.
+RTMP_ENGINE = 'multitask'
+# Size of the chunks the RTMP server sends, announced to every client that
+# connects. The protocol default of 128 bytes splits a video frame into dozens
+# of chunks with a header each.
+RTMP_CHUNK_SIZE = 4096
+# Bytes of the latest group of pictures the RTMP server keeps for each
+# published stream, so that a joining player starts from the last key frame
+# straight away instead of waiting for the next one. 0 turns the cache off.
+RTMP_GOP_CACHE_SIZE = 4 * 1024 * 1024
+# Limits of what the RTMP server queues for a player that doesn't keep up, in
+# bytes and in milliseconds of media. Past either, the player's video is
+# dropped up to the next key frame while its audio goes on; past twice either,
+# the player is disconnected. 0 for no limit.
+RTMP_QUEUE_BYTES = 4 * 1024 * 1024
+RTMP_QUEUE_TIME = 10000
+# Messages of a recorded stream that can wait for the thread writing them to
+# its FLV file, about a minute of audio and video. Past that, they are dropped
+# from the recording, never from live delivery.
+RTMP_RECORD_QUEUE_SIZE = 4096
+# Seconds between fsyncs of the FLV file of a recorded stream, 0 for none.
+RTMP_RECORD_SYNC_INTERVAL = 1.0
+# Pull streams that are played on the RTMP server here but published on
+# another node from the source of our ticket for them, once per stream, and
+# share that one upstream connection among all of their players.
+RTMP_RELAY = True
+# Seconds to wait for the upstream node to answer each step of setting up a
+# relay.
+RTMP_RELAY_TIMEOUT = 10
+
+# Bytes each tunnel connection can buffer in either direction. A connection
+# stops reading once the buffer it fills is above the high water mark, and
+# resumes when it drops back below the low water mark. Every connection of a
+# tunnel stops reading while the tunnel holds TUNNEL_MAX_BUFFERED bytes.
+TUNNEL_BUFFER_SIZE = 128 * 1024
+TUNNEL_HIGH_WATER_MARK = 96 * 1024
+TUNNEL_LOW_WATER_MARK = 32 * 1024
+TUNNEL_MAX_BUFFERED = 1024 * 1024
+
+# Share one connection to the ticket source between every local connection to
+# a ticket's tunnel. Only suitable when the source sends a one-way byte feed,
+# as only the first connection gets to talk back to the source.
+TUNNEL_FANOUT = False
+
+# On Linux, move the bytes of (non fan-out) tunnels between sockets with
+# splice(2) through kernel pipes instead of copying them through Python. Costs
+# two more file descriptors per direction of every connection.
+TUNNEL_SPLICE = False
+
+# Cap the total rate tunnels send to other nodes at the upstream bandwidth
+# (--upstream-limit, or else the measured upstream of this node) and share it
+# out fairly between tickets.
+TUNNEL_EGRESS_LIMIT = True
+
+# How often (in ms) the traffic rates and last activity of tunnels are updated.
+TUNNEL_COUNTER_INTERVAL = 1000
+
+# Tunnels are created and closed as tickets and streams come and go. As a
+# safety net for deletes that bypass the model events (e.g. bulk deletes),
+# every so many seconds the tunnels are also checked against the database.
+TUNNEL_RECONCILE_INTERVAL = 60
+
+# Listening sockets kept bound and ready to be handed to new tunnels, so the
+# port of a ticket's tunnel is known without waiting on bind().
+TUNNEL_LISTENER_POOL_SIZE = 8
+
+# Seconds a request for a ticket waits for its tunnel to be ready before
+# answering with whatever port the ticket has.
+TUNNEL_READY_TIMEOUT = 2
+
+# Close tunnel connections that haven't moved a byte in either direction for
+# this many seconds, e.g. because the peer went away without a FIN. None keeps
+# them open until the ticket goes away.
+TUNNEL_IDLE_TIMEOUT = 300
+
+# The most file descriptors the node may have open before it turns away new
+# tunnels and tunnel connections. None uses 90% of the open files limit
+# (ulimit -n) of the process.
+FD_BUDGET = None
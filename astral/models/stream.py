@@ -1,9 +1,10 @@
 from elixir import Field, Unicode, Entity, ManyToOne, Boolean, Text, Integer
-from elixir.events import after_insert, before_insert, after_update
+from elixir.events import (after_insert, before_insert, after_update,
+        after_delete)
 import json
 
 from astral.models import session, Node
-from astral.models.ticket import TUNNEL_QUEUE
+from astral.models.ticket import TUNNEL_QUEUE, TunnelDeleted
 from astral.models.base import BaseEntityMixin, slugify
 from astral.models.event import Event
 
@@ -64,5 +65,9 @@ class Stream(BaseEntityMixin, Entity):
         if self.source == Node.me():
             TUNNEL_QUEUE.put(self)
 
+    @after_delete
+    def queue_tunnel_deletion(self):
+        TUNNEL_QUEUE.put(TunnelDeleted(Stream, self.slug))
+
     def __repr__(self):
         return u'<Stream %s, from %s>' % (self.slug, self.source)
@@ -1,5 +1,6 @@
 from elixir import ManyToOne, Entity, Boolean, Field, DateTime, Integer
-from elixir.events import after_insert, before_insert, after_update
+from elixir.events import (after_insert, before_insert, after_update,
+        after_delete)
 import json
 import datetime
 import Queue
@@ -11,6 +12,19 @@ from astral.models.node import Node
 
 TUNNEL_QUEUE = Queue.Queue()
 
+
+class TunnelDeleted(object):
+    """Queued on the TUNNEL_QUEUE when the ticket or stream behind a tunnel is
+    deleted, so the tunnel can be closed without going back to the database.
+    """
+    def __init__(self, entity, key):
+        self.entity = entity
+        self.key = key
+
+    def __repr__(self):
+        return u'<TunnelDeleted %s %s>' % (self.entity.__name__, self.key)
+
+
 class Ticket(Entity, BaseEntityMixin):
     source = ManyToOne('Node')
     source_port = Field(Integer)
@@ -74,9 +88,16 @@ class Ticket(Entity, BaseEntityMixin):
         is not us), we don't create any extra tunnels. A tunnel will already
         exist in that case to bring the stream from somewhere else to here.
         """
-        if self.confirmed and self.destination == Node.me():
+        if self.needs_tunnel():
             TUNNEL_QUEUE.put(self)
 
+    def needs_tunnel(self):
+        return self.confirmed and self.destination == Node.me()
+
+    @after_delete
+    def queue_tunnel_deletion(self):
+        TUNNEL_QUEUE.put(TunnelDeleted(Ticket, self.id))
+
     @before_insert
     def set_created_time(self):
         if not self.created:
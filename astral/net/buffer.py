@@ -0,0 +1,279 @@
+"""
+astral.net.buffer
+==========
+
+Preallocated byte buffers for the tunnel data path.
+
+"""
+import errno
+import socket
+
+DISCONNECTED = frozenset((errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN,
+        errno.ECONNABORTED, errno.EPIPE, errno.EBADF))
+WOULD_BLOCK = frozenset((errno.EWOULDBLOCK, errno.EAGAIN))
+
+
+class ConnectionLost(Exception):
+    """The peer went away while we were reading from or writing to it."""
+
+
+class RingBuffer(object):
+    """Fixed capacity FIFO of bytes backed by a single preallocated bytearray.
+
+    Sockets read straight into the free region with recv_into() and write out
+    of the filled region with send(), both through memoryview slices, so moving
+    data through the buffer never allocates or copies a Python string.
+
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._data = bytearray(capacity)
+        self._view = memoryview(self._data)
+        self._start = 0
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def free(self):
+        return self.capacity - self._length
+
+    def full(self):
+        return self._length >= self.capacity
+
+    def _filled_region(self):
+        """Return the offset and length of the contiguous filled region at the
+        head of the buffer.
+        """
+        return self._start, min(self._length, self.capacity - self._start)
+
+    def _free_region(self):
+        """Return the offset and length of the contiguous free region after the
+        tail of the buffer.
+        """
+        end = self._start + self._length
+        if end >= self.capacity:
+            end -= self.capacity
+            return end, self._start - end
+        return end, self.capacity - end
+
+    def consume(self, count):
+        """Drop count bytes from the head of the buffer."""
+        count = min(count, self._length)
+        self._length -= count
+        if self._length:
+            self._start = (self._start + count) % self.capacity
+        else:
+            # rewinding an empty buffer keeps the next read contiguous
+            self._start = 0
+        return count
+
+    def append(self, data):
+        """Copy as much of data as fits into the buffer, returning the number
+        of bytes stored.
+        """
+        stored = 0
+        while stored < len(data):
+            offset, length = self._free_region()
+            length = min(length, len(data) - stored)
+            if not length:
+                break
+            self._view[offset:offset + length] = data[stored:stored + length]
+            self._length += length
+            stored += length
+        return stored
+
+    def peek(self):
+        """Return a copy of the buffered bytes, without consuming them."""
+        offset, length = self._filled_region()
+        data = self._view[offset:offset + length].tobytes()
+        if length < self._length:
+            data += self._view[:self._length - length].tobytes()
+        return data
+
+    def recv_into(self, sock, size):
+        """Receive at most size bytes from sock into the free region.
+
+        Returns the number of bytes read, or 0 if the socket would block. Raises
+        ConnectionLost if the peer has closed the connection.
+        """
+        offset, length = self._free_region()
+        size = min(size, length)
+        if not size:
+            return 0
+        count = _recv_into(sock, self._view[offset:offset + size])
+        self._length += count
+        return count
+
+    def send(self, sock, limit=None):
+        """Send the contiguous head of the buffer (at most limit bytes of it)
+        on sock and consume whatever was accepted by the kernel.
+
+        Returns the number of bytes sent. Raises ConnectionLost if the peer has
+        closed the connection.
+        """
+        offset, length = self._filled_region()
+        if limit is not None:
+            length = min(length, limit)
+        if not length:
+            return 0
+        return self.consume(_send(sock, self._view[offset:offset + length]))
+
+    def close(self):
+        """Nothing to give back, the memory goes with the buffer."""
+
+
+class BroadcastBuffer(object):
+    """Ring of bytes written once and read by any number of cursors.
+
+    Positions are absolute byte counts since the buffer was created. Space is
+    only reclaimed once every attached cursor has read past it, so the free
+    space is bounded by the cursor that lags the most.
+
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._data = bytearray(capacity)
+        self._view = memoryview(self._data)
+        self.tail = 0
+        self.cursors = []
+
+    def attach(self):
+        """Return a new cursor positioned at the live edge of the buffer."""
+        cursor = Cursor(self, self.tail)
+        self.cursors.append(cursor)
+        return cursor
+
+    def detach(self, cursor):
+        if cursor in self.cursors:
+            self.cursors.remove(cursor)
+
+    @property
+    def head(self):
+        if not self.cursors:
+            return self.tail
+        return min(cursor.position for cursor in self.cursors)
+
+    def __len__(self):
+        return self.tail - self.head
+
+    @property
+    def free(self):
+        return self.capacity - len(self)
+
+    def full(self):
+        return len(self) >= self.capacity
+
+    def _free_region(self):
+        offset = self.tail % self.capacity
+        return offset, min(self.free, self.capacity - offset)
+
+    def append(self, data):
+        """Copy as much of data as fits into the buffer, returning the number
+        of bytes stored.
+        """
+        stored = 0
+        while stored < len(data):
+            offset, length = self._free_region()
+            length = min(length, len(data) - stored)
+            if not length:
+                break
+            self._view[offset:offset + length] = data[stored:stored + length]
+            self.tail += length
+            stored += length
+        return stored
+
+    def recv_into(self, sock, size):
+        """Receive at most size bytes from sock, see RingBuffer.recv_into."""
+        offset, length = self._free_region()
+        size = min(size, length)
+        if not size:
+            return 0
+        count = _recv_into(sock, self._view[offset:offset + size])
+        self.tail += count
+        return count
+
+
+class Cursor(object):
+    """A single reader's position in a BroadcastBuffer."""
+    def __init__(self, buffer, position):
+        self.buffer = buffer
+        self.position = position
+
+    def __len__(self):
+        """The number of bytes this reader is behind the writer."""
+        return self.buffer.tail - self.position
+
+    def _filled_region(self):
+        offset = self.position % self.buffer.capacity
+        return offset, min(len(self), self.buffer.capacity - offset)
+
+    def peek(self):
+        offset, length = self._filled_region()
+        data = self.buffer._view[offset:offset + length].tobytes()
+        if length < len(self):
+            data += self.buffer._view[:len(self) - length].tobytes()
+        return data
+
+    def consume(self, count):
+        count = min(count, len(self))
+        self.position += count
+        return count
+
+    def send(self, sock, limit=None):
+        """Send the contiguous unread bytes on sock, see RingBuffer.send."""
+        offset, length = self._filled_region()
+        if limit is not None:
+            length = min(length, limit)
+        if not length:
+            return 0
+        return self.consume(_send(sock, self.buffer._view[
+            offset:offset + length]))
+
+
+def _recv_into(sock, view):
+    try:
+        count = sock.recv_into(view, len(view))
+    except socket.error, e:
+        if e.args[0] in WOULD_BLOCK:
+            return 0
+        elif e.args[0] in DISCONNECTED:
+            raise ConnectionLost(e)
+        raise
+    if not count:
+        raise ConnectionLost()
+    return count
+
+
+def _send(sock, view):
+    try:
+        return sock.send(view)
+    except socket.error, e:
+        if e.args[0] in WOULD_BLOCK:
+            return 0
+        elif e.args[0] in DISCONNECTED:
+            raise ConnectionLost(e)
+        raise
+
+
+class ReadSize(object):
+    """Socket read size that follows the throughput of a connection.
+
+    The size doubles every time a read fills the whole request and halves when
+    reads come back mostly empty, staying within [minimum, maximum].
+
+    """
+    def __init__(self, minimum=4096, maximum=65536):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.size = minimum
+
+    def __int__(self):
+        return self.size
+
+    def update(self, requested, received):
+        if received >= requested and self.size < self.maximum:
+            self.size = min(self.size * 2, self.maximum)
+        elif received < self.size / 4 and self.size > self.minimum:
+            self.size = max(self.size / 2, self.minimum)
@@ -0,0 +1,68 @@
+"""
+astral.net.counters
+==========
+
+Traffic counters for tunnels and their connections.
+
+"""
+import math
+import time
+
+RATE_WINDOW = 5.0 # seconds
+
+
+class TrafficCounter(object):
+    """Bytes and socket calls through one connection.
+
+    The tunnel bumps bytes_in/reads, bytes_out/writes and peak_buffered
+    directly from its read and write handlers, nothing else happens per call.
+    The rates (an EWMA over about RATE_WINDOW seconds) and last_activity are
+    only worked out when sample() is called, which should be every second or
+    so - last_activity is only as precise as that.
+
+    """
+    __slots__ = ('bytes_in', 'bytes_out', 'reads', 'writes', 'peak_buffered',
+            'rate_in', 'rate_out', 'last_activity', '_sampled_in',
+            '_sampled_out', '_sampled_at')
+
+    def __init__(self):
+        self.bytes_in = self.bytes_out = 0
+        self.reads = self.writes = 0
+        self.peak_buffered = 0
+        self.rate_in = self.rate_out = 0.0
+        self.last_activity = self._sampled_at = time.time()
+        self._sampled_in = self._sampled_out = 0
+
+    def sample(self, now=None):
+        now = now or time.time()
+        elapsed = now - self._sampled_at
+        if elapsed <= 0:
+            return
+        moved_in = self.bytes_in - self._sampled_in
+        moved_out = self.bytes_out - self._sampled_out
+        alpha = 1 - math.exp(-elapsed / RATE_WINDOW)
+        self.rate_in += alpha * (moved_in / elapsed - self.rate_in)
+        self.rate_out += alpha * (moved_out / elapsed - self.rate_out)
+        if moved_in or moved_out:
+            self.last_activity = now
+        self._sampled_in = self.bytes_in
+        self._sampled_out = self.bytes_out
+        self._sampled_at = now
+
+    def add(self, other):
+        """Fold the totals of other into this counter."""
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        self.reads += other.reads
+        self.writes += other.writes
+        self.rate_in += other.rate_in
+        self.rate_out += other.rate_out
+        self.peak_buffered = max(self.peak_buffered, other.peak_buffered)
+        self.last_activity = max(self.last_activity, other.last_activity)
+
+    def to_dict(self):
+        return {'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                'reads': self.reads, 'writes': self.writes,
+                'rate_in': self.rate_in, 'rate_out': self.rate_out,
+                'peak_buffered': self.peak_buffered,
+                'last_activity': self.last_activity}
@@ -0,0 +1,213 @@
+"""
+astral.net.dispatcher
+==========
+
+asyncore style socket channels driven by the Tornado IOLoop.
+
+"""
+import errno
+import socket
+
+from tornado import ioloop
+
+from astral.net.buffer import DISCONNECTED, WOULD_BLOCK
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class Dispatcher(object):
+    """A non-blocking socket registered with an IOLoop.
+
+    Subclasses implement the same readable()/writable()/handle_*() interface as
+    an asyncore.dispatcher, but instead of the loop polling every channel on
+    every pass, the socket is registered with epoll once and only wakes up when
+    it has something to do. The interest mask is recomputed from readable() and
+    writable() after each event and after update() is called on it, e.g. by a
+    peer that just filled or drained a buffer this channel depends on, and is
+    only handed to the IOLoop when it actually changes.
+
+    Registration is done with add_callback, the only thread-safe IOLoop call,
+    so channels can be created from outside the IOLoop thread.
+
+    """
+    def __init__(self, sock=None, io_loop=None):
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+        self.socket = None
+        self.addr = None
+        self.connected = False
+        self.connecting = False
+        self.accepting = False
+        self._fileno = None
+        self._events = None
+        if sock:
+            self.set_socket(sock)
+            self.connected = True
+            try:
+                self.addr = sock.getpeername()
+            except socket.error:
+                pass
+
+    def create_socket(self, family, type):
+        self.set_socket(socket.socket(family, type))
+
+    def set_socket(self, sock):
+        sock.setblocking(0)
+        self.socket = sock
+        self._fileno = sock.fileno()
+        self.io_loop.add_callback(self._register)
+
+    def set_reuse_addr(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,
+                self.socket.getsockopt(socket.SOL_SOCKET,
+                    socket.SO_REUSEADDR) | 1)
+
+    def fileno(self):
+        return self._fileno
+
+    def _register(self):
+        if self.socket is None or self._events is not None:
+            return
+        self._events = self._interest()
+        self.io_loop.add_handler(self._fileno, self._handle_events,
+                self._events)
+
+    def _interest(self):
+        events = 0
+        if self.accepting:
+            return ioloop.IOLoop.READ
+        if self.connecting:
+            events |= ioloop.IOLoop.WRITE
+        elif self.writable():
+            events |= ioloop.IOLoop.WRITE
+        if self.readable():
+            events |= ioloop.IOLoop.READ
+        return events
+
+    def update(self):
+        """Recompute the events this channel is waiting for."""
+        if self.socket is None or self._events is None:
+            return
+        events = self._interest()
+        if events != self._events:
+            self._events = events
+            self.io_loop.update_handler(self._fileno, events)
+
+    def _handle_events(self, fd, events):
+        if self.socket is None:
+            return
+        try:
+            if self.accepting:
+                self.handle_accept()
+                return
+            if self.connecting:
+                self._finish_connect()
+            elif events & ioloop.IOLoop.READ:
+                self.handle_read()
+            elif events & ioloop.IOLoop.ERROR:
+                if self.readable():
+                    # let the read find the end of the stream, so whatever
+                    # the peer sent before it hung up is still forwarded
+                    self.handle_read()
+                else:
+                    self.handle_close()
+            if self.socket is not None and events & ioloop.IOLoop.WRITE:
+                self.handle_write()
+        except Exception:
+            self.handle_error()
+        self.handle_events_done()
+
+    def handle_events_done(self):
+        """Called after every batch of events, by default re-arms the channel.
+        """
+        self.update()
+
+    def _finish_connect(self):
+        err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            log.debug("Couldn't connect %s to %s: %s", self, self.addr,
+                    errno.errorcode.get(err, err))
+            self.handle_close()
+            return
+        self.connecting = False
+        self.connected = True
+        self.handle_connect()
+
+    def listen(self, backlog):
+        self.accepting = True
+        self.socket.listen(backlog)
+
+    def bind(self, addr):
+        self.socket.bind(addr)
+
+    def connect(self, address):
+        self.addr = address
+        err = self.socket.connect_ex(address)
+        if err in (errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK):
+            self.connecting = True
+        elif err in (0, errno.EISCONN):
+            self.connected = True
+            self.handle_connect()
+        else:
+            self.close()
+            raise socket.error(err, errno.errorcode[err])
+
+    def accept(self):
+        try:
+            return self.socket.accept()
+        except socket.error, e:
+            if e.args[0] in WOULD_BLOCK or e.args[0] == errno.ECONNABORTED:
+                return None
+            raise
+
+    def recv(self, size):
+        try:
+            data = self.socket.recv(size)
+        except socket.error, e:
+            if e.args[0] in WOULD_BLOCK:
+                return ''
+            elif e.args[0] in DISCONNECTED:
+                self.handle_close()
+                return ''
+            raise
+        if not data:
+            self.handle_close()
+        return data
+
+    def close(self):
+        if self.socket is None:
+            return
+        if self._events is not None:
+            self.io_loop.remove_handler(self._fileno)
+        self._events = None
+        self.connected = self.connecting = self.accepting = False
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+        self.socket = None
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def handle_accept(self):
+        log.warning("Unhandled accept event on %s", self)
+
+    def handle_connect(self):
+        pass
+
+    def handle_read(self):
+        log.warning("Unhandled read event on %s", self)
+
+    def handle_write(self):
+        log.warning("Unhandled write event on %s", self)
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        log.exception("Closing %s after an unexpected error", self)
+        self.handle_close()
@@ -0,0 +1,196 @@
+"""
+astral.net.egress
+==========
+
+Shares the node's upstream bandwidth between the tunnels sending to other
+nodes.
+
+"""
+import time
+
+from tornado import ioloop
+
+INTERVAL = 10 # ms
+BURST = 0.05 # seconds worth of the rate that may go out at once
+QUANTUM = 4 * 1024
+RATE_WINDOW = 1.0 # seconds
+
+
+def is_loopback(addr):
+    return bool(addr) and addr[0].startswith('127.')
+
+
+class Flow(object):
+    """The outgoing traffic of one downstream connection.
+
+    While the scheduler is limiting, the connection may only write the bytes
+    it was granted (allowance) and reports what it wrote with spend().
+
+    """
+    def __init__(self, scheduler, key, connection):
+        self.scheduler = scheduler
+        self.key = key
+        self.connection = connection
+        self.allowance = 0
+        self.deficit = 0
+        self.sent = 0
+        self.rate = 0.0
+        self._sent_since_tick = 0
+
+    @property
+    def weight(self):
+        return self.scheduler.weights.get(self.key, 1)
+
+    @property
+    def queued(self):
+        return self.connection.queued()
+
+    @property
+    def delay(self):
+        """Estimated seconds the queued bytes will wait to go out."""
+        if not self.queued:
+            return 0.0
+        if not self.rate:
+            return None
+        return self.queued / self.rate
+
+    def limit(self):
+        """The number of bytes the connection may write right now, or None."""
+        if self.scheduler.limited():
+            return self.allowance
+        return None
+
+    def spend(self, count):
+        self.allowance = max(self.allowance - count, 0)
+        self.sent += count
+        self._sent_since_tick += count
+
+    def update_rate(self, elapsed):
+        if elapsed <= 0:
+            return
+        alpha = min(elapsed / RATE_WINDOW, 1.0)
+        self.rate += alpha * (self._sent_since_tick / elapsed - self.rate)
+        self._sent_since_tick = 0
+
+    def close(self):
+        self.scheduler.remove(self)
+
+
+class EgressScheduler(object):
+    """Token bucket over every outgoing tunnel connection, shared out between
+    them with deficit round robin.
+
+    Tokens accrue at rate bytes per second, up to burst seconds worth, and
+    every interval milliseconds they are handed out as allowances to the flows
+    that have something queued, a quantum times their weight at a time. A
+    ticket (or stream) gets weights[key] times the share of a ticket with the
+    default weight of 1. A rate of None turns the limit off, but the flows
+    still keep their statistics.
+
+    Flows, allowances and the timer all live on io_loop, only rate may be set
+    from another thread.
+
+    """
+    def __init__(self, rate=None, interval=INTERVAL, burst=BURST,
+            quantum=QUANTUM, io_loop=None):
+        self.rate = rate
+        self.burst = burst
+        self.quantum = quantum
+        self.weights = {}
+        self.flows = []
+        self.tokens = 0
+        self._next = 0
+        self._last_tick = time.time()
+        self._timer = ioloop.PeriodicCallback(self.tick, interval, io_loop)
+
+    def start(self):
+        self._last_tick = time.time()
+        self._timer.start()
+
+    def stop(self):
+        self._timer.stop()
+
+    def limited(self):
+        return bool(self.rate)
+
+    def add(self, key, connection):
+        flow = Flow(self, key, connection)
+        self.flows.append(flow)
+        return flow
+
+    def remove(self, flow):
+        if flow in self.flows:
+            self.flows.remove(flow)
+
+    def set_weight(self, key, weight):
+        self.weights[key] = weight
+
+    def tick(self):
+        now = time.time()
+        elapsed = now - self._last_tick
+        self._last_tick = now
+        for flow in self.flows:
+            flow.update_rate(elapsed)
+        if not self.limited():
+            return
+        self.tokens = min(self.tokens + self.rate * elapsed,
+                self.rate * self.burst)
+        for flow in self.schedule():
+            flow.connection.update()
+
+    def schedule(self):
+        """Hand out the available tokens, returning the flows that were
+        granted some.
+        """
+        wanted = {}
+        for flow in self.flows:
+            want = flow.queued - flow.allowance
+            if want > 0:
+                wanted[flow] = want
+            else:
+                flow.deficit = 0
+        order = [flow for flow in self.flows if flow in wanted]
+        if not order:
+            return []
+        # start the round where the last tick ran out of tokens
+        start = self._next % len(order)
+        order = order[start:] + order[:start]
+        granted = set()
+        while self.tokens >= 1 and wanted:
+            for index, flow in enumerate(order):
+                if flow not in wanted:
+                    continue
+                flow.deficit += self.quantum * flow.weight
+                grant = int(min(flow.deficit, wanted[flow], self.tokens))
+                flow.allowance += grant
+                flow.deficit -= grant
+                self.tokens -= grant
+                wanted[flow] -= grant
+                granted.add(flow)
+                if not wanted[flow]:
+                    # nothing left waiting, don't let the credit pile up
+                    del wanted[flow]
+                    flow.deficit = 0
+                if self.tokens < 1:
+                    self._next = start + index + 1
+                    break
+        return granted
+
+    def stats(self):
+        """Outgoing rate (bytes/s), queued bytes and estimated queueing delay
+        (seconds) by ticket or stream key.
+        """
+        stats = {}
+        for flow in self.flows:
+            entry = stats.setdefault(flow.key, {'connections': 0, 'rate': 0.0,
+                'queued': 0, 'sent': 0, 'delay': 0.0,
+                'weight': flow.weight})
+            entry['connections'] += 1
+            entry['rate'] += flow.rate
+            entry['queued'] += flow.queued
+            entry['sent'] += flow.sent
+            if entry['delay'] is not None:
+                delay = flow.delay
+                entry['delay'] = (None if delay is None
+                        else max(entry['delay'], delay))
+        return stats
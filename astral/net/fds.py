@@ -0,0 +1,112 @@
+"""
+astral.net.fds
+==========
+
+Keeps the number of open file descriptors of the node in check.
+
+Open descriptors and sockets are looked up in /proc, so outside of Linux
+open_fds() returns None, socket_ports() is empty and an FdBudget admits
+everything.
+
+"""
+import collections
+import os
+import resource
+
+BUDGET_SHARE = 0.9 # of the soft RLIMIT_NOFILE, when no budget is given
+TCP_LISTEN = '0A'
+
+
+def fd_limit():
+    """The soft limit on open files of this process, or None."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return None
+    return soft
+
+
+def open_fds():
+    """The number of file descriptors this process has open, or None."""
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def socket_ports():
+    """The connected TCP sockets of this process (listening sockets left
+    out), counted by local port.
+    """
+    inodes = set()
+    try:
+        for fd in os.listdir('/proc/self/fd'):
+            try:
+                target = os.readlink('/proc/self/fd/%s' % fd)
+            except OSError:
+                # closed since the listing
+                continue
+            if target.startswith('socket:['):
+                inodes.add(target[8:-1])
+    except OSError:
+        return {}
+    ports = collections.defaultdict(int)
+    for table in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            lines = open(table).readlines()[1:]
+        except IOError:
+            continue
+        for line in lines:
+            fields = line.split()
+            if fields[3] == TCP_LISTEN or fields[9] not in inodes:
+                continue
+            ports[int(fields[1].rsplit(':', 1)[1], 16)] += 1
+    return dict(ports)
+
+
+class FdBudget(object):
+    """Admission control against a budget of open file descriptors.
+
+    Counting the open descriptors is too slow to do for every connection, so
+    the count is only taken by refresh(), which should be called every second
+    or so. In between, admit() adds up what it has let in on top of the last
+    count and turns away anything that would take the node over limit. The
+    limit defaults to BUDGET_SHARE of the soft RLIMIT_NOFILE, leaving some
+    room for the database, logs and API sockets.
+
+    """
+    def __init__(self, limit=None):
+        if limit is None:
+            rlimit = fd_limit()
+            limit = int(rlimit * BUDGET_SHARE) if rlimit else None
+        self.limit = limit
+        self.open = None
+        self.rejected = 0
+        self._admitted = 0
+        self.refresh()
+
+    def refresh(self):
+        self.open = open_fds()
+        self._admitted = 0
+
+    def in_use(self):
+        return (self.open or 0) + self._admitted
+
+    def exhausted(self):
+        if self.limit is None or self.open is None:
+            return False
+        return self.in_use() >= self.limit
+
+    def admit(self, count=1):
+        """Return True and count them in if count more descriptors fit in the
+        budget, False otherwise.
+        """
+        if (self.limit is not None and self.open is not None
+                and self.in_use() + count > self.limit):
+            self.rejected += 1
+            return False
+        self._admitted += count
+        return True
+
+    def to_dict(self):
+        return {'limit': self.limit, 'open': self.open,
+                'rejected': self.rejected}
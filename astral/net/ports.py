@@ -0,0 +1,64 @@
+"""
+astral.net.ports
+==========
+
+Listening sockets bound ahead of time for new tunnels.
+
+"""
+import collections
+import socket
+import threading
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class ListenerPool(object):
+    """A pool of sockets already bound to a free port and listening, so a new
+    tunnel can be handed its port straight away.
+
+    take() never waits on anything but a lock, and only binds a socket itself
+    when the pool has run dry. fill() tops the pool back up to size and is
+    meant to be called once the caller is off the critical path.
+
+    """
+    def __init__(self, size, bind_ip='', backlog=5):
+        self.size = size
+        self.bind_ip = bind_ip
+        self.backlog = backlog
+        self._listeners = collections.deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._listeners)
+
+    def _listen(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.bind_ip, 0))
+        sock.listen(self.backlog)
+        sock.setblocking(0)
+        return sock
+
+    def take(self):
+        with self._lock:
+            if self._listeners:
+                return self._listeners.popleft()
+        log.debug("Listener pool is empty, binding a new socket")
+        return self._listen()
+
+    def fill(self):
+        while len(self._listeners) < self.size:
+            try:
+                sock = self._listen()
+            except socket.error, e:
+                log.warning("Couldn't bind a listening socket for the pool: "
+                        "%s", e)
+                return
+            with self._lock:
+                self._listeners.append(sock)
+
+    def close(self):
+        with self._lock:
+            while self._listeners:
+                self._listeners.popleft().close()
@@ -0,0 +1,150 @@
+"""
+astral.net.splice
+==========
+
+Zero-copy forwarding between sockets with Linux splice(2).
+
+Python 2 has no os.splice, so the system call is made through ctypes. When it
+isn't there (not Linux, or no usable libc) SPLICE_AVAILABLE is False and
+callers should stick to RingBuffer.
+
+"""
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+
+from astral.net.buffer import ConnectionLost, DISCONNECTED, WOULD_BLOCK
+
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+SPLICE_F_MORE = 4
+F_SETPIPE_SZ = 1031
+F_GETPIPE_SZ = 1032
+
+_FLAGS = SPLICE_F_MOVE | SPLICE_F_NONBLOCK
+
+
+def _load_splice():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        splice = libc.splice
+    except (OSError, AttributeError):
+        return None
+    splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+            ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    splice.restype = ctypes.c_ssize_t
+    return splice
+
+_splice = _load_splice()
+SPLICE_AVAILABLE = _splice is not None
+
+
+def splice(fd_in, fd_out, size):
+    """Move at most size bytes from fd_in to fd_out, one of which must be a
+    pipe. Returns the number of bytes moved, or 0 if either side would block.
+    Raises ConnectionLost if the socket end has gone away, and EOFError at the
+    end of the input.
+    """
+    count = _splice(fd_in, None, fd_out, None, size, _FLAGS)
+    if count > 0:
+        return count
+    elif count == 0:
+        raise EOFError()
+    err = ctypes.get_errno()
+    if err in WOULD_BLOCK or err == errno.EINTR:
+        return 0
+    elif err in DISCONNECTED:
+        raise ConnectionLost(OSError(err, os.strerror(err)))
+    raise OSError(err, os.strerror(err))
+
+
+class SplicePipe(object):
+    """A kernel pipe standing in for a RingBuffer between two sockets.
+
+    recv_into() splices from a socket into the pipe and send() splices from the
+    pipe out to another socket, so the payload is moved by the kernel and never
+    copied into Python. It has the same interface as RingBuffer for everything
+    but peek(), as the bytes are not supposed to be looked at.
+
+    Each pipe costs two file descriptors, which have to be given back with
+    close().
+
+    """
+    def __init__(self, capacity):
+        self._read_fd, self._write_fd = os.pipe()
+        for fd in (self._read_fd, self._write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        try:
+            fcntl.fcntl(self._write_fd, F_SETPIPE_SZ, capacity)
+        except IOError:
+            # above /proc/sys/fs/pipe-max-size, keep the default size
+            pass
+        try:
+            self.capacity = fcntl.fcntl(self._write_fd, F_GETPIPE_SZ)
+        except IOError:
+            self.capacity = 64 * 1024
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def free(self):
+        return self.capacity - self._length
+
+    def full(self):
+        return self._length >= self.capacity
+
+    def consume(self, count):
+        """Drop count bytes from the head of the pipe."""
+        count = min(count, self._length)
+        dropped = 0
+        while dropped < count:
+            try:
+                data = os.read(self._read_fd, count - dropped)
+            except OSError, e:
+                if e.errno in WOULD_BLOCK:
+                    break
+                raise
+            if not data:
+                break
+            dropped += len(data)
+        self._length -= dropped
+        return dropped
+
+    def recv_into(self, sock, size):
+        """Splice at most size bytes from sock into the pipe, see
+        RingBuffer.recv_into.
+        """
+        size = min(size, self.free)
+        if not size:
+            return 0
+        try:
+            count = splice(sock.fileno(), self._write_fd, size)
+        except EOFError:
+            raise ConnectionLost()
+        self._length += count
+        return count
+
+    def send(self, sock, limit=None):
+        """Splice everything in the pipe out to sock, see RingBuffer.send."""
+        length = self._length
+        if limit is not None:
+            length = min(length, limit)
+        if not length:
+            return 0
+        try:
+            count = splice(self._read_fd, sock.fileno(), length)
+        except EOFError:
+            return 0
+        self._length -= count
+        return count
+
+    def close(self):
+        for fd in (self._read_fd, self._write_fd):
+            if fd is not None:
+                os.close(fd)
+        self._read_fd = self._write_fd = None
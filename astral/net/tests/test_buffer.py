@@ -0,0 +1,123 @@
+import socket
+import unittest2
+from nose.tools import eq_, ok_, raises
+
+from astral.net.buffer import (RingBuffer, BroadcastBuffer, ReadSize,
+        ConnectionLost)
+
+
+class RingBufferTest(unittest2.TestCase):
+    def setUp(self):
+        self.buffer = RingBuffer(8)
+
+    def test_append_and_consume(self):
+        eq_(self.buffer.append('abcde'), 5)
+        eq_(len(self.buffer), 5)
+        eq_(self.buffer.free, 3)
+        self.buffer.consume(2)
+        eq_(self.buffer.peek(), 'cde')
+
+    def test_append_stops_when_full(self):
+        eq_(self.buffer.append('abcdefghij'), 8)
+        ok_(self.buffer.full())
+        eq_(self.buffer.append('k'), 0)
+
+    def test_wraps_around(self):
+        self.buffer.append('abcdef')
+        self.buffer.consume(4)
+        eq_(self.buffer.append('ghijkl'), 6)
+        eq_(self.buffer.peek(), 'efghijkl')
+
+    def test_empty_buffer_rewinds(self):
+        self.buffer.append('abcdef')
+        self.buffer.consume(6)
+        eq_(self.buffer.append('12345678'), 8)
+        eq_(self.buffer.peek(), '12345678')
+
+
+class RingBufferSocketTest(unittest2.TestCase):
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+        self.left.setblocking(False)
+        self.right.setblocking(False)
+        self.buffer = RingBuffer(16)
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def test_recv_into_and_send(self):
+        self.right.send('hello world')
+        eq_(self.buffer.recv_into(self.left, 1024), 11)
+        eq_(self.buffer.send(self.left), 11)
+        eq_(len(self.buffer), 0)
+        eq_(self.right.recv(1024), 'hello world')
+
+    def test_recv_into_wrapped_buffer(self):
+        self.buffer.append('x' * 12)
+        self.buffer.consume(12)
+        self.right.send('0123456789')
+        eq_(self.buffer.recv_into(self.left, 1024), 10)
+        eq_(self.buffer.peek(), '0123456789')
+
+    def test_would_block(self):
+        eq_(self.buffer.recv_into(self.left, 1024), 0)
+
+    @raises(ConnectionLost)
+    def test_closed_peer(self):
+        self.right.close()
+        self.buffer.recv_into(self.left, 1024)
+
+
+class BroadcastBufferTest(unittest2.TestCase):
+    def setUp(self):
+        self.buffer = BroadcastBuffer(8)
+
+    def test_cursors_read_independently(self):
+        first = self.buffer.attach()
+        second = self.buffer.attach()
+        self.buffer.append('abcdef')
+        first.consume(4)
+        eq_(first.peek(), 'ef')
+        eq_(second.peek(), 'abcdef')
+        eq_(len(self.buffer), 6)
+
+    def test_slowest_cursor_bounds_free_space(self):
+        first = self.buffer.attach()
+        second = self.buffer.attach()
+        self.buffer.append('abcdef')
+        first.consume(6)
+        eq_(self.buffer.append('ghijkl'), 2)
+        self.buffer.detach(second)
+        eq_(self.buffer.append('ijkl'), 4)
+        eq_(first.peek(), 'ghijkl')
+
+    def test_attach_at_live_edge(self):
+        self.buffer.attach()
+        self.buffer.append('abc')
+        late = self.buffer.attach()
+        eq_(len(late), 0)
+        self.buffer.append('d')
+        eq_(late.peek(), 'd')
+
+    def test_no_cursors_never_fills(self):
+        eq_(self.buffer.append('abcdefghijkl'), 12)
+
+
+class ReadSizeTest(unittest2.TestCase):
+    def test_grows_on_full_reads(self):
+        size = ReadSize(1024, 4096)
+        size.update(1024, 1024)
+        eq_(int(size), 2048)
+        size.update(2048, 2048)
+        size.update(4096, 4096)
+        eq_(int(size), 4096)
+
+    def test_shrinks_on_small_reads(self):
+        size = ReadSize(1024, 4096)
+        size.size = 4096
+        size.update(4096, 100)
+        eq_(int(size), 2048)
+        size.update(2048, 100)
+        size.update(1024, 100)
+        eq_(int(size), 1024)
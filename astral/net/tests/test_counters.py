@@ -0,0 +1,38 @@
+import unittest2
+from nose.tools import eq_, ok_
+
+from astral.net.counters import TrafficCounter
+
+
+class TrafficCounterTest(unittest2.TestCase):
+    def setUp(self):
+        self.counter = TrafficCounter()
+        self.start = self.counter._sampled_at
+
+    def test_sample_updates_rate(self):
+        self.counter.bytes_in = 1000
+        self.counter.sample(self.start + 1)
+        ok_(0 < self.counter.rate_in < 1000)
+        eq_(self.counter.rate_out, 0)
+        eq_(self.counter.last_activity, self.start + 1)
+
+    def test_rate_converges(self):
+        for second in range(1, 60):
+            self.counter.bytes_out += 1000
+            self.counter.sample(self.start + second)
+        ok_(abs(self.counter.rate_out - 1000) < 1)
+
+    def test_idle_keeps_last_activity(self):
+        self.counter.bytes_in = 10
+        self.counter.sample(self.start + 1)
+        self.counter.sample(self.start + 5)
+        eq_(self.counter.last_activity, self.start + 1)
+
+    def test_add(self):
+        other = TrafficCounter()
+        other.bytes_in, other.writes, other.peak_buffered = 10, 2, 300
+        self.counter.peak_buffered = 100
+        self.counter.add(other)
+        eq_(self.counter.bytes_in, 10)
+        eq_(self.counter.writes, 2)
+        eq_(self.counter.peak_buffered, 300)
@@ -0,0 +1,88 @@
+import unittest2
+from nose.tools import eq_, ok_
+
+from astral.net.egress import EgressScheduler, is_loopback
+
+
+class FakeConnection(object):
+    def __init__(self, queued=0):
+        self._queued = queued
+        self.updates = 0
+
+    def queued(self):
+        return self._queued
+
+    def update(self):
+        self.updates += 1
+
+
+class EgressSchedulerTest(unittest2.TestCase):
+    def setUp(self):
+        self.scheduler = EgressScheduler(rate=100 * 1024, quantum=1024)
+
+    def _grant(self, tokens):
+        self.scheduler.tokens = tokens
+        return self.scheduler.schedule()
+
+    def test_unlimited(self):
+        scheduler = EgressScheduler()
+        flow = scheduler.add('ticket', FakeConnection(4096))
+        eq_(flow.limit(), None)
+
+    def test_nothing_queued_nothing_granted(self):
+        flow = self.scheduler.add('ticket', FakeConnection())
+        eq_(self._grant(10000), [])
+        eq_(flow.limit(), 0)
+
+    def test_shares_fairly(self):
+        first = self.scheduler.add(1, FakeConnection(100000))
+        second = self.scheduler.add(2, FakeConnection(100000))
+        self._grant(8192)
+        eq_(first.allowance, 4096)
+        eq_(second.allowance, 4096)
+
+    def test_shares_by_weight(self):
+        self.scheduler.set_weight(1, 3)
+        first = self.scheduler.add(1, FakeConnection(100000))
+        second = self.scheduler.add(2, FakeConnection(100000))
+        self._grant(8192)
+        eq_(first.allowance, 6144)
+        eq_(second.allowance, 2048)
+
+    def test_leftover_goes_to_busy_flows(self):
+        first = self.scheduler.add(1, FakeConnection(512))
+        second = self.scheduler.add(2, FakeConnection(100000))
+        self._grant(8192)
+        eq_(first.allowance, 512)
+        eq_(second.allowance, 8192 - 512)
+
+    def test_spend(self):
+        flow = self.scheduler.add(1, FakeConnection(4096))
+        self._grant(4096)
+        flow.spend(1000)
+        eq_(flow.limit(), 3096)
+        eq_(flow.sent, 1000)
+
+    def test_tick_wakes_granted_connections(self):
+        connection = FakeConnection(4096)
+        self.scheduler.add(1, connection)
+        self.scheduler._last_tick -= 0.01
+        self.scheduler.tick()
+        eq_(connection.updates, 1)
+        ok_(self.scheduler.tokens < 1)
+
+    def test_stats(self):
+        flow = self.scheduler.add(1, FakeConnection(2048))
+        self.scheduler.add(1, FakeConnection(0))
+        flow.spend(1024)
+        flow.update_rate(1.0)
+        stats = self.scheduler.stats()[1]
+        eq_(stats['connections'], 2)
+        eq_(stats['queued'], 2048)
+        eq_(stats['rate'], 1024.0)
+        eq_(stats['delay'], 2.0)
+
+    def test_is_loopback(self):
+        ok_(is_loopback(('127.0.0.1', 5000)))
+        ok_(not is_loopback(('10.0.0.1', 5000)))
+        ok_(not is_loopback(None))
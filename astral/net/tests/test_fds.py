@@ -0,0 +1,37 @@
+import socket
+import unittest2
+from nose.tools import eq_, ok_
+
+from astral.net.fds import FdBudget, open_fds, socket_ports
+
+
+class FdBudgetTest(unittest2.TestCase):
+    def test_admit(self):
+        budget = FdBudget(limit=100)
+        budget.open = 95
+        ok_(budget.admit(2))
+        ok_(budget.admit(3))
+        ok_(budget.exhausted())
+        ok_(not budget.admit(1))
+        eq_(budget.rejected, 1)
+
+    def test_refresh_resets_admitted(self):
+        budget = FdBudget(limit=100000)
+        budget.admit(50)
+        budget.refresh()
+        eq_(budget.in_use(), open_fds())
+
+    def test_default_limit(self):
+        ok_(FdBudget().limit > 0)
+
+    def test_socket_ports(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        port = listener.getsockname()[1]
+        eq_(socket_ports().get(port, 0), 0)
+        client = socket.create_connection(('127.0.0.1', port))
+        conn, addr = listener.accept()
+        eq_(socket_ports().get(port), 1)
+        for sock in (conn, client, listener):
+            sock.close()
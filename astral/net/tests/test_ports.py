@@ -0,0 +1,34 @@
+import socket
+import unittest2
+from nose.tools import eq_, ok_
+
+from astral.net.ports import ListenerPool
+
+
+class ListenerPoolTest(unittest2.TestCase):
+    def setUp(self):
+        self.pool = ListenerPool(2, bind_ip='127.0.0.1')
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_fill(self):
+        self.pool.fill()
+        eq_(len(self.pool), 2)
+
+    def test_take_listening_socket(self):
+        self.pool.fill()
+        listener = self.pool.take()
+        eq_(len(self.pool), 1)
+        client = socket.create_connection(listener.getsockname())
+        listener.setblocking(1)
+        conn, addr = listener.accept()
+        eq_(addr, client.getsockname())
+        for sock in (conn, client, listener):
+            sock.close()
+
+    def test_take_from_empty_pool(self):
+        listener = self.pool.take()
+        ok_(listener.getsockname()[1] > 0)
+        eq_(len(self.pool), 0)
+        listener.close()
@@ -0,0 +1,53 @@
+import socket
+import unittest2
+from nose.tools import eq_, ok_, raises
+
+from astral.net.buffer import ConnectionLost
+from astral.net.splice import SplicePipe, SPLICE_AVAILABLE
+
+
+@unittest2.skipUnless(SPLICE_AVAILABLE, "splice(2) is not available")
+class SplicePipeTest(unittest2.TestCase):
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+        self.other_left, self.other_right = socket.socketpair()
+        for sock in (self.left, self.right, self.other_left,
+                self.other_right):
+            sock.setblocking(False)
+        self.pipe = SplicePipe(64 * 1024)
+
+    def tearDown(self):
+        self.pipe.close()
+        for sock in (self.left, self.right, self.other_left,
+                self.other_right):
+            sock.close()
+
+    def test_forwards_between_sockets(self):
+        self.right.send('hello world')
+        eq_(self.pipe.recv_into(self.left, 1024), 11)
+        eq_(len(self.pipe), 11)
+        eq_(self.pipe.send(self.other_left), 11)
+        eq_(len(self.pipe), 0)
+        eq_(self.other_right.recv(1024), 'hello world')
+
+    def test_respects_capacity(self):
+        self.right.send('x' * 1024)
+        eq_(self.pipe.recv_into(self.left, 100), 100)
+        self.pipe._length = self.pipe.capacity
+        ok_(self.pipe.full())
+        eq_(self.pipe.recv_into(self.left, 100), 0)
+
+    def test_would_block(self):
+        eq_(self.pipe.recv_into(self.left, 1024), 0)
+
+    def test_consume(self):
+        self.right.send('abcdef')
+        self.pipe.recv_into(self.left, 1024)
+        eq_(self.pipe.consume(4), 4)
+        self.pipe.send(self.other_left)
+        eq_(self.other_right.recv(1024), 'ef')
+
+    @raises(ConnectionLost)
+    def test_closed_peer(self):
+        self.right.close()
+        self.pipe.recv_into(self.left, 1024)
@@ -0,0 +1,268 @@
+import socket
+import time
+import tornado.testing
+import unittest2
+from nose.tools import eq_, ok_
+
+from astral.net.egress import EgressScheduler
+from astral.net.fds import FdBudget
+from astral.net.ports import ListenerPool
+from astral.net.splice import SplicePipe, SPLICE_AVAILABLE
+from astral.net.tunnel import Tunnel
+
+
+class BaseTunnelTest(tornado.testing.AsyncTestCase):
+    tunnel_options = {}
+
+    def setUp(self):
+        super(BaseTunnelTest, self).setUp()
+        self.source = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.source.bind(('127.0.0.1', 0))
+        self.source.listen(5)
+        self.tunnel = Tunnel('127.0.0.1', self.source.getsockname()[1],
+                bind_ip='127.0.0.1', io_loop=self.io_loop,
+                **self.get_tunnel_options())
+
+    def tearDown(self):
+        self.tunnel.handle_close()
+        self.source.close()
+        super(BaseTunnelTest, self).tearDown()
+
+    def get_tunnel_options(self):
+        return self.tunnel_options
+
+    def spin(self, seconds=0.01):
+        """Run the IOLoop for a little while."""
+        self.io_loop.add_timeout(time.time() + seconds, self.stop)
+        self.wait()
+
+    def _connect(self):
+        client = socket.create_connection(('127.0.0.1',
+                self.tunnel.bind_port))
+        while len(self.tunnel.receivers) < 1 or (
+                self.tunnel.receivers[-1].socket.getpeername()
+                != client.getsockname()):
+            self.spin()
+        return client
+
+    def _receive(self, client, count):
+        client.setblocking(False)
+        data = ''
+        while len(data) < count:
+            self.spin()
+            try:
+                data += client.recv(count - len(data))
+            except socket.error:
+                pass
+        return data
+
+
+class TunnelTest(BaseTunnelTest):
+    def test_forwards_both_ways(self):
+        client = self._connect()
+        upstream, addr = self.source.accept()
+        client.send('request')
+        eq_(self._receive(upstream, 7), 'request')
+        upstream.send('response')
+        eq_(self._receive(client, 8), 'response')
+        for sock in (client, upstream):
+            sock.close()
+
+    def test_counts_traffic(self):
+        client = self._connect()
+        upstream, addr = self.source.accept()
+        client.send('request')
+        self._receive(upstream, 7)
+        upstream.send('response')
+        self._receive(client, 8)
+        self.tunnel.sample()
+        stats = self.tunnel.stats()
+        eq_(stats['bytes_in'], 15)
+        eq_(stats['bytes_out'], 15)
+        ok_(stats['peak_buffered'] >= 7)
+        roles = dict((connection['role'], connection)
+                for connection in stats['connections'])
+        eq_(roles['downstream']['bytes_in'], 7)
+        eq_(roles['downstream']['bytes_out'], 8)
+        ok_(roles['upstream']['rate_in'] > 0)
+        client.close()
+        self.spin(0.05)
+        stats = self.tunnel.stats()
+        eq_(stats['connections'], [])
+        eq_(stats['bytes_in'], 15)
+        upstream.close()
+
+    def test_reap_idle(self):
+        client = self._connect()
+        upstream, addr = self.source.accept()
+        while not self.tunnel.sender:
+            self.spin()
+        eq_(self.tunnel.fd_count(), self.tunnel.fds_per_connection())
+        eq_(self.tunnel.reap_idle(60), 0)
+        eq_(self.tunnel.reap_idle(60, time.time() + 61), 1)
+        eq_(self.tunnel.receivers, [])
+        eq_(self.tunnel.fd_count(), 0)
+        client.close()
+        upstream.close()
+
+    def test_pre_bound_listener(self):
+        pool = ListenerPool(1, bind_ip='127.0.0.1')
+        listener = pool.take()
+        port = listener.getsockname()[1]
+        tunnel = Tunnel('127.0.0.1', self.source.getsockname()[1],
+                listener=listener, io_loop=self.io_loop)
+        eq_(tunnel.bind_port, port)
+        client = socket.create_connection(('127.0.0.1', port))
+        while not tunnel.receivers:
+            self.spin()
+        upstream, addr = self.source.accept()
+        client.send('request')
+        eq_(self._receive(upstream, 7), 'request')
+        tunnel.handle_close()
+        for sock in (client, upstream):
+            sock.close()
+
+    def test_close_drops_connections(self):
+        client = self._connect()
+        upstream, addr = self.source.accept()
+        self.spin()
+        self.tunnel.handle_close()
+        eq_(self.tunnel.receivers, [])
+        upstream.settimeout(1)
+        eq_(upstream.recv(1024), '')
+        for sock in (client, upstream):
+            sock.close()
+
+
+@unittest2.skipUnless(SPLICE_AVAILABLE, "splice(2) is not available")
+class SpliceTunnelTest(TunnelTest):
+    tunnel_options = {'splice': True}
+
+    def test_uses_pipes(self):
+        ok_(self.tunnel.splice)
+        client = self._connect()
+        ok_(isinstance(self.tunnel.receivers[0].from_remote_buffer,
+            SplicePipe))
+        client.close()
+
+
+class EgressTunnelTest(BaseTunnelTest):
+    def get_tunnel_options(self):
+        self.egress = EgressScheduler(rate=64 * 1024, io_loop=self.io_loop)
+        self.egress.start()
+        return {'egress': self.egress, 'egress_key': 42}
+
+    def tearDown(self):
+        self.egress.stop()
+        super(EgressTunnelTest, self).tearDown()
+
+    def test_limits_downstream_rate(self):
+        client = self._connect()
+        receiver = self.tunnel.receivers[0]
+        # pretend the client is on another host
+        receiver.flow = self.egress.add(42, receiver)
+        upstream, addr = self.source.accept()
+        upstream.send('x' * 32 * 1024)
+        start = time.time()
+        eq_(len(self._receive(client, 32 * 1024)), 32 * 1024)
+        ok_(time.time() - start >= 0.3)
+        eq_(self.egress.stats()[42]['sent'], 32 * 1024)
+        for sock in (client, upstream):
+            sock.close()
+
+    def test_loopback_is_not_limited(self):
+        client = self._connect()
+        eq_(self.tunnel.receivers[0].flow, None)
+        client.close()
+
+
+class FanoutTunnelTest(BaseTunnelTest):
+    tunnel_options = {'fanout': True}
+
+    def test_one_upstream_connection(self):
+        first = self._connect()
+        upstream, addr = self.source.accept()
+        second = self._connect()
+        self.source.setblocking(False)
+        self.assertRaises(socket.error, self.source.accept)
+
+        upstream.send('live data')
+        eq_(self._receive(first, 9), 'live data')
+        eq_(self._receive(second, 9), 'live data')
+        for sock in (first, second, upstream):
+            sock.close()
+
+    def test_only_primary_talks_upstream(self):
+        first = self._connect()
+        upstream, addr = self.source.accept()
+        second = self._connect()
+        second.send('ignored')
+        first.send('request')
+        self.spin(0.1)
+        eq_(upstream.recv(1024), 'request')
+        for sock in (first, second, upstream):
+            sock.close()
+
+    def test_lagging_receiver_is_dropped(self):
+        self.tunnel.lag_limit = 16
+        first = self._connect()
+        upstream, addr = self.source.accept()
+        receiver = self.tunnel.receivers[0]
+        receiver.writable = lambda: False
+        receiver.update()
+        upstream.send('x' * 64)
+        self.spin(0.1)
+        eq_(self.tunnel.receivers, [])
+        eq_(self.tunnel.sender, None)
+        for sock in (first, upstream):
+            sock.close()
+
+
+class BackpressureTest(BaseTunnelTest):
+    tunnel_options = {'buffer_size': 64 * 1024, 'high_water': 32 * 1024,
+            'low_water': 8 * 1024}
+
+    def test_slow_reader_pauses_source(self):
+        client = socket.create_connection(('127.0.0.1',
+                self.tunnel.bind_port))
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        while not self.tunnel.sender:
+            self.spin()
+        upstream, addr = self.source.accept()
+        upstream.setblocking(False)
+        sent = 0
+        for i in range(200):
+            try:
+                sent += upstream.send('x' * 65536)
+            except socket.error:
+                pass
+            self.spin()
+        ok_(self.tunnel.sender.paused)
+        ok_(self.tunnel.backpressure_count > 0)
+        ok_(self.tunnel.buffered <= 64 * 1024)
+        ok_(sent > self.tunnel.buffered)
+        for sock in (client, upstream):
+            sock.close()
+
+
+class FdBudgetTunnelTest(BaseTunnelTest):
+    def get_tunnel_options(self):
+        self.budget = FdBudget(limit=1000)
+        return {'fd_budget': self.budget}
+
+    def test_turns_away_over_budget(self):
+        self.budget.open = 999
+        client = socket.create_connection(('127.0.0.1',
+                self.tunnel.bind_port))
+        while not self.budget.rejected:
+            self.spin()
+        eq_(self.tunnel.receivers, [])
+        client.setblocking(True)
+        eq_(client.recv(1), '')
+        client.close()
+
+    def test_admits_within_budget(self):
+        self.budget.open = 10
+        client = self._connect()
+        eq_(self.budget.in_use(), 12)
+        client.close()
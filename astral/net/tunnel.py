@@ -1,115 +1,590 @@
 #! /usr/bin/env python
 """
-TCP Socket liaison/tunnel asyncore test for RTMP streaming
+TCP Socket liaison/tunnel for RTMP streaming, running on the Tornado IOLoop.
 
-Source: http://code.activestate.com/recipes/483732/
+Originally based on the asyncore recipe at
+http://code.activestate.com/recipes/483732/
 """
-import socket, asyncore
+import socket
+import time
 
+from tornado import ioloop
 
-class Tunnel(asyncore.dispatcher, object):
-    """TCP packet forwarding tunnel as an asyncore channel.
+from astral.net.buffer import (RingBuffer, BroadcastBuffer, ReadSize,
+        ConnectionLost)
+from astral.net.counters import TrafficCounter
+from astral.net.dispatcher import Dispatcher
+from astral.net.egress import is_loopback
+from astral.net.splice import SplicePipe, SPLICE_AVAILABLE
+
+import logging
+log = logging.getLogger(__name__)
+
+BUFFER_SIZE = 128 * 1024
+HIGH_WATER_MARK = 96 * 1024
+LOW_WATER_MARK = 32 * 1024
+MAX_BUFFERED = 1024 * 1024
+MIN_READ_SIZE = 4 * 1024
+MAX_READ_SIZE = 64 * 1024
+
+
+class Tunnel(Dispatcher):
+    """TCP packet forwarding tunnel as an IOLoop channel.
 
     Forward TCP packets through a tunnel from source socket to another local
     socket, and vice versa. The "source" is the intial point of entry - this is
     where the connections get started. The destination is most likely the
     service you already have listening on a port somewhere, e.g. an RTMP server.
 
+    Each connection stops reading once the buffer it fills reaches high_water
+    bytes and starts again when the other side has drained it to low_water, so
+    a slow peer throttles the fast one instead of growing the buffer. All of
+    the connections of a tunnel also stop reading while the tunnel as a whole
+    holds max_buffered bytes. backpressure_count counts how many times one of
+    the connections had to stop.
+
+    In fan-out mode a single connection to the source is shared by every
+    accepted connection. Bytes from the source are read once into a broadcast
+    buffer and each downstream connection writes them out from its own cursor;
+    one that falls more than lag_limit bytes behind is disconnected so it can't
+    stall the others. Only the first attached downstream connection (the
+    primary) talks back to the source, anything the others send is dropped.
+
+    With splice on Linux, the bytes of a (non fan-out) tunnel are moved
+    between the two sockets of each connection pair through kernel pipes with
+    splice(2) and never copied into Python. The buffered path is used instead
+    whenever splice isn't available or a pipe can't be created.
+
+    Given an EgressScheduler, writes to downstream connections from other
+    hosts are charged to it under egress_key (the ticket id or stream slug),
+    so they share the node's upstream bandwidth with every other tunnel.
+
+    Every connection keeps a TrafficCounter, stats() adds them up along with
+    the totals of the connections that have already closed. reap_idle() closes
+    the connections that haven't moved a byte in a while.
+
+    Given an FdBudget, connections that would need more file descriptors than
+    the node has left are closed as soon as they are accepted.
+
+    The listening socket is bound right away (or passed in already bound as
+    listener) so bind_port is known to the caller, but it and every connection
+    of the tunnel are only ever touched from the io_loop thread after that -
+    close the tunnel with io_loop.add_callback(tunnel.handle_close) from
+    anywhere else.
+
     """
     def __init__(self, source_ip, source_port, bind_ip='', bind_port=0,
-            backlog=5, enabled=True):
-        super(Tunnel, self).__init__()
+            backlog=5, enabled=True, buffer_size=BUFFER_SIZE,
+            high_water=HIGH_WATER_MARK, low_water=LOW_WATER_MARK,
+            max_buffered=MAX_BUFFERED, fanout=False, lag_limit=None,
+            splice=False, egress=None, egress_key=None, listener=None,
+            fd_budget=None, io_loop=None):
+        super(Tunnel, self).__init__(io_loop=io_loop)
         self.sender = None
         self.enabled = enabled
         self.source_ip = source_ip
         self.source_port = source_port
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.set_reuse_addr()
-        self.bind((bind_ip, bind_port))
+        self.buffer_size = buffer_size
+        self.high_water = min(high_water, buffer_size)
+        self.low_water = min(low_water, self.high_water)
+        self.max_buffered = max_buffered
+        self.backpressure_count = 0
+        self.fanout = fanout
+        self.lag_limit = lag_limit or buffer_size / 2
+        self.splice = splice and SPLICE_AVAILABLE and not fanout
+        self.egress = egress
+        self.egress_key = egress_key
+        self.fd_budget = fd_budget
+        self.receivers = []
+        self.broadcast_buffer = None
+        self._buffered = 0
+        self._over_limit = False
+        self.peak_buffered = 0
+        self.retired = TrafficCounter()
+        if listener:
+            # already bound, e.g. taken from a ListenerPool
+            self.set_socket(listener)
+        else:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+            self.bind((bind_ip, bind_port))
+        self.address = self.socket.getsockname()
         self.listen(backlog)
 
     @property
     def bind_ip(self):
-        return self.socket.getsockname()[0]
+        return self.address[0]
 
     @property
     def bind_port(self):
-        return self.socket.getsockname()[1]
+        return self.address[1]
+
+    @property
+    def primary(self):
+        return self.receivers[0] if self.receivers else None
+
+    @property
+    def buffered(self):
+        """The number of bytes held in the buffers of this tunnel."""
+        if self.fanout:
+            return ((len(self.broadcast_buffer) if self.broadcast_buffer
+                    else 0) + (len(self.sender.to_remote_buffer)
+                        if self.sender else 0))
+        return self._buffered
+
+    def over_limit(self):
+        return self.buffered >= self.max_buffered
+
+    def new_buffer(self):
+        """Return a buffer for one direction of a connection pair."""
+        if self.splice:
+            try:
+                return SplicePipe(self.buffer_size)
+            except EnvironmentError, e:
+                log.warning("Falling back to buffered forwarding in %s: %s",
+                        self, e)
+        return RingBuffer(self.buffer_size)
+
+    def egress_flow(self, connection):
+        """Register a downstream connection with the egress scheduler, unless
+        it is from this host.
+        """
+        if self.egress is None or is_loopback(connection.addr):
+            return None
+        return self.egress.add(self.egress_key, connection)
+
+    def connections(self):
+        """Every open connection of this tunnel, in both directions."""
+        connections = list(self.receivers)
+        if self.fanout:
+            if self.sender:
+                connections.append(self.sender)
+        else:
+            connections.extend(receiver.sender for receiver in self.receivers
+                    if receiver.sender)
+        return connections
+
+    def fds_per_connection(self):
+        """File descriptors the next accepted connection will hold, pipes
+        included.
+        """
+        if self.fanout:
+            return 1 if self.sender else 2
+        return 6 if self.splice else 2
+
+    def fd_count(self):
+        """File descriptors held by the connections of this tunnel, not
+        counting the listening socket.
+        """
+        count = len(self.connections())
+        if self.splice:
+            for receiver in self.receivers:
+                for buffer in (receiver.from_remote_buffer,
+                        receiver.to_remote_buffer):
+                    if isinstance(buffer, SplicePipe):
+                        count += 2
+        return count
+
+    def check_limit(self):
+        """Re-arm every connection when the tunnel crosses max_buffered, as
+        that changes whether any of them may read.
+        """
+        buffered = self.buffered
+        if buffered > self.peak_buffered:
+            self.peak_buffered = buffered
+        over_limit = buffered >= self.max_buffered
+        if over_limit != self._over_limit:
+            self._over_limit = over_limit
+            for connection in self.connections():
+                connection.update()
 
     def change_status(self, enabled):
         self.enabled = enabled
+        for receiver in self.receivers:
+            receiver.enabled = enabled
+            if receiver.sender:
+                receiver.sender.enabled = enabled
         if self.sender:
             self.sender.enabled = enabled
-            self.sender.receiver.enabled = enabled
 
     def handle_accept(self):
-        conn, addr = self.accept()
-        self.sender = Sender(Receiver(conn, enabled=self.enabled),
-                self.source_ip, self.source_port, enabled=self.enabled)
+        pair = self.accept()
+        if pair is None:
+            return
+        conn, addr = pair
+        if self.fd_budget and not self.fd_budget.admit(
+                self.fds_per_connection()):
+            log.warning("Turning away %s from %s, out of file descriptors",
+                    addr, self)
+            conn.close()
+            return
+        if self.fanout:
+            self.attach(conn)
+            return
+        receiver = Receiver(conn, self, enabled=self.enabled)
+        self.receivers.append(receiver)
+        try:
+            self.sender = Sender(receiver, self.source_ip, self.source_port,
+                    enabled=self.enabled)
+        except socket.error, e:
+            log.warning("Couldn't connect %s to its source: %s", self, e)
+            receiver.handle_close()
+
+    def handle_close(self):
+        """Stop listening and close every connection of the tunnel."""
+        self.close()
+        for receiver in self.receivers[:]:
+            receiver.handle_close()
+
+    def attach(self, conn):
+        """Add a downstream connection to the fan-out, opening the shared
+        connection to the source if this is the first one.
+        """
+        if not self.sender:
+            self.broadcast_buffer = BroadcastBuffer(self.buffer_size)
+            try:
+                self.sender = FanoutSender(self, self.source_ip,
+                        self.source_port, enabled=self.enabled)
+            except socket.error, e:
+                log.warning("Couldn't connect %s to its source: %s", self, e)
+                conn.close()
+                return
+        self.receivers.append(FanoutReceiver(conn, self,
+                enabled=self.enabled))
+
+    def detach(self, receiver):
+        """Remove a downstream connection from the tunnel. In fan-out mode,
+        also close the connection to the source when nobody is left to watch it.
+        """
+        if receiver in self.receivers:
+            self.receivers.remove(receiver)
+        if not self.fanout:
+            if self.sender is receiver.sender:
+                self.sender = None
+            return
+        self.broadcast_buffer.detach(receiver.cursor)
+        if not self.receivers and self.sender:
+            self.sender.close()
+            self.sender = None
+
+    def enforce_lag_limit(self):
+        for receiver in self.receivers[:]:
+            if len(receiver.cursor) > self.lag_limit:
+                log.info("Disconnecting %s from %s, it is %d bytes behind",
+                        receiver.addr, self, len(receiver.cursor))
+                receiver.handle_close()
+
+    def upstream_closed(self):
+        self.sender = None
+        for receiver in self.receivers[:]:
+            receiver.handle_close()
+
+    def retire(self, connection):
+        """Keep the totals of a connection that is going away."""
+        self.retired.add(connection.counter)
+        self.retired.rate_in = self.retired.rate_out = 0.0
+
+    def sample(self, now=None):
+        """Update the rates and last activity of every connection."""
+        for connection in self.connections():
+            connection.counter.sample(now)
+
+    def reap_idle(self, timeout, now=None):
+        """Close the downstream connections (and their connection upstream)
+        that have been idle in both directions for more than timeout seconds,
+        going by the last activity of their counters. Returns how many were
+        closed.
+        """
+        deadline = (now or time.time()) - timeout
+        reaped = 0
+        for receiver in self.receivers[:]:
+            last_activity = receiver.counter.last_activity
+            if receiver.sender:
+                last_activity = max(last_activity,
+                        receiver.sender.counter.last_activity)
+            if last_activity < deadline:
+                log.info("Closing %s from %s, idle since %s", receiver.addr,
+                        self, time.ctime(last_activity))
+                receiver.handle_close()
+                reaped += 1
+        return reaped
+
+    def stats(self):
+        """Traffic through the tunnel so far, and through each open
+        connection.
+        """
+        total = TrafficCounter()
+        total.last_activity = 0
+        total.add(self.retired)
+        connections = []
+        for connection in self.connections():
+            total.add(connection.counter)
+            entry = connection.counter.to_dict()
+            entry['role'] = connection.role
+            entry['peer'] = connection.addr
+            entry['paused'] = connection.paused
+            connections.append(entry)
+        stats = total.to_dict()
+        stats.update({'source': (self.source_ip, self.source_port),
+            'bind_port': self.bind_port, 'enabled': self.enabled,
+            'fanout': self.fanout, 'splice': self.splice,
+            'buffered': self.buffered,
+            'peak_buffered': max(self.peak_buffered, total.peak_buffered),
+            'backpressure_count': self.backpressure_count,
+            'connections': connections})
+        return stats
 
     def __str__(self):
         return "<Tunnel from %s:%s -> %s:%s>" % (self.source_ip,
                 self.source_port, self.bind_ip, self.bind_port)
 
 
-class Receiver(asyncore.dispatcher, object):
-    def __init__(self, connection, enabled=True):
-        super(Receiver, self).__init__(connection)
-        self.from_remote_buffer = ''
-        self.to_remote_buffer = ''
-        self.sender = None
+class BufferedDispatcher(Dispatcher):
+    """A channel that reads into and writes out of RingBuffers, with a read
+    size that adapts to the throughput of the connection and high/low water
+    marks on the buffer it reads into. Traffic through it is tallied in
+    counter.
+
+    Moving bytes through a buffer can make the channel on the other end of it
+    readable or writable, so after every event the channels returned by peers()
+    are re-armed as well.
+    """
+    def __init__(self, tunnel, connection=None, enabled=True):
+        super(BufferedDispatcher, self).__init__(connection,
+                io_loop=tunnel.io_loop)
+        self.tunnel = tunnel
         self.enabled = enabled
+        self.read_size = ReadSize(MIN_READ_SIZE, MAX_READ_SIZE)
+        self.paused = False
+        self.backpressure_count = 0
+        self.flow = None
+        self.counter = TrafficCounter()
+
+    def peers(self):
+        """The channels sharing a buffer with this one."""
+        return []
+
+    def handle_events_done(self):
+        self.update()
+        for peer in self.peers():
+            peer.update()
+        self.tunnel.check_limit()
+
+    def should_read(self, buffer):
+        """Apply backpressure once buffer passes the high water mark (or the
+        tunnel as a whole holds too much) and release it when buffer has been
+        drained down to the low water mark.
+        """
+        if self.paused:
+            if (len(buffer) <= self.tunnel.low_water
+                    and not self.tunnel.over_limit()):
+                self.paused = False
+        elif (len(buffer) >= self.tunnel.high_water or buffer.full()
+                or self.tunnel.over_limit()):
+            self.paused = True
+            self.backpressure_count += 1
+            self.tunnel.backpressure_count += 1
+        return not self.paused
+
+    def read_into(self, buffer):
+        """Read from the socket into buffer, returning the number of bytes
+        received.
+        """
+        if not self.enabled:
+            # drop the data on the floor, but keep draining the socket
+            self.recv(int(self.read_size))
+            return 0
+        requested = min(int(self.read_size), buffer.free)
+        try:
+            received = buffer.recv_into(self.socket, requested)
+        except ConnectionLost:
+            self.handle_close()
+            return 0
+        self.read_size.update(requested, received)
+        counter = self.counter
+        counter.bytes_in += received
+        counter.reads += 1
+        buffered = len(buffer)
+        if buffered > counter.peak_buffered:
+            counter.peak_buffered = buffered
+        return received
+
+    def may_write(self):
+        """False while the egress scheduler has no bandwidth for us."""
+        return self.flow is None or self.flow.limit() != 0
+
+    def write_from(self, buffer):
+        """Write out of buffer to the socket, as much as the egress scheduler
+        allows, returning the number of bytes sent.
+        """
+        limit = self.flow.limit() if self.flow else None
+        try:
+            sent = buffer.send(self.socket, limit)
+        except ConnectionLost:
+            self.handle_close()
+            return 0
+        if self.flow:
+            self.flow.spend(sent)
+        self.counter.bytes_out += sent
+        self.counter.writes += 1
+        return sent
 
-    def handle_connect(self):
-        pass
+    def close(self):
+        if self.socket is None:
+            return
+        super(BufferedDispatcher, self).close()
+        self.tunnel.retire(self)
+        if self.flow:
+            self.flow.close()
+            self.flow = None
+
+
+class Receiver(BufferedDispatcher):
+    role = 'downstream'
+
+    def __init__(self, connection, tunnel, enabled=True):
+        super(Receiver, self).__init__(tunnel, connection, enabled=enabled)
+        self.from_remote_buffer = tunnel.new_buffer()
+        self.to_remote_buffer = tunnel.new_buffer()
+        self.sender = None
+        self.flow = tunnel.egress_flow(self)
+
+    def peers(self):
+        return [self.sender] if self.sender else []
+
+    def readable(self):
+        return self.should_read(self.from_remote_buffer)
 
     def handle_read(self):
-        read = self.recv(512)
-        if self.enabled:
-            self.from_remote_buffer += read
+        self.tunnel._buffered += self.read_into(self.from_remote_buffer)
+
+    def queued(self):
+        return len(self.to_remote_buffer)
 
     def writable(self):
-        return (len(self.to_remote_buffer) > 0)
+        return len(self.to_remote_buffer) > 0 and self.may_write()
 
     def handle_write(self):
-        sent = self.send(self.to_remote_buffer)
-        self.to_remote_buffer = self.to_remote_buffer[sent:]
+        self.tunnel._buffered -= self.write_from(self.to_remote_buffer)
+
+    def release(self):
+        """Drop whatever is still buffered for this connection pair."""
+        for buffer in (self.from_remote_buffer, self.to_remote_buffer):
+            self.tunnel._buffered -= buffer.consume(len(buffer))
+            buffer.close()
+        self.tunnel.detach(self)
 
     def handle_close(self):
         self.close()
         if self.sender:
             self.sender.close()
+        self.release()
+
 
+class FanoutReceiver(BufferedDispatcher):
+    """A downstream connection of a fan-out Tunnel, written to from its own
+    cursor into the tunnel's broadcast buffer.
+    """
+    role = 'downstream'
+
+    def __init__(self, connection, tunnel, enabled=True):
+        super(FanoutReceiver, self).__init__(tunnel, connection,
+                enabled=enabled)
+        self.cursor = tunnel.broadcast_buffer.attach()
+        self.sender = None
+        self.flow = tunnel.egress_flow(self)
+
+    def peers(self):
+        return [self.tunnel.sender] if self.tunnel.sender else []
+
+    def readable(self):
+        if self.tunnel.primary is self and self.tunnel.sender:
+            return self.should_read(self.tunnel.sender.to_remote_buffer)
+        return True
+
+    def handle_read(self):
+        if self.tunnel.primary is self and self.tunnel.sender:
+            self.read_into(self.tunnel.sender.to_remote_buffer)
+        else:
+            self.recv(int(self.read_size))
+
+    def queued(self):
+        return len(self.cursor)
+
+    def writable(self):
+        return len(self.cursor) > 0 and self.may_write()
+
+    def handle_write(self):
+        self.write_from(self.cursor)
+
+    def handle_close(self):
+        self.close()
+        self.tunnel.detach(self)
+
+
+class FanoutSender(BufferedDispatcher):
+    """The single connection to the source of a fan-out Tunnel."""
+    role = 'upstream'
+
+    def __init__(self, tunnel, destination_ip, destination_port, enabled=True):
+        super(FanoutSender, self).__init__(tunnel, enabled=enabled)
+        self.to_remote_buffer = RingBuffer(tunnel.buffer_size)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((destination_ip, destination_port))
+
+    def peers(self):
+        return self.tunnel.receivers
+
+    def readable(self):
+        return self.should_read(self.tunnel.broadcast_buffer)
+
+    def handle_read(self):
+        self.read_into(self.tunnel.broadcast_buffer)
+        self.tunnel.enforce_lag_limit()
+
+    def writable(self):
+        return len(self.to_remote_buffer) > 0
+
+    def handle_write(self):
+        self.write_from(self.to_remote_buffer)
+
+    def handle_close(self):
+        self.close()
+        if self.tunnel.sender is self:
+            self.tunnel.upstream_closed()
+
+
+class Sender(BufferedDispatcher):
+    role = 'upstream'
 
-class Sender(asyncore.dispatcher, object):
     def __init__(self, receiver, destination_ip, destination_port,
             enabled=True):
-        super(Sender, self).__init__()
+        super(Sender, self).__init__(receiver.tunnel, enabled=enabled)
         self.receiver = receiver
         receiver.sender = self
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.connect((destination_ip, destination_port))
-        self.enabled = enabled
 
-    def handle_connect(self):
-        pass
+    def peers(self):
+        return [self.receiver]
+
+    def readable(self):
+        return self.should_read(self.receiver.to_remote_buffer)
 
     def handle_read(self):
-        read = self.recv(512)
-        if self.enabled:
-            self.receiver.to_remote_buffer += read
+        self.tunnel._buffered += self.read_into(self.receiver.to_remote_buffer)
 
     def writable(self):
         return len(self.receiver.from_remote_buffer) > 0
 
     def handle_write(self):
-        sent = self.send(self.receiver.from_remote_buffer)
-        self.receiver.from_remote_buffer = self.receiver.from_remote_buffer[sent:]
+        self.tunnel._buffered -= self.write_from(
+                self.receiver.from_remote_buffer)
 
     def handle_close(self):
         self.close()
         self.receiver.close()
-
+        self.receiver.release()
 
 if __name__=='__main__':
     publisher_address = ('127.0.0.1', 1935)
@@ -118,4 +593,4 @@ if __name__=='__main__':
             publisher_address[1])
     print "Liaison started: %s:%d <-> %s:%d" % (publisher_address[0],
             publisher_address[1], liaison_address[0], liaison_address[1])
-    asyncore.loop()
+    ioloop.IOLoop.instance().start()
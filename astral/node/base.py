@@ -7,7 +7,7 @@ Node Base Class.
 """
 
 import astral.api.app
-from astral.models import Node, Ticket, session
+from astral.models import Node, Stream, Ticket, session
 from astral.conf import settings
 from astral.api.client import NodesAPI, TicketsAPI
 from astral.node.bootstrap import BootstrapThread
@@ -26,8 +26,11 @@ class LocalNode(object):
         self.upstream_limit = upstream_limit
         self.uuid = uuid_override
         self.bootstrap()
-        StreamingThread().start()
-        TunnelControlThread().start()
+        self.streaming = StreamingThread(upstream=self.upstream_url)
+        self.streaming.start()
+        self.tunnel_control = TunnelControlThread(
+                upstream_limit=upstream_limit)
+        self.tunnel_control.start()
         DaemonThread().start()
 
         try:
@@ -38,6 +41,26 @@ class LocalNode(object):
     def node(self):
         return Node.get_by(uuid=self.uuid) or Node.me(uuid_override=self.uuid)
 
+    def upstream_url(self, name):
+        """Returns the RTMP URL of the node we get the stream called name (or
+        with that slug) from, or None if we don't have a confirmed ticket for it
+        from another node. Called from the RTMP server's thread.
+        """
+        try:
+            stream = Stream.get_by(slug=name) or Stream.get_by(name=name)
+            if not stream:
+                return None
+            ticket = Ticket.query.filter_by(stream=stream,
+                    destination=Node.me(), confirmed=True).filter(
+                    Ticket.source != Node.me()).first()
+            if not ticket or not ticket.source:
+                return None
+            return 'rtmp://%s:%d/%s' % (ticket.source.ip_address,
+                    ticket.source_port or settings.RTMP_PORT,
+                    settings.RTMP_APP_NAME)
+        finally:
+            session.commit()
+
     def _unregister_from_origin(self):
         if self.node().supernode:
             log.info("Unregistering ourself (%s) from the web server",
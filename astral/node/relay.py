@@ -0,0 +1,81 @@
+"""
+astral.node.relay
+==========
+
+Relays a stream from the RTMP server of another node to the one of this node.
+
+The stream is pulled over a single RTMP connection however many players it has
+here, local viewers and downstream nodes alike, and republished in-process.
+
+"""
+from astral.rtmp import multitask, rtmp, rtmpclient
+
+import logging
+log = logging.getLogger(__name__)
+
+MEDIA_TYPES = (rtmp.Message.AUDIO, rtmp.Message.VIDEO, rtmp.Message.DATA,
+        rtmp.Message.DATA3)
+
+
+class Relay(object):
+    """Plays the stream called name from the RTMP server at url, and publishes
+    it under the same name in the application instance inst of the local
+    FlashServer agent.
+
+    Each message that comes in goes through agent.mediahandler as if a local
+    client had published it, so it reaches every player of the stream and the
+    stream's GOP cache. For as long as it runs, the relay stands in for the
+    client of that published stream.
+    """
+    def __init__(self, agent, inst, path, name, url, timeout=None):
+        self.agent, self.inst, self.path = agent, inst, path
+        self.name, self.url, self.timeout = name, url, timeout
+        self.nc = self.stream = None
+        self.closed = False
+
+    def run(self):
+        """A generator that relays the stream until it ends upstream or the
+        relay is closed.
+        """
+        try:
+            self.nc = rtmpclient.NetConnection()
+            connected = yield self.nc.connect(self.url, timeout=self.timeout)
+            if not connected:
+                log.warning("Unable to connect to %s to relay %s", self.url,
+                        self.name)
+                return
+            ns = yield rtmpclient.NetStream().create(self.nc,
+                    timeout=self.timeout)
+            if ns is None or self.closed:
+                return
+            # a SmartQueue never hands out the None that marks the end of the
+            # connection, so read the stream through a plain Queue instead
+            ns.stream.queue = multitask.Queue()
+            yield ns.play(self.name, timeout=self.timeout)
+            if self.closed or self.name in self.inst.publishers:
+                return
+            self.stream = rtmp.Stream(self)
+            self.stream.name = self.name
+            if self.agent.gopCacheSize:
+                self.stream.gop = rtmp.GopCache(self.agent.gopCacheSize)
+            self.inst.publishers[self.name] = self.stream
+            log.info("Relaying %s from %s", self.name, self.url)
+            while not self.closed:
+                message = yield ns.stream.queue.get()
+                if message is None:
+                    break
+                if message.type in MEDIA_TYPES:
+                    self.agent.mediahandler(self.stream, message)
+        finally:
+            if (self.stream is not None and
+                    self.inst.publishers.get(self.name) is self.stream):
+                del self.inst.publishers[self.name]
+                self.stream.close()
+            self.close()
+            log.info("Stopped relaying %s from %s", self.name, self.url)
+
+    def close(self):
+        """Drops the upstream connection, which ends run() with it."""
+        self.closed = True
+        if self.nc is not None and self.nc.client is not None:
+            multitask.add(self.nc.close())
@@ -1,34 +1,110 @@
 import threading
 
 from astral.conf import settings
-from astral.rtmp import rtmp, multitask
+from astral.node.relay import Relay
+from astral.rtmp import evented, rtmp, multitask
 
 import logging
 log = logging.getLogger(__name__)
 
 
+ENGINES = {'multitask': rtmp.FlashServer,
+        'ioloop': evented.EventedFlashServer}
+
+
 class StreamingThread(threading.Thread):
-    """Manages the RTMP server and socket forwarder.
+    """Manages the RTMP server and the relays of streams from other nodes.
     The server is exposed at localhost:RTMP_PORT/RTMP_APP_NAME.
+
+    upstream is called with the name of a stream that is played here but not
+    published here, and returns the RTMP URL of the node to relay it from, or
+    None to leave the players waiting for a local publisher.
+
+    engine is the RTMP_ENGINE the server runs on. With 'multitask' it runs in
+    this thread. With 'ioloop' it runs on the IOLoop instance, with the API
+    and the tunnels, and this thread only starts it. Relays need the multitask
+    engine, so there are none with 'ioloop'.
     """
 
-    def __init__(self):
+    def __init__(self, upstream=None, engine=None):
         super(StreamingThread, self).__init__()
         self.daemon = True
-        self.agent = rtmp.FlashServer()
-        self.agent.apps = dict({settings.RTMP_APP_NAME: self.AstralApp})
+        self.upstream = upstream
+        self.engine = engine or settings.RTMP_ENGINE
+        if self.engine not in ENGINES:
+            raise ValueError("Unknown RTMP engine %r, expected one of %s" % (
+                    self.engine, ', '.join(sorted(ENGINES))))
+        self.relay = settings.RTMP_RELAY and self.engine == 'multitask'
+        if settings.RTMP_RELAY and not self.relay:
+            log.warning("Relays need the multitask RTMP engine, streams from "
+                    "other nodes are only played through their tunnels")
+        self.agent = ENGINES[self.engine]()
+        self.agent.apps = dict({settings.RTMP_APP_NAME: self.app})
+        self.agent.chunkSize = settings.RTMP_CHUNK_SIZE
+        self.agent.gopCacheSize = settings.RTMP_GOP_CACHE_SIZE
+        self.agent.queueBytes = settings.RTMP_QUEUE_BYTES
+        self.agent.queueTime = settings.RTMP_QUEUE_TIME
+        self.agent.recordQueueSize = settings.RTMP_RECORD_QUEUE_SIZE
+        self.agent.recordSyncInterval = settings.RTMP_RECORD_SYNC_INTERVAL
 
     def run(self):
-        log.info("Starting RTMP server on port %d", settings.RTMP_PORT)
+        log.info("Starting RTMP server on port %d with the %s engine",
+                settings.RTMP_PORT, self.engine)
         self.agent.start('0.0.0.0', settings.RTMP_PORT)
-        multitask.run()
+        if self.engine == 'multitask':
+            multitask.run()
 
     def stop(self):
         log.info("Stopping the RTMP server on port %d", settings.RTMP_PORT)
         self.agent.stop()
 
-    # TO DO: overwrite Protocol.parsemessage to intercept and forward data
-    # packets between Astral nodes (start-up messages will need to be simulated)
+    def recording_stats(self):
+        """Counters of the recorder of every stream recorded here, by stream
+        name: messages written, dropped and still queued, write batches and
+        seconds spent writing, in all and at most in one batch.
+        """
+        stats = {}
+        for clients in self.agent.clients.values():
+            for name, stream in clients[0].publishers.items():
+                if stream.recordfile is not None:
+                    stats[name] = stream.recordfile.stats()
+        return stats
+
+    def app(self):
+        return self.AstralApp(self)
+
     class AstralApp(rtmp.App):
-        def __init__(self):
+        """Pulls each stream that is played here but published elsewhere once
+        from upstream, over a Relay, and shares it among all of its players.
+        """
+        def __init__(self, streaming):
             rtmp.App.__init__(self)
+            self.streaming = streaming
+            self.relays = {}
+
+        def onPlay(self, client, stream):
+            rtmp.App.onPlay(self, client, stream)
+            name = stream.name
+            if (not self.streaming.relay or name in self.publishers
+                    or name in self.relays or not self.streaming.upstream):
+                return
+            url = self.streaming.upstream(name)
+            if url:
+                relay = self.relays[name] = Relay(self.streaming.agent, self,
+                        client.path, name, url,
+                        timeout=settings.RTMP_RELAY_TIMEOUT)
+                multitask.add(self._relay(relay))
+
+        def onStop(self, client, stream):
+            rtmp.App.onStop(self, client, stream)
+            # called before the stream leaves the players of its name
+            if (stream.name in self.relays and
+                    len(self.players.get(stream.name, [])) <= 1):
+                self.relays[stream.name].close()
+
+        def _relay(self, relay):
+            try:
+                yield relay.run()
+            finally:
+                if self.relays.get(relay.name) is relay:
+                    del self.relays[relay.name]
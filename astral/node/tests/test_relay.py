@@ -0,0 +1,93 @@
+import socket
+import time
+import unittest2
+from nose.tools import eq_, ok_
+
+from astral.node.relay import Relay
+from astral.rtmp import multitask, rtmpclient
+from astral.rtmp.rtmp import App, FlashServer, Header, Message, Stream
+
+
+class FakeClient(object):
+    path = 'live'
+
+    def __init__(self):
+        self.written = []
+
+    def writeMessage(self, message):
+        self.written.append(message)
+
+
+class RelayTest(unittest2.TestCase):
+    def setUp(self):
+        self.manager = multitask._default_task_manager = \
+                multitask.TaskManager()
+        self.upstream = FlashServer()
+        self.upstream.start('127.0.0.1', 0)
+        self.url = 'rtmp://127.0.0.1:%d/live' % (
+                self.upstream.sock.getsockname()[1])
+        self.local = FlashServer()
+        self.inst = App()
+        self.local.clients['live'] = [self.inst]
+        self.players = [Stream(FakeClient()) for i in range(3)]
+        for player in self.players:
+            player.name = 'cam'
+        self.inst.players['cam'] = list(self.players)
+
+    def tearDown(self):
+        self.upstream.stop()
+        multitask._default_task_manager = None
+
+    def run_until(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            self.manager.run_next(timeout=0.01)
+        ok_(condition())
+
+    def publish(self, count):
+        nc = rtmpclient.NetConnection()
+        ok_((yield nc.connect(self.url, timeout=5)))
+        ns = yield rtmpclient.NetStream().create(nc, timeout=5)
+        yield ns.publish('cam', timeout=5)
+        while 'cam' not in self.inst.publishers:
+            yield multitask.sleep(0.01)
+        for i in range(count):
+            ns.stream.send(Message(Header(time=i, size=3,
+                type=Message.VIDEO), ('\x27' if i else '\x17') + '\x01' +
+                chr(i)))
+        yield multitask.sleep(5)
+
+    def upstream_inst(self):
+        return self.upstream.clients['live'][0]
+
+    def test_players_share_one_upstream_stream(self):
+        relay = Relay(self.local, self.inst, 'live', 'cam', self.url,
+                timeout=5)
+        self.manager.add(relay.run())
+        self.manager.add(self.publish(3))
+        self.run_until(lambda: all(len(player.client.written) == 3
+            for player in self.players))
+        for player in self.players:
+            eq_([m.data for m in player.client.written],
+                    ['\x17\x01\x00', '\x27\x01\x01', '\x27\x01\x02'])
+        eq_(len(self.upstream_inst().players['cam']), 1)
+        eq_(len(self.inst.publishers['cam'].gop.frames), 3)
+
+    def test_close_drops_upstream_stream(self):
+        relay = Relay(self.local, self.inst, 'live', 'cam', self.url,
+                timeout=5)
+        self.manager.add(relay.run())
+        self.run_until(lambda: 'cam' in self.inst.publishers)
+        relay.close()
+        self.run_until(lambda: 'cam' not in self.inst.publishers)
+        self.run_until(lambda: 'live' not in self.upstream.clients)
+
+    def test_unreachable_upstream(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = 'rtmp://127.0.0.1:%d/live' % sock.getsockname()[1]
+        sock.close()
+        relay = Relay(self.local, self.inst, 'live', 'cam', url, timeout=5)
+        self.manager.add(relay.run())
+        self.run_until(lambda: relay.closed)
+        ok_('cam' not in self.inst.publishers)
@@ -0,0 +1,50 @@
+import unittest2
+from nose.tools import eq_, ok_
+
+from astral.conf import settings
+from astral.node.stream import StreamingThread
+from astral.rtmp.evented import EventedFlashServer
+from astral.rtmp.rtmp import FlashServer, Stream
+
+
+class FakeClient(object):
+    path = 'astral'
+
+    def writeMessage(self, message):
+        pass
+
+
+class StreamingThreadTest(unittest2.TestCase):
+    def setUp(self):
+        self.upstreams = []
+
+    def upstream(self, name):
+        self.upstreams.append(name)
+        return None
+
+    def play(self, streaming, name):
+        app = streaming.app()
+        stream = Stream(FakeClient())
+        stream.name = name
+        app.onPlay(stream.client, stream)
+
+    def test_multitask_engine(self):
+        streaming = StreamingThread(self.upstream, engine='multitask')
+        ok_(type(streaming.agent) is FlashServer)
+        eq_(streaming.relay, settings.RTMP_RELAY)
+        eq_(streaming.agent.recordQueueSize, settings.RTMP_RECORD_QUEUE_SIZE)
+        eq_(streaming.agent.recordSyncInterval,
+                settings.RTMP_RECORD_SYNC_INTERVAL)
+        self.play(streaming, 'cam')
+        eq_(self.upstreams, ['cam'] if settings.RTMP_RELAY else [])
+
+    def test_ioloop_engine_has_no_relays(self):
+        streaming = StreamingThread(self.upstream, engine='ioloop')
+        ok_(isinstance(streaming.agent, EventedFlashServer))
+        ok_(not streaming.relay)
+        eq_(streaming.agent.queueBytes, settings.RTMP_QUEUE_BYTES)
+        self.play(streaming, 'cam')
+        eq_(self.upstreams, [])
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, StreamingThread, engine='threads')
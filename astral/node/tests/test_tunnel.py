@@ -0,0 +1,93 @@
+from nose.tools import eq_, ok_
+import Queue
+
+from astral.api.tests import BaseTest
+from astral.models import Node, Ticket, Stream, session
+from astral.models.ticket import TUNNEL_QUEUE, TunnelDeleted
+from astral.models.tests.factories import TicketFactory, StreamFactory
+from astral.node.tunnel import TunnelControlThread, TunnelFuture
+
+
+class FakeTunnel(object):
+    backpressure_count = 0
+    closed = False
+
+    def handle_close(self):
+        self.closed = True
+
+
+def drain_tunnel_queue():
+    items = []
+    while True:
+        try:
+            items.append(TUNNEL_QUEUE.get_nowait())
+        except Queue.Empty:
+            return items
+
+
+class TunnelControlThreadTest(BaseTest):
+    def setUp(self):
+        super(TunnelControlThreadTest, self).setUp()
+        self.control = TunnelControlThread(io_loop=self.io_loop)
+        drain_tunnel_queue()
+
+    def test_ticket_deletion_closes_tunnel(self):
+        tunnel = FakeTunnel()
+        self.control.tunnels[42] = tunnel
+        self.control.handle(TunnelDeleted(Ticket, 42))
+        ok_(42 not in self.control.tunnels)
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+        ok_(tunnel.closed)
+
+    def test_stream_deletion_closes_tunnel(self):
+        self.control.stream_tunnels['a-stream'] = FakeTunnel()
+        self.control.handle(TunnelDeleted(Stream, 'a-stream'))
+        eq_(self.control.stream_tunnels, {})
+
+    def test_unknown_deletion(self):
+        self.control.handle(TunnelDeleted(Ticket, 42))
+        eq_(self.control.tunnels, {})
+
+    def test_deleting_ticket_queues_deletion(self):
+        ticket = TicketFactory()
+        session.commit()
+        ticket_id = ticket.id
+        drain_tunnel_queue()
+        ticket.delete()
+        session.commit()
+        deletions = [item for item in drain_tunnel_queue()
+                if isinstance(item, TunnelDeleted)]
+        eq_(len(deletions), 1)
+        eq_(deletions[0].entity, Ticket)
+        eq_(deletions[0].key, ticket_id)
+
+    def test_reconcile(self):
+        # streams look up Node.me() while they are inserted, have it ready
+        Node.me()
+        session.commit()
+        ticket = TicketFactory()
+        stream = StreamFactory()
+        session.commit()
+        self.control.tunnels[ticket.id] = FakeTunnel()
+        self.control.tunnels[ticket.id + 1000] = FakeTunnel()
+        self.control.stream_tunnels[stream.slug] = FakeTunnel()
+        self.control.stream_tunnels['gone'] = FakeTunnel()
+        self.control.reconcile()
+        eq_(self.control.tunnels.keys(), [ticket.id])
+        eq_(self.control.stream_tunnels.keys(), [stream.slug])
+
+    def test_tunnel_future_resolved(self):
+        future = self.control.tunnel_future(42)
+        ok_(self.control.tunnel_future(42) is future)
+        self.control._resolve_future(42, port=1234)
+        ok_(future.done())
+        eq_(future.wait(0), 1234)
+        ok_(42 not in self.control.futures)
+
+    def test_tunnel_future_callback_on_loop(self):
+        future = TunnelFuture()
+        future.add_done_callback(self.stop, self.io_loop)
+        future.resolve(error="gone")
+        eq_(self.wait(), future)
+        eq_(future.error, "gone")
@@ -1,48 +1,150 @@
+import errno
+import socket
 import threading
-import asyncore
+import time
+import Queue
+
+from tornado import ioloop
 
 from astral.conf import settings
+from astral.net.egress import EgressScheduler
+from astral.net.fds import FdBudget
+from astral.net.ports import ListenerPool
 from astral.net.tunnel import Tunnel
 from astral.models import Ticket, Node, session, Stream
-from astral.models.ticket import TUNNEL_QUEUE
+from astral.models.ticket import TUNNEL_QUEUE, TunnelDeleted
 
 import logging
 log = logging.getLogger(__name__)
 
 
-class TunnelControlThread(threading.Thread):
+class TunnelFuture(object):
+    """Resolves with the port of a ticket's tunnel once it is listening and
+    the port has been saved to the ticket, or with the error that stopped it.
+    """
     def __init__(self):
+        self.port = None
+        self.error = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def resolve(self, port=None, error=None):
+        with self._lock:
+            self.port = port
+            self.error = error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback, io_loop=None):
+        """Call callback(future) on io_loop once the future resolves."""
+        io_loop = io_loop or ioloop.IOLoop.instance()
+        callback_on_loop = lambda future: io_loop.add_callback(
+                lambda: callback(future))
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback_on_loop)
+                return
+        callback_on_loop(self)
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.port
+
+
+class TunnelControlThread(threading.Thread):
+    """Creates and destroys tunnels as tickets and streams come and go.
+
+    Tunnels are keyed by ticket id and stream slug, and every event on the
+    TUNNEL_QUEUE only touches the one tunnel it is about. Every
+    TUNNEL_RECONCILE_INTERVAL seconds the tunnels are also compared with the
+    tickets and streams in the database (one query each) to catch anything the
+    events missed.
+
+    Listening sockets for new tunnels come out of a pool that is bound ahead
+    of time, and anybody waiting for the port of a ticket's tunnel can get a
+    TunnelFuture for it with tunnel_future().
+
+    Connections that have been idle for TUNNEL_IDLE_TIMEOUT seconds are
+    closed, and new tunnels and connections are turned away once the node is
+    about to run out of file descriptors (FD_BUDGET).
+
+    The tunnels themselves run on the node's Tornado IOLoop, this thread only
+    sets them up and hands them over to it. Everything they send to other
+    nodes goes through the egress scheduler, limited to upstream_limit (KB/s)
+    or else the measured upstream of the node.
+    """
+    def __init__(self, upstream_limit=None, io_loop=None):
         super(TunnelControlThread, self).__init__()
         self.daemon = True
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+        self.upstream_limit = upstream_limit
+        self.egress = EgressScheduler(io_loop=self.io_loop)
+        self.sampler = ioloop.PeriodicCallback(self.sample_counters,
+                settings.TUNNEL_COUNTER_INTERVAL, self.io_loop)
+        self.listeners = ListenerPool(settings.TUNNEL_LISTENER_POOL_SIZE)
+        self.fd_budget = FdBudget(settings.FD_BUDGET)
+        self.futures = dict()
+        self.futures_lock = threading.Lock()
         self.tunnels = dict()
         self.stream_tunnels = dict()
-        self.async_loop_thread = TunnelLoopThread()
+        self.last_reconciled = time.time()
+
+    def tunnel_future(self, ticket_id):
+        """Return a TunnelFuture for the tunnel of a ticket. Ask for it before
+        queueing the ticket, or it may already have been handled.
+        """
+        with self.futures_lock:
+            future = self.futures.get(ticket_id)
+            if not future:
+                future = self.futures[ticket_id] = TunnelFuture()
+            return future
+
+    def _resolve_future(self, ticket_id, port=None, error=None):
+        with self.futures_lock:
+            future = self.futures.pop(ticket_id, None)
+        if future:
+            future.resolve(port, error)
 
     def _handle_ticket(self, ticket):
         # reload to get a new database session
-        ticket = Ticket.get_by(id=ticket.id)
+        ticket_id = ticket.id
+        ticket = Ticket.get_by(id=ticket_id)
+        if not ticket:
+            # deleted since it was queued, the deletion is on its way
+            self._resolve_future(ticket_id, error="Ticket was deleted")
+            return
         if ticket.source == Node.me():
             source_ip = "127.0.0.1"
         else:
             source_ip = ticket.source.ip_address
         try:
             port = self.create_tunnel(ticket.id, source_ip,
-                    ticket.source_port, self.tunnels)
+                    ticket.source_port, self.tunnels,
+                    fanout=settings.TUNNEL_FANOUT,
+                    splice=settings.TUNNEL_SPLICE)
         except Exception, e:
             log.warning("Couldn't create a tunnel for %s: %s",
                     ticket, e)
+            self._resolve_future(ticket_id, error=str(e))
         else:
             if not ticket.destination_port or ticket.destination_port != port:
                 ticket.destination_port = port
             session.commit()
-            self.close_expired_tunnels()
-        finally:
-            TUNNEL_QUEUE.task_done()
+            self._resolve_future(ticket_id, port)
 
     def _handle_stream(self, stream):
-        """Update the enabled flag on all tunnels that are for this stream."""
+        """Make sure a local stream has a tunnel, and update its enabled flag.
+        """
         # reload to get a new database session
         stream = Stream.get_by(slug=stream.slug)
+        if not stream:
+            return
         try:
             port = self.create_tunnel(stream.slug, "127.0.0.1",
                     settings.RTMP_PORT, self.stream_tunnels)
@@ -53,65 +155,134 @@ class TunnelControlThread(threading.Thread):
             if not stream.source_port or stream.source_port != port:
                 stream.source_port = port
             session.commit()
-        self.close_expired_stream_tunnels()
-        self.update_stream_tunnel_flags()
-        TUNNEL_QUEUE.task_done()
-
-    def update_stream_tunnel_flags(self):
-        for slug, tunnel in self.stream_tunnels.items():
-            stream = Stream.get_by(slug=slug)
-            if stream:
-                pass
-                #log.debug("Set streaming status of %s to %s", tunnel,
-                #stream.streaming)
-                # TODO temporarily disabled, doesn't seem to work with RTMP
-                #if tunnel.enabled != stream.streaming:
-                    #tunnel.change_status(stream.streaming)
+            self.update_stream_tunnel_flag(stream,
+                    self.stream_tunnels[stream.slug])
+
+    def _handle_deletion(self, deletion):
+        if deletion.entity is Ticket:
+            tunnel_dict = self.tunnels
+        else:
+            tunnel_dict = self.stream_tunnels
+        if deletion.key in tunnel_dict:
+            self.destroy_tunnel(deletion.key, tunnel_dict)
+
+    def update_stream_tunnel_flag(self, stream, tunnel):
+        pass
+        #log.debug("Set streaming status of %s to %s", tunnel,
+        #stream.streaming)
+        # TODO temporarily disabled, doesn't seem to work with RTMP
+        #if tunnel.enabled != stream.streaming:
+            #tunnel.change_status(stream.streaming)
+
+    def update_egress_rate(self):
+        upstream = self.upstream_limit or Node.me().upstream
+        if settings.TUNNEL_EGRESS_LIMIT and upstream:
+            self.egress.rate = int(upstream) * 1024
+        else:
+            self.egress.rate = None
+
+    def sample_counters(self):
+        """Update the traffic counters of every tunnel, then close the idle
+        connections and take a fresh count of the open file descriptors.
+        """
+        now = time.time()
+        for tunnel in self.tunnels.values() + self.stream_tunnels.values():
+            tunnel.sample(now)
+            if settings.TUNNEL_IDLE_TIMEOUT:
+                tunnel.reap_idle(settings.TUNNEL_IDLE_TIMEOUT, now)
+        self.fd_budget.refresh()
+
+    def fd_usage(self):
+        """File descriptors held by tunnels, listening and connected."""
+        tunnels = self.tunnels.values() + self.stream_tunnels.values()
+        return {'tunnel_listeners': len(tunnels) + len(self.listeners),
+                'tunnel_connections': sum(tunnel.fd_count()
+                    for tunnel in tunnels)}
+
+    def stats(self):
+        """Traffic counters of every tunnel, by ticket id and stream slug."""
+        return {'tickets': dict((str(ticket_id), tunnel.stats())
+                    for ticket_id, tunnel in self.tunnels.items()),
+                'streams': dict((slug, tunnel.stats())
+                    for slug, tunnel in self.stream_tunnels.items())}
 
     def run(self):
+        self.io_loop.add_callback(self.egress.start)
+        self.io_loop.add_callback(self.sampler.start)
+        if not self.fd_budget.exhausted():
+            self.listeners.fill()
         while True:
-            obj = TUNNEL_QUEUE.get()
+            timeout = (self.last_reconciled + settings.TUNNEL_RECONCILE_INTERVAL
+                    - time.time())
+            if timeout <= 0:
+                self.reconcile()
+                continue
+            try:
+                obj = TUNNEL_QUEUE.get(timeout=timeout)
+            except Queue.Empty:
+                continue
             log.debug("Found %s in tunnel queue", obj)
-            if isinstance(obj, Ticket):
-                self._handle_ticket(obj)
-            elif isinstance(obj, Stream):
-                self._handle_stream(obj)
+            try:
+                self.handle(obj)
+            except Exception:
+                log.exception("Couldn't handle %s", obj)
+                session.rollback()
+            finally:
+                TUNNEL_QUEUE.task_done()
+            # tunnels that were waited on have their ports, catch up now
+            if not self.fd_budget.exhausted():
+                self.listeners.fill()
 
-    def create_tunnel(self, ticket_id, source_ip, source_port, tunnel_dict):
+    def handle(self, obj):
+        if isinstance(obj, TunnelDeleted):
+            self._handle_deletion(obj)
+            return
+        self.update_egress_rate()
+        if isinstance(obj, Ticket):
+            self._handle_ticket(obj)
+        elif isinstance(obj, Stream):
+            self._handle_stream(obj)
+
+    def create_tunnel(self, ticket_id, source_ip, source_port, tunnel_dict,
+            fanout=False, splice=False):
         tunnel = tunnel_dict.get(ticket_id)
         if not tunnel:
-            tunnel = Tunnel(source_ip, source_port, enabled=True)
+            if self.fd_budget.exhausted():
+                raise socket.error(errno.EMFILE,
+                        "Out of file descriptors for new tunnels")
+            tunnel = Tunnel(source_ip, source_port, enabled=True,
+                    buffer_size=settings.TUNNEL_BUFFER_SIZE,
+                    high_water=settings.TUNNEL_HIGH_WATER_MARK,
+                    low_water=settings.TUNNEL_LOW_WATER_MARK,
+                    max_buffered=settings.TUNNEL_MAX_BUFFERED, fanout=fanout,
+                    splice=splice, egress=self.egress, egress_key=ticket_id,
+                    listener=self.listeners.take(), fd_budget=self.fd_budget,
+                    io_loop=self.io_loop)
             log.info("Starting %s", tunnel)
             tunnel_dict[ticket_id] = tunnel
         else:
             log.info("Found existing %s", tunnel)
-        if not self.async_loop_thread.running:
-            self.async_loop_thread.start()
         return tunnel.bind_port
 
     def destroy_tunnel(self, key, tunnel_dict):
         tunnel = tunnel_dict.pop(key)
-        log.info("Stopping %s", tunnel)
-        tunnel.handle_close()
+        log.info("Stopping %s, it hit backpressure %d times", tunnel,
+                tunnel.backpressure_count)
+        self.io_loop.add_callback(tunnel.handle_close)
 
-    def close_expired_tunnels(self):
-        for ticket_id, tunnel in self.tunnels.items():
-            if not Ticket.get_by(id=ticket_id):
+    def reconcile(self):
+        """Close the tunnels whose ticket or stream is no longer in the
+        database.
+        """
+        self.last_reconciled = time.time()
+        if self.tunnels:
+            ticket_ids = set(ticket_id for ticket_id,
+                    in session.query(Ticket.id))
+            for ticket_id in set(self.tunnels) - ticket_ids:
                 self.destroy_tunnel(ticket_id, self.tunnels)
-
-    def close_expired_stream_tunnels(self):
-        for slug, tunnel in self.stream_tunnels.items():
-            if not Stream.get_by(slug=slug):
+        if self.stream_tunnels:
+            slugs = set(slug for slug, in session.query(Stream.slug))
+            for slug in set(self.stream_tunnels) - slugs:
                 self.destroy_tunnel(slug, self.stream_tunnels)
+        session.commit()
 
-
-class TunnelLoopThread(threading.Thread):
-    def __init__(self):
-        super(TunnelLoopThread, self).__init__()
-        self.daemon = True
-        self.running = False
-
-    def run(self):
-        self.running = True
-        while self.running:
-            asyncore.loop()
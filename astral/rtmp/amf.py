@@ -4,8 +4,7 @@
 # http://opensource.adobe.com/wiki/download/attachments/1114283/amf0_spec_121207.pdf
 # http://opensource.adobe.com/wiki/download/attachments/1114283/amf3_spec_121207.pdf
 
-import struct, datetime, time, types
-from StringIO import StringIO
+import struct, datetime, time, calendar, types
 import xml.etree.ElementTree as ET
 
 class Object(object): # a typed object or received object. Typed object has _classname attr.
@@ -21,27 +20,48 @@ class _Undefined(object):
 undefined = _Undefined()  # received undefined is different from null (None)
 
 
-class BytesIO(StringIO): # raise EOFError if needed, allow read with optional length, and peek next byte
-    def __init__(self, *args, **kwargs): StringIO.__init__(self, *args, **kwargs)
-    def eof(self): return self.tell() >= self.len  # return true if next read will cause EOFError
-    def remaining(self): return self.len - self.tell() # return number of remaining bytes
+class BytesIO(object): # raise EOFError if needed, allow read with optional length, and peek next byte
+    # Reads go by offset into a str with precompiled structs. Writes are kept as a list of pieces until there is a seek or
+    # a read(), which is always the case once they are done, so that there is never any piece past a read position.
+    def __init__(self, data=''):
+        self.buf = data.tobytes() if isinstance(data, memoryview) else str(data)
+        self.pos, self.len, self.pieces = 0, len(self.buf), []
+    def _join(self):
+        if self.pieces: self.buf += ''.join(self.pieces); self.pieces = []
+    def eof(self): return self.pos >= self.len  # return true if next read will cause EOFError
+    def remaining(self): return self.len - self.pos # return number of remaining bytes
+    def tell(self): return self.pos
+    def seek(self, pos, mode=0):
+        self._join(); self.pos = max(0, pos if mode == 0 else self.pos + pos if mode == 1 else self.len + pos)
+    def getvalue(self): self._join(); return self.buf
+    def close(self): self.buf, self.pieces, self.pos, self.len = '', [], 0, 0
     
     def read(self, length=-1):
-        if length > 0 and self.eof(): raise EOFError # raise error if reading beyond EOF
-        if length > 0 and self.tell() + length > self.len: length = self.len - self.tell() # don't read more than available bytes
-        return StringIO.read(self, length)
+        pos = self.pos
+        if length > 0 and pos >= self.len: raise EOFError # raise error if reading beyond EOF
+        self._join()
+        self.pos = self.len if length is None or length < 0 else min(pos + length, self.len) # don't read more than available bytes
+        return self.buf[pos:self.pos]
+    def write(self, data):
+        if self.pos == self.len: self.pieces.append(data); self.pos = self.len = self.pos + len(data) # appending, as all writes of the codec do
+        else: self._join(); self.buf = self.buf[:self.pos] + data + self.buf[self.pos+len(data):]; self.pos += len(data); self.len = max(self.len, self.pos)
     def peek(self):
         if self.eof(): return None
-        else:
-            c = self.read(1)
-            self.seek(self.tell()-1)
-            return c
+        else: return self.buf[self.pos]
         
     for type, T, bytes in (('u8', 'B', 1), ('s8', 'b', 1), ('u16', 'H', 2), ('s16', 'h', 2), ('u32', 'L', 4), ('s32', 'l', 4), ('double', 'd', 8)):
-        exec '''def read_%s(self): return struct.unpack("!%s", self.read(%d))[0]'''%(type, T, bytes)
-        exec '''def write_%s(self, c): self.write(struct.pack("!%s", c))'''%(type, T)
+        exec '''def read_%s(self, _struct=struct.Struct("!%s")):
+            pos = self.pos
+            if pos + %d > self.len: raise EOFError
+            self.pos = pos + %d
+            return _struct.unpack_from(self.buf, pos)[0]'''%(type, T, bytes, bytes)
+        exec '''def write_%s(self, c, _pack=struct.Struct("!%s").pack): self.write(_pack(c))'''%(type, T)
         
-    def read_utf8(self, length): return unicode(self.read(length), 'utf8')
+    def read_utf8(self, length):
+        pos = self.pos
+        if length > 0 and pos >= self.len: raise EOFError
+        self.pos = min(pos + length, self.len)
+        return unicode(self.buf[pos:self.pos], 'utf8')
     def write_utf8(self, c): self.write(c.encode('utf8'))
     
     def read_u29(self):
@@ -57,13 +77,10 @@ class BytesIO(StringIO): # raise EOFError if needed, allow read with optional le
         return result
     def write_u29(self, c):
         if c < 0 or c > 0x1fffffff: raise ValueError('uint29 out of range')
-        bytes = ''
-        if c >= 0x200000: bytes += chr(0x80 | ((c >> 22) & 0x7f))
-        if c >= 0x4000: bytes += chr(0x80 | ((c >> 15) & 0x7f))
-        if c >= 0x80: bytes += chr(0x80 | ((c >> 8) & 0x7f))
-        if c >= 0x200000: bytes += chr(c & 0xff)
-        else: bytes += chr(c & 0x7f)
-        self.write(bytes)
+        if c < 0x80: self.write(chr(c))
+        elif c < 0x4000: self.write(chr(0x80 | (c >> 7)) + chr(c & 0x7f))
+        elif c < 0x200000: self.write(chr(0x80 | (c >> 14)) + chr(0x80 | ((c >> 7) & 0x7f)) + chr(c & 0x7f))
+        else: self.write(chr(0x80 | (c >> 22)) + chr(0x80 | ((c >> 15) & 0x7f)) + chr(0x80 | ((c >> 8) & 0x7f)) + chr(c & 0xff))
     def write_s29(self, c):
         if c < -0x10000000 or c > 0x0fffffff: raise ValueError('sint29 out of range')
         if c < 0: c += 0x20000000
@@ -72,9 +89,11 @@ class BytesIO(StringIO): # raise EOFError if needed, allow read with optional le
 
 class AMF0(object):
     NUMBER, BOOL, STRING, OBJECT, MOVIECLIP, NULL, UNDEFINED, REFERENCE, ECMA_ARRAY, OBJECT_END, ARRAY, DATE, LONG_STRING, UNSUPPORTED, RECORDSET, XML, TYPED_OBJECT, TYPE_AMF3 = range(0x12)
+    _u16, _marked16, _marked32, _number = struct.Struct('!H'), struct.Struct('!BH'), struct.Struct('!BL'), struct.Struct('!Bd') # a marker and what follows it in one write
 
     def __init__(self, data=None):
         self._obj_refs, self.data = list(), data if isinstance(data, BytesIO) else BytesIO(data) if data is not None else BytesIO()
+        self._obj_index = dict() # id of a written object to its index in _obj_refs
     def _created(self, obj): # new object-reference is created
         self._obj_refs.append(obj); return obj
     def read(self):
@@ -101,10 +120,10 @@ class AMF0(object):
         
     def write(self, data):
         global undefined
-        if   data is None:                         self.data.write_u8(AMF0.NULL)
-        elif data == undefined:                    self.data.write_u8(AMF0.UNDEFINED)
-        elif isinstance(data, bool):               self.data.write_u8(AMF0.BOOL); self.data.write_u8(1 if data else 0)
-        elif isinstance(data, (int, long, float)): self.data.write_u8(AMF0.NUMBER); self.data.write_double(float(data))
+        if   data is None:                         self.data.write('\x05') # NULL
+        elif data is undefined:                    self.data.write_u8(AMF0.UNDEFINED)
+        elif isinstance(data, bool):               self.data.write('\x01\x01' if data else '\x01\x00') # BOOL
+        elif isinstance(data, (int, long, float)): self.data.write(AMF0._number.pack(AMF0.NUMBER, data))
         elif isinstance(data, types.StringTypes):  self.writeString(data)
         elif isinstance(data, (types.ListType, types.TupleType)): self.writeArray(data)
         elif isinstance(data, (datetime.date, datetime.datetime)): self.writeDate(data)
@@ -117,15 +136,14 @@ class AMF0(object):
     def readString(self): return self.data.read_utf8(self.data.read_u16())
     def readLongString(self): return self.data.read_utf8(self.data.read_u32())
     def writeString(self, data, writeType=True):
-        data = unicode(data).encode('utf8') if isinstance(data, unicode) else data
-        if writeType: self.data.write_u8(AMF0.LONG_STRING if len(data) > 0xffff else AMF0.STRING)
-        if len(data) > 0xffff: self.data.write_u32(len(data))
-        else: self.data.write_u16(len(data))
-        self.data.write(data)
+        data = data.encode('utf8') if isinstance(data, unicode) else data
+        if len(data) > 0xffff: self.data.write(AMF0._marked32.pack(AMF0.LONG_STRING, len(data))[0 if writeType else 1:]); self.data.write(data)
+        elif writeType: self.data.write(AMF0._marked16.pack(AMF0.STRING, len(data)) + data)
+        else: self.data.write(AMF0._u16.pack(len(data)) + data)
         
     def readObject(self):
         obj, key = self._created(Object()), self.readString()
-        while key != '' or self.data.peek() != chr(AMF0.OBJECT_END):
+        while key != '' or self.data.peek() != '\x09': # OBJECT_END
             setattr(obj, key, self.read()); key = self.readString()
         self.data.read(1) # discard OBJECT_END
         return obj
@@ -134,19 +152,20 @@ class AMF0(object):
             self.data.write_u8(AMF0.OBJECT)
             for key, val in data.__dict__.items(): 
                 if not key.startswith('_'): self.writeString(key, False); self.write(val)
-            self.writeString('', False); self.data.write_u8(AMF0.OBJECT_END)
+            self.data.write('\x00\x00\x09') # empty key and OBJECT_END
 
     def readReference(self): 
         try: return self._obj_refs[self.data.read_u16()]
         except IndexError: raise ValueError('invalid reference index')
     def writePossibleReference(self, data):
-        if data in self._obj_refs: self.data.write_u8(AMF0.REFERENCE); self.data.write_u16(self._obj_refs.index(data)); return True
-        elif len(self._obj_refs) < 0xfffe: self._obj_refs.append(data)
+        index = self._obj_index.get(id(data)) # by identity, in constant time, and _obj_refs keeps the object alive for it
+        if index is not None: self.data.write(AMF0._marked16.pack(AMF0.REFERENCE, index)); return True
+        elif len(self._obj_refs) < 0xfffe: self._obj_index[id(data)] = len(self._obj_refs); self._obj_refs.append(data)
     
     def readEcmaArray(self):
         len_ignored = self.data.read_u32()
         obj, key = self._created(dict()), self.readString()
-        while key != '' or self.data.peek() != chr(AMF0.OBJECT_END):
+        while key != '' or self.data.peek() != '\x09': # OBJECT_END
             obj[int(key) if key.isdigit() else key] = self.read(); key = self.readString()
         self.data.read(1) # discard OBJECT_END
         return obj
@@ -154,7 +173,7 @@ class AMF0(object):
         if not self.writePossibleReference(data):
             self.data.write_u8(AMF0.ECMA_ARRAY); self.data.write_u32(len(data))
             for key, val in data.items(): self.writeString(key, writeType=False); self.write(val)
-            self.writeString('', writeType=False); self.data.write_u8(AMF0.OBJECT_END)
+            self.data.write('\x00\x00\x09') # empty key and OBJECT_END
          
     def readArray(self):
         count, obj = self.data.read_u32(), self._created([])
@@ -169,14 +188,15 @@ class AMF0(object):
         ms, tz = self.data.read_double(), self.data.read_s16()
         class TZ(datetime.tzinfo):
             def utcoffset(self, dt): return datetime.timedelta(minutes=tz)
-            def dst(self,dt): return None
+            def dst(self,dt): return datetime.timedelta(0)
             def tzname(self,dt): return None
         return datetime.datetime.fromtimestamp(ms/1000.0, TZ())
     def writeDate(self, data):
-        if isinstance(data, datetime.date): data = datetime.datetime.combine(data, datetime.time(0))
-        self.data.write_u8(AMF0.DATE); ms = time.mktime(data.timetuple)
-        tz = 0 if not data.tzinfo else (data.tzinfo.utcoffset.days*1440 + data.tzinfo.utcoffset.seconds/60)
-        self.data.write_double(ms); self.data.write_s16(tz)
+        if not isinstance(data, datetime.datetime): data = datetime.datetime.combine(data, datetime.time(0))
+        offset = data.utcoffset()
+        ms = (calendar.timegm(data.utctimetuple()) if offset is not None else time.mktime(data.timetuple())) * 1000.0 + data.microsecond / 1000
+        tz = 0 if offset is None else (offset.days*1440 + offset.seconds/60)
+        self.data.write_u8(AMF0.DATE); self.data.write_double(ms); self.data.write_s16(tz)
 
     def readXML(self): return ET.fromstring(self.readLongString())
     def writeXML(self, data):
@@ -188,10 +208,10 @@ class AMF0(object):
     def writeTypedObject(self, data):
         if not self.writePossibleReference(data):
             self.data.write_u8(AMF0.TYPED_OBJECT)
-            self.data.writeString(data._classname)
+            self.writeString(data._classname, False)
             for key, val in data.__dict__.items(): 
                 if not key.startswith('_'): self.writeString(key, False); self.write(val)
-            self.writeString('', False); self.data.write_u8(AMF0.OBJECT_END)
+            self.data.write('\x00\x00\x09') # empty key and OBJECT_END
 
     
 class AMF3(object):
@@ -200,6 +220,7 @@ class AMF3(object):
     
     def __init__(self, data=None):
         self._obj_refs, self._str_refs, self._class_refs = list(), list(), list()
+        self._obj_index, self._str_index, self._class_index = dict(), dict(), dict() # what is written, to its index in the list
         self.data = data if isinstance(data, BytesIO) else BytesIO(data) if data is not None else BytesIO()
 
     def read(self):
@@ -223,7 +244,7 @@ class AMF3(object):
     def write(self, data):
         global undefined
         if data is None:              self.data.write_u8(AMF3.NULL)
-        elif data == undefined:       self.data.write_u8(AMF3.UNDEFINED)
+        elif data is undefined:       self.data.write_u8(AMF3.UNDEFINED)
         elif isinstance(data, bool):  self.data.write_u8(AMF3.BOOL_FALSE if data is False else AMF3.BOOL_TRUE)
         elif isinstance(data, (int, long, float)): self.writeNumber(data)
         elif isinstance(data, types.StringTypes): self.writeString(data)
@@ -240,7 +261,7 @@ class AMF3(object):
         return (val >> 1, val & 0x01 == 0)
     
     def readInteger(self, signed=True):
-        self.data.read_u29() if not signed else self.data.read_s29()
+        return self.data.read_u29() if not signed else self.data.read_s29()
     def writeNumber(self, data, writeType=True, type=None):
         if type is None: type = AMF3.INTEGER if isinstance(data, (int, long)) and -0x10000000 <= data <= 0x0FFFFFFF else AMF3.NUMBER
         if writeType: self.data.write_u8(type)
@@ -264,12 +285,14 @@ class AMF3(object):
         if len(data) == 0: self.data.write_u8(0x01)
         elif not self._writePossibleReference(data, refs):
             if encode and type(data) is unicode: data = unicode(data).encode('utf8')
-            self.data.write_u29((len(data) << 1) & 0x01)
+            self.data.write_u29((len(data) << 1) | 0x01)
             self.data.write(data)
         
     def _writePossibleReference(self, data, refs):
-        if data in refs: self.data.write_u29(refs.index(data) << 1); return True
-        elif len(refs) < 0x1ffffffe: refs.append(data)
+        index = self._str_index if refs is self._str_refs else self._obj_index
+        key = data if isinstance(data, types.StringTypes) else id(data) # strings by value, anything else by identity
+        if key in index: self.data.write_u29(index[key] << 1); return True
+        elif len(refs) < 0x1ffffffe: index[key] = len(refs); refs.append(data)
     
     # Ported from http://viewvc.rubyforge.mmmultiworks.com/cgi/viewvc.cgi/trunk/lib/ruva/class.rb
     # Ruby version is Copyright (c) 2006 Ross Bamford (rosco AT roscopeco DOT co DOT uk). The string is first converted to UTF16 BE
@@ -293,7 +316,7 @@ class AMF3(object):
     def readDate(self):
         length, is_reference = self._readLengthRef()
         if is_reference: return self._obj_refs[length]
-        ms = self.data.read_double(),
+        ms = self.data.read_double()
         ts =  datetime.datetime.fromtimestamp(ms/1000.0)
         self._obj_refs.append(ts)
         return ts
@@ -301,27 +324,27 @@ class AMF3(object):
         self.data.write_u8(AMF3.DATE)
         if not self._writePossibleReference(data, self._obj_refs):
             if isinstance(data, datetime.time): raise ValueError('invalid type datetime.time found')
-            if isinstance(data, datetime.date): data = datetime.datetime.combine(data, datetime.time(0))
-            ms = time.mktime(data.timetuple)
+            if not isinstance(data, datetime.datetime): data = datetime.datetime.combine(data, datetime.time(0))
+            ms = time.mktime(data.timetuple())
             self.data.write_u29(0x01)
-            self.data.write_double(ms * 1000.0)
+            self.data.write_double(ms * 1000.0 + data.microsecond / 1000)
     
     def readArray(self):
         length, is_reference = self._readLengthRef()
         if is_reference: return self._obj_refs[length]
         key = self.readString(refs=self._str_refs)
         if key == '': # return python list since only integer index
-            result = [self.read() for i in xrange(length)]
+            result = []; self._obj_refs.append(result) # before the values, which may refer to it, as the writer does
+            result.extend(self.read() for i in xrange(length))
         else: # return python dict with key, value
-            result = {}
+            result = {}; self._obj_refs.append(result)
             while key != '': result[key] = self.read(); key = self.readString(refs=self._str_refs)
             for i in xrange(length): result[i] = self.read()
-        self._obj_refs.append(result)
         return result
     def writeList(self, data):
         self.data.write_u8(AMF3.ARRAY)
         if not self._writePossibleReference(data, refs=self._obj_refs):
-            self.data.write_u29((len(data) << 1) & 0x01)
+            self.data.write_u29((len(data) << 1) | 0x01)
             self.data.write_u8(0x01) # empty key, value
             for val in data: self.write(val)
     def writeDict(self, data, mixed=True):
@@ -337,7 +360,7 @@ class AMF3(object):
                     str_keys.extend(int_keys); int_keys[:] = []
             else:
                 int_keys, str_keys = [], data.keys()
-            self.data.write_u29((len(int_keys) << 1) & 0x01)
+            self.data.write_u29((len(int_keys) << 1) | 0x01)
             for key in str_keys: self.writeString(str(key), writeType=False); self.write(data[key])
             self.data.write_u8(0x01)
             for key in int_keys: self.write(data[key])
@@ -351,47 +374,48 @@ class AMF3(object):
         elif type & 0x01 == 0: class_ = self._class_refs[type >> 1]
         elif type & 0x03 == 0x01: # class information
             class_ = Class()
-            class_.name = self.readString()
-            class_.attrs = [self.read() for i in xrange(type >> 3)]
+            class_.name, class_.encoding = self.readString(), 0
+            class_.attrs = [self.readString() for i in xrange(type >> 3)]
             if type & 0x04 != 0: class_.encoding |= AMF3.DYNAMIC
             if not class_.name: class_.encoding |= AMF3.ANONYMOUS
             if len(class_.attrs) > 0: class_.encoding |= AMF3.TYPED
             self._class_refs.append(class_)
         obj = Object(_class=class_)
+        self._obj_refs.append(obj) # before the members, which may refer to it, as the writer does
         for attr in class_.attrs: setattr(obj, attr, self.read())
         if class_.encoding & AMF3.DYNAMIC:
             attr = self.readString()
             while attr != '': setattr(obj, attr, self.read()); attr = self.readString()
-        self._obj_refs.append(obj)
         return obj
     def writeObject(self, data):
         self.data.write_u8(AMF3.OBJECT)
         if not self._writePossibleReference(data, refs=self._obj_refs):
             if isinstance(data, Object) and hasattr(data, '_class'):
                 class_ = data._class
-                if class_ in self._class_refs:
-                    self.data.write_u29((self._class_refs.index(class_) << 2) | 0x01)
+                if id(class_) in self._class_index:
+                    self.data.write_u29((self._class_index[id(class_)] << 2) | 0x01)
                 else:
-                    is_dynamic = 0x80 if class_.encoding & AMF3.DYNAMIC else 0
+                    is_dynamic = 0x08 if class_.encoding & AMF3.DYNAMIC else 0
                     attr_len = len(class_.attrs) if hasattr(class_, 'attrs') and class_.attrs else 0
                     self.data.write_u29((attr_len << 4) | 0x03 | is_dynamic)
                     if hasattr(class_, 'name') and class_.name: self.writeString(class_.name, writeType=False)
                     else: self.data.write_u8(0x01)
                     for attr in class_.attrs: self.writeString(attr, writeType=False)
-                    self._class_refs.append(class_)
+                    self._class_index[id(class_)] = len(self._class_refs); self._class_refs.append(class_)
                 for attr in class_.attrs: self.write(getattr(data, attr))
                 if class_.encoding & AMF3.DYNAMIC:
                     for key, value in data.__dict__.items():
-                        if key not in class_.attrs:
+                        if key not in class_.attrs and not key.startswith('_'):
                             self.writeString(key, writeType=False)
-                            self.write(getattr(data, key))
+                            self.write(value)
                     self.data.write_u8(0x01)
             else: # encode as anonymous and dynamic object.
                 self.data.write_u29(0x0b) # no typed attr, dynamic, class def
                 self.data.write_u8(0x01)  # anonymous
                 for key, value in data.__dict__.items():
-                    self.writeString(key, writeType=False)
-                    self.write(getattr(data, key)) 
+                    if not key.startswith('_'):
+                        self.writeString(key, writeType=False)
+                        self.write(value) 
                 self.data.write_u8(0x01) 
     
     
@@ -0,0 +1,334 @@
+"""
+astral.rtmp.evented
+==========
+
+The RTMP server on the Tornado IOLoop instead of the multitask scheduler.
+
+EventedFlashServer is a FlashServer whose listening socket and clients are
+channels of an IOLoop, so a node can run it on the same loop as its tunnels
+and its API. Its App instances get the same callbacks as with FlashServer, and
+the messages of a client are decoded, handled and written by the code the
+multitask engine runs: only the way a client gets to run differs. The socket
+of a client is read when epoll says it has something, the messages read are
+handled right there rather than queued for the tasks of the server, and
+writing is armed when the client has messages queued.
+
+A node runs it when RTMP_ENGINE is 'ioloop' (see StreamingThread). Relays of
+streams from other nodes (astral.node.relay) and rtmpclient wait on queues of
+the multitask engine, which a Task can't do, so there are none on it.
+
+"""
+import socket
+import sys
+import types
+
+from tornado import ioloop
+
+from astral.net.buffer import DISCONNECTED, WOULD_BLOCK
+from astral.net.dispatcher import Dispatcher
+from astral.rtmp import multitask
+from astral.rtmp.rtmp import (Client, Command, FlashServer, Message, Protocol,
+        SockStream)
+
+import logging
+log = logging.getLogger(__name__)
+
+# what an EventedClient waits for, in order
+POLICY, HANDSHAKE, ACKNOWLEDGEMENT, MESSAGES = range(4)
+
+
+class Task(object):
+    """Runs a generator written for the multitask scheduler on an IOLoop.
+
+    The generator can yield other generators, which run to their end before it
+    goes on as they would under multitask, and multitask.sleep(), which
+    suspends it on a timeout of the IOLoop. Values that are not a
+    YieldCondition are sent straight back. That covers the handlers of
+    FlashServer and FLV.reader; the generator gets a TypeError if it waits on
+    anything else, a queue or a socket.
+
+    """
+    def __init__(self, generator, io_loop):
+        self.io_loop = io_loop
+        self._stack = [generator]
+
+    def step(self, value=None):
+        """Run the generator up to its next sleep or its end."""
+        stack, error = self._stack, None
+        while stack:
+            current, error = error, None
+            try:
+                if current:
+                    value = stack[-1].throw(*current)
+                else:
+                    value = stack[-1].send(value)
+            except StopIteration, e:
+                stack.pop()
+                value = e.args[0] if e.args else None
+                continue
+            except Exception:
+                stack.pop()
+                value, error = None, sys.exc_info()
+                continue
+            if isinstance(value, types.GeneratorType):
+                stack.append(value)
+                value = None
+            elif isinstance(value, multitask._SleepDelay):
+                self.io_loop.add_timeout(value.expiration, self.step)
+                return
+            elif isinstance(value, multitask.YieldCondition):
+                error = (TypeError, TypeError("Can't wait for %r on the "
+                        "IOLoop" % value), None)
+        if error:
+            log.error("Task ended with an error", exc_info=error)
+
+
+class Channel(Dispatcher):
+    """The socket of an EventedClient.
+
+    Reads go straight into the buffer of the client's SockStream, where the
+    client decodes them in place, and writes take the messages queued for the
+    client by priority as Protocol.write() does, up to READ_SIZE bytes of them
+    per send.
+
+    """
+    def __init__(self, client, sock, io_loop=None):
+        self.client = client
+        self._pushed = []
+        self._output, self._offset = '', 0
+        self._closing = False
+        super(Channel, self).__init__(sock, io_loop)
+
+    def push(self, data):
+        """Queue bytes to go out ahead of the messages of the client."""
+        self._pushed.append(data)
+        self.update()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return bool(self._offset < len(self._output) or self._pushed
+                or self.client.writeQueue or self._closing)
+
+    def handle_read(self):
+        stream = self.client.stream
+        stream._reserve(self.client.needed)
+        try:
+            received = stream._recv_into()
+        except socket.error, e:
+            if e.args[0] in WOULD_BLOCK:
+                return
+            elif e.args[0] in DISCONNECTED:
+                self.handle_close()
+                return
+            raise
+        if not received:
+            self.handle_close()
+            return
+        stream.bytesRead += received
+        stream.end += received
+        self.client.received()
+
+    def handle_write(self):
+        if self._offset >= len(self._output) and not self._closing:
+            self._fill()
+        if self._offset < len(self._output):
+            try:
+                sent = self.socket.send(buffer(self._output, self._offset,
+                    SockStream.READ_SIZE))
+            except socket.error, e:
+                if e.args[0] in WOULD_BLOCK:
+                    return
+                elif e.args[0] in DISCONNECTED:
+                    self.handle_close()
+                    return
+                raise
+            self._offset += sent
+            self.client.stream.bytesWritten += sent
+        if self._closing and self._offset >= len(self._output):
+            self.handle_close()
+
+    def _fill(self):
+        chunks, self._pushed = self._pushed, []
+        size = sum(len(chunk) for chunk in chunks)
+        queue = self.client.writeQueue
+        while queue and size < SockStream.READ_SIZE:
+            message = queue.popleft()
+            if message is None:
+                self._closing = True
+                break
+            try:
+                data = self.client.encodeMessage(message)
+            except Exception:
+                log.exception("Couldn't encode %r for %s", message, self)
+                continue
+            chunks.append(data)
+            size += len(data)
+        # a single message stays shared with the other clients it went to
+        self._output = chunks[0] if len(chunks) == 1 else ''.join(chunks)
+        self._offset = 0
+
+    def handle_close(self):
+        if self.socket is None:
+            return
+        self.close()
+        self.client.connectionClosed()
+
+
+class EventedClient(Client):
+    """A Client on a Channel of the IOLoop of its server.
+
+    Its messages are handled as soon as they are decoded, by the handlers of
+    the server, instead of going through the queues of the client and its
+    streams to the listener tasks of the multitask engine.
+
+    """
+    def __init__(self, sock, server):
+        self.channel, self.joined = None, False
+        Client.__init__(self, sock, server)
+        self.state, self.needed = POLICY, len(Protocol.POLICY_REQUEST)
+
+    def start(self):
+        self.channel = Channel(self, self.stream.sock, self.server.io_loop)
+
+    def writeMessage(self, message):
+        result = Client.writeMessage(self, message)
+        if self.channel is not None:
+            self.channel.update()
+        return result
+
+    def connectionClosed(self):
+        """Called by the channel once the connection is closed."""
+        self.writeQueue.clear()
+        self.writeQueue.append(None)
+        if self.joined:
+            self.joined = False
+            self.server.disconnecthandler(self)
+
+    def received(self):
+        """Handle what the stream has buffered, up to the last complete
+        message.
+        """
+        stream = self.stream
+        while self.state != MESSAGES:
+            if len(stream) < self.needed:
+                return
+            data = str(buffer(stream.buffer, stream.start, self.needed))
+            if self.state == POLICY:
+                if data == Protocol.POLICY_REQUEST:
+                    self.channel.push(Protocol.POLICY)
+                    self.writeMessage(None)
+                    stream.consumed(len(data))
+                    return
+                # bound version and first ping, sent back before the second
+                # one is read to work with ffmpeg
+                self.state, self.needed = HANDSHAKE, Protocol.PING_SIZE + 1
+            elif self.state == HANDSHAKE:
+                stream.consumed(len(data))
+                self.channel.push(data)
+                self.channel.push(data[1:])
+                self.state, self.needed = ACKNOWLEDGEMENT, Protocol.PING_SIZE
+            else:
+                stream.consumed(len(data))
+                self.state, self.needed = MESSAGES, 1
+        self.acknowledge()
+        for message in self.readMessages():
+            try:
+                if message.header.channel == Protocol.PROTOCOL_CHANNEL_ID:
+                    self.protocolMessage(message)
+                else:
+                    self.messageReceived(message)
+            except Exception:
+                log.exception("Couldn't handle %r from %s", message, self)
+            if self.channel.socket is None:
+                break
+
+    def messageReceived(self, msg):
+        server = self.server
+        if msg.type in (Message.RPC, Message.RPC3) and msg.streamId == 0:
+            cmd = Command.fromMessage(msg)
+            if cmd.name == 'connect':
+                self.agent = cmd.cmdData
+                self.objectEncoding = getattr(self.agent, 'objectEncoding',
+                        0.0)
+                self.joined = server.connecthandler(self, cmd.args)
+            elif not self.joined:
+                log.debug("Ignoring %s from %s before it connected",
+                        cmd.name, self)
+            elif cmd.name == 'createStream':
+                stream = self.createStream()
+                self.writeMessage(Command(name='_result', id=cmd.id,
+                    type=self.rpc, args=[stream.id]).toMessage())
+            elif cmd.name == 'closeStream':
+                stream = self.streams.pop(msg.streamId, None)
+                if stream is not None:
+                    server.closehandler(stream)
+            else:
+                server.runhandler(server.clienthandler(self, cmd))
+        else:
+            stream = self.streams.get(msg.streamId, None)
+            if stream is None:
+                log.debug("Ignoring a message on unknown stream %d from %s",
+                        msg.streamId, self)
+                return
+            if not stream.client:
+                stream.client = self
+            if msg.type in (Message.RPC, Message.RPC3):
+                server.runhandler(server.streamhandler(stream, msg))
+            else:
+                server.mediahandler(stream, msg)
+
+
+class Listener(Dispatcher):
+    """The listening socket of an EventedFlashServer."""
+    def __init__(self, server, io_loop=None):
+        super(Listener, self).__init__(io_loop=io_loop)
+        self.server = server
+
+    def handle_accept(self):
+        # players arrive in bursts, take all of the ones that are there
+        while self.socket is not None:
+            pair = self.accept()
+            if pair is None:
+                return
+            sock, addr = pair
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            log.debug("RTMP connection from %s", addr)
+            EventedClient(sock, self.server)
+
+
+class EventedFlashServer(FlashServer):
+    """A FlashServer on a Tornado IOLoop, by default the IOLoop instance.
+
+    It is set up and started like a FlashServer, then runs as long as its
+    IOLoop does; multitask.run() isn't needed for it. Files are played by
+    FLV.reader() as they are with FlashServer, but in a Task of the IOLoop.
+
+    """
+    def __init__(self, io_loop=None):
+        FlashServer.__init__(self)
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+
+    def start(self, host='0.0.0.0', port=1935):
+        if not self.server:
+            server = self.server = Listener(self, self.io_loop)
+            server.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.set_reuse_addr()
+            server.bind((host, port))
+            server.listen(socket.SOMAXCONN)
+            self.sock = server.socket
+
+    def stop(self):
+        if self.server:
+            self.server.close()
+        self.server = self.sock = None
+
+    def spawn(self, task):
+        self.io_loop.add_callback(Task(task, self.io_loop).step)
+
+    def runhandler(self, handler):
+        """Run a handler generator, e.g. streamhandler(), right away. The ones
+        of FlashServer never sleep, so it is done when this returns.
+        """
+        Task(handler, self.io_loop).step()
@@ -137,6 +137,7 @@ import collections
 import errno
 from functools import partial
 import heapq
+import math
 import os
 import select
 import sys
@@ -297,6 +298,7 @@ class FDReady(YieldCondition):
         super(FDReady, self).__init__(timeout)
 
         self.fd = (fd if _is_file_descriptor(fd) else fd.fileno())
+        self._file = fd
 
         if not (read or write or exc):
             raise ValueError("'read', 'write', and 'exc' cannot all be false")
@@ -319,6 +321,16 @@ class FDReady(YieldCondition):
         for fdset in (read_fds, write_fds, exc_fds):
             fdset.discard(self)
 
+    def _is_stale(self):
+        # True if the file was closed since, and self.fd may well be
+        # someone else's by now
+        if _is_file_descriptor(self._file):
+            return False
+        try:
+            return (self._file.fileno() != self.fd)
+        except:
+            return True
+
 
 def _is_file_descriptor(fd):
     return isinstance(fd, (int, long))
@@ -673,6 +685,18 @@ class Queue(object):
 
         return _QueueAction(self, item, timeout=timeout)
 
+    def get_nowait(self, task_manager=None):
+        """
+
+        Remove and return an item right away, without yielding.  Raises
+        IndexError if the queue is empty.  A task waiting in put() on
+        task_manager (the default TaskManager if None) is resumed, as
+        it would be by a get().
+
+        """
+
+        return (task_manager or get_default_task_manager()).get_nowait(self)
+
 
 class _QueueAction(YieldCondition):
 
@@ -804,6 +828,373 @@ class _SmartQueueAction(YieldCondition):
         self.expires = (timeout is not None) and (time.time() + timeout) or 0
 
 
+################################################################################
+#
+# Event and _EventWait classes
+#
+################################################################################
+
+
+
+class Event(object):
+
+    """
+
+    A wakeup for tasks that wait on something other than I/O, a queue
+    or the clock.  Unlike the queues, set() is a plain method, so code
+    that is not a task, or a task that must not be suspended, can
+    wake the waiting tasks; it must run in the thread of their task
+    manager, though.  The event clears itself when it wakes a task,
+    so a set() with no task waiting is remembered for the next wait()
+    only.
+
+    """
+
+    def __init__(self):
+        self._set = False
+        self._waits = collections.deque()
+
+    def is_set(self):
+        'Return True if a set() is pending, False otherwise'
+        return self._set
+
+    def set(self):
+        """
+
+        Resume all tasks waiting on the event, or if there are none,
+        let the next wait() return straight away
+
+        """
+
+        if not self._waits:
+            self._set = True
+        while self._waits:
+            manager, action = self._waits.popleft()
+            manager._enqueue(action.task)
+            if action._expires():
+                manager._remove_timeout(action)
+
+    def clear(self):
+        'Forget a pending set()'
+        self._set = False
+
+    def wait(self, timeout=None):
+        """
+
+        A task that yields the result of this method will be resumed
+        when the event is set.  If timeout is not None, a Timeout
+        exception will be raised in the yielding task if the event has
+        not been set after timeout seconds have elapsed.  For example:
+
+          while not work:
+              yield event.wait()
+
+        """
+
+        return _EventWait(self, timeout=timeout)
+
+
+class _EventWait(YieldCondition):
+
+    def __init__(self, event, timeout=None):
+        super(_EventWait, self).__init__(timeout)
+        if not isinstance(event, Event):
+            raise TypeError("'event' must be an Event instance")
+        self.event = event
+
+
+################################################################################
+#
+# I/O backends
+#
+################################################################################
+
+
+
+class SelectPoller(object):
+
+    """
+
+    Waits for I/O with select.select().  Works everywhere, but costs
+    time in proportion to the number of waiting tasks on every call,
+    and can't take file descriptors above FD_SETSIZE (usually 1024).
+
+    """
+
+    def __init__(self):
+        self._read_waits  = set()
+        self._write_waits = set()
+        self._exc_waits   = set()
+
+    def __len__(self):
+        'Return the number of FDReady instances waiting for I/O'
+        return len(self._waiting())
+
+    def __nonzero__(self):
+        return bool(self._read_waits or self._write_waits or self._exc_waits)
+
+    def _waiting(self):
+        return (self._read_waits | self._write_waits | self._exc_waits)
+
+    def register(self, fdready):
+        fdready._add_to_fdsets(self._read_waits,
+                               self._write_waits,
+                               self._exc_waits)
+
+    def unregister(self, fdready):
+        fdready._remove_from_fdsets(self._read_waits,
+                                    self._write_waits,
+                                    self._exc_waits)
+
+    def poll(self, timeout):
+        """
+
+        Wait up to timeout seconds (forever if timeout is None) for
+        I/O, and return a list of the FDReady instances that are
+        ready and a list of those with a bad file descriptor.  Both
+        are unregistered.
+
+        """
+
+        # The error handling here is (mostly) borrowed from Twisted
+        try:
+            read_ready, write_ready, exc_ready = \
+                select.select(self._read_waits,
+                              self._write_waits,
+                              self._exc_waits,
+                              timeout)
+        except (TypeError, ValueError):
+            return [], self._remove_bad_file_descriptors()
+        except (select.error, IOError), err:
+            if err[0] == errno.EINTR:
+                return [], []
+            elif ((err[0] == errno.EBADF) or
+                  ((sys.platform == 'win32') and
+                   (err[0] == 10038))):  # WSAENOTSOCK
+                return [], self._remove_bad_file_descriptors()
+            else:
+                # Not an error we can handle, so die
+                raise
+        ready = list(set(read_ready + write_ready + exc_ready))
+        for fd in ready:
+            self.unregister(fd)
+        return ready, []
+
+    def _remove_bad_file_descriptors(self):
+        bad = []
+        for fd in self._waiting():
+            try:
+                select.select([fd], [fd], [fd], 0.0)
+            except:
+                bad.append(fd)
+                self.unregister(fd)
+        return bad
+
+
+class _MaskPoller(object):
+
+    """
+
+    Base class for the backends that keep a set of file descriptors
+    with the events of interest registered with the kernel, which
+    makes a wait cost time in proportion to the number of ready file
+    descriptors only.  A file descriptor is registered when a task
+    first waits on it and left registered while the task handles the
+    I/O, because by the next poll() the task is usually waiting on it
+    again.  Only file descriptors whose waiting tasks have changed
+    since the last poll() are brought up to date, right before the
+    next one.
+
+    A socket closed under a waiting task may give no event at all, so
+    every SWEEP_INTERVAL seconds all the waits are checked for files
+    that have been closed, which are dropped like the bad file
+    descriptors select() complains about.
+
+    Subclasses set the event masks and implement _update() and
+    _poll().
+
+    """
+
+    READ = WRITE = EXC = INVALID = 0
+    SWEEP_INTERVAL = 1.0
+
+    def __init__(self):
+        self._waits = {}       # fd -> set of FDReady instances
+        self._masks = {}       # fd -> events registered with the kernel
+        self._changed = set()  # fds whose waits may not match their mask
+        self._swept = time.time()
+
+    def __len__(self):
+        'Return the number of FDReady instances waiting for I/O'
+        return sum(len(waits) for waits in self._waits.itervalues())
+
+    def __nonzero__(self):
+        return bool(self._waits)
+
+    def _waiting(self):
+        return set().union(*self._waits.itervalues())
+
+    def register(self, fdready):
+        self._waits.setdefault(fdready.fd, set()).add(fdready)
+        self._changed.add(fdready.fd)
+
+    def unregister(self, fdready):
+        waits = self._waits.get(fdready.fd)
+        if waits is not None:
+            waits.discard(fdready)
+            if not waits:
+                del self._waits[fdready.fd]
+            self._changed.add(fdready.fd)
+
+    def _mask(self, fdready):
+        return ((self.READ if fdready.read else 0) |
+                (self.WRITE if fdready.write else 0) |
+                (self.EXC if fdready.exc else 0))
+
+    def _sync(self):
+        bad = []
+        for fd in list(self._changed):
+            mask = 0
+            for fdready in list(self._waits.get(fd, ())):
+                if fdready._is_stale():
+                    bad.append(fdready)
+                    self.unregister(fdready)
+                else:
+                    mask |= self._mask(fdready)
+            old_mask = self._masks.pop(fd, 0)
+            if mask == old_mask:
+                if mask:
+                    self._masks[fd] = mask
+                continue
+            try:
+                self._update(fd, old_mask, mask)
+            except (EnvironmentError, select.error):
+                for fdready in list(self._waits.get(fd, ())):
+                    bad.append(fdready)
+                    self.unregister(fdready)
+            else:
+                if mask:
+                    self._masks[fd] = mask
+        self._changed.clear()
+        return bad
+
+    def poll(self, timeout):
+        """
+
+        Wait up to timeout seconds (forever if timeout is None) for
+        I/O, and return a list of the FDReady instances that are
+        ready and a list of those with a bad file descriptor.  Both
+        are unregistered.
+
+        """
+
+        now = time.time()
+        if now - self._swept >= self.SWEEP_INTERVAL:
+            self._changed.update(self._waits)
+            self._swept = now
+        bad = self._sync()
+        if bad:
+            # let the caller deal with them first
+            timeout = 0.0
+        elif self._waits and (timeout is None or
+                              timeout > self.SWEEP_INTERVAL):
+            timeout = self.SWEEP_INTERVAL
+        try:
+            events = self._poll(timeout)
+        except (EnvironmentError, select.error), err:
+            if err.args[0] == errno.EINTR:
+                return [], bad
+            raise
+        ready = []
+        for fd, event in events:
+            waits = self._waits.get(fd)
+            if not waits:
+                continue
+            if event & self.INVALID:
+                bad.extend(waits)
+                del self._waits[fd]
+                self._changed.add(fd)
+                continue
+            for fdready in list(waits):
+                if event & self._mask(fdready) or event & ~(self.READ |
+                                                            self.WRITE |
+                                                            self.EXC):
+                    # error and hangup wake everyone, as select() does
+                    ready.append(fdready)
+                    self.unregister(fdready)
+        return ready, bad
+
+
+class PollPoller(_MaskPoller):
+
+    'Waits for I/O with select.poll()'
+
+    if hasattr(select, 'poll'):
+        READ, WRITE, EXC, INVALID = (select.POLLIN, select.POLLOUT,
+                                     select.POLLPRI, select.POLLNVAL)
+
+    def __init__(self):
+        super(PollPoller, self).__init__()
+        self._poller = select.poll()
+
+    def _update(self, fd, old_mask, mask):
+        if mask:
+            self._poller.register(fd, mask)
+        else:
+            self._poller.unregister(fd)
+
+    def _poll(self, timeout):
+        return self._poller.poll(None if timeout is None
+                                 else int(math.ceil(timeout * 1000)))
+
+
+class EpollPoller(_MaskPoller):
+
+    'Waits for I/O with select.epoll() (Linux only)'
+
+    if hasattr(select, 'epoll'):
+        READ, WRITE, EXC = select.EPOLLIN, select.EPOLLOUT, select.EPOLLPRI
+
+    def __init__(self):
+        super(EpollPoller, self).__init__()
+        self._poller = select.epoll()
+
+    def _update(self, fd, old_mask, mask):
+        # the kernel forgets a file descriptor once it is closed, so
+        # its number may be registered or not whatever we last did
+        if not mask:
+            try:
+                self._poller.unregister(fd)
+            except EnvironmentError:
+                pass
+        elif old_mask:
+            try:
+                self._poller.modify(fd, mask)
+            except EnvironmentError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+                self._poller.register(fd, mask)
+        else:
+            try:
+                self._poller.register(fd, mask)
+            except EnvironmentError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+                self._poller.modify(fd, mask)
+
+    def _poll(self, timeout):
+        return self._poller.poll(-1 if timeout is None else timeout)
+
+
+def default_poller():
+    'Return an instance of the best I/O backend for this platform'
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    if hasattr(select, 'poll') and sys.platform != 'darwin':
+        return PollPoller()
+    return SelectPoller()
+
+
 ################################################################################
 #
 # TaskManager class
@@ -821,7 +1212,7 @@ class TaskManager(object):
 
     """
 
-    def __init__(self):
+    def __init__(self, poller=None):
         """
 
         Create a new TaskManager instance.  Generally, there will only
@@ -829,12 +1220,15 @@ class TaskManager(object):
         existing instances simultaneously, merge them first, then run
         one or the other.
 
+        poller is the I/O backend to wait with, an instance of
+        SelectPoller, PollPoller or EpollPoller.  It defaults to the
+        best one available (see default_poller()).
+
         """
 
         self._queue       = collections.deque()
-        self._read_waits  = set()
-        self._write_waits = set()
-        self._exc_waits   = set()
+        self._poller      = (poller if poller is not None
+                             else default_poller())
         self._queue_waits = collections.defaultdict(self._double_deque)
         self._timeouts    = []
 
@@ -856,9 +1250,8 @@ class TaskManager(object):
 
         # Merge the data structures
         self._queue.extend(other._queue)
-        self._read_waits  |= other._read_waits
-        self._write_waits |= other._write_waits
-        self._exc_waits   |= other._exc_waits
+        for fd in other._poller._waiting():
+            self._poller.register(fd)
         self._queue_waits.update(other._queue_waits)
         self._timeouts.extend(other._timeouts)
         heapq.heapify(self._timeouts)
@@ -867,9 +1260,7 @@ class TaskManager(object):
         # necessary because other's tasks may reference and use other
         # (e.g. to add a new task in response to an event).
         other._queue       = self._queue
-        other._read_waits  = self._read_waits
-        other._write_waits = self._write_waits
-        other._exc_waits   = self._exc_waits
+        other._poller      = self._poller
         other._queue_waits = self._queue_waits
         other._timeouts    = self._timeouts
 
@@ -880,6 +1271,26 @@ class TaskManager(object):
             raise TypeError("'task' must be a generator")
         self._enqueue(task)
 
+    def get_nowait(self, queue):
+        """
+
+        Remove and return the first item of queue without waiting, as
+        a task yielding queue.get() would get it, and resume the first
+        task waiting to put an item on it, if any.  Raises IndexError
+        if queue is empty.
+
+        """
+
+        item = queue._get()
+        waits = self._queue_waits.get(queue)
+        if waits and waits[1]:
+            action = waits[1].popleft()
+            queue._put(action.item)
+            self._enqueue(action.task)
+            if action._expires():
+                self._remove_timeout(action)
+        return item
+
     def _enqueue(self, task, input=None, exc_info=()):
         self._queue.append((task, input, exc_info))
 
@@ -912,7 +1323,7 @@ class TaskManager(object):
         otherwise
 
         """
-        return bool(self._read_waits or self._write_waits or self._exc_waits)
+        return bool(self._poller)
 
     def has_timeouts(self):
         """
@@ -992,51 +1403,21 @@ class TaskManager(object):
         return timeout
 
     def _handle_io_waits(self, timeout):
-        # The error handling here is (mostly) borrowed from Twisted
-        try:
-            read_ready, write_ready, exc_ready = \
-                select.select(self._read_waits,
-                              self._write_waits,
-                              self._exc_waits,
-                              timeout)
-        except (TypeError, ValueError):
-            self._remove_bad_file_descriptors()
-        except (select.error, IOError), err:
-            if err[0] == errno.EINTR:
-                pass
-            elif ((err[0] == errno.EBADF) or
-                  ((sys.platform == 'win32') and
-                   (err[0] == 10038))):  # WSAENOTSOCK
-                self._remove_bad_file_descriptors()
-            else:
-                # Not an error we can handle, so die
-                raise
-        else:
-            for fd in set(read_ready + write_ready + exc_ready):
-                try:
-                    input = (fd._eval() if isinstance(fd, FDAction) else None)
-                    self._enqueue(fd.task, input=input)
-                except:
-                    self._enqueue(fd.task, exc_info=sys.exc_info())
-                fd._remove_from_fdsets(self._read_waits,
-                                       self._write_waits,
-                                       self._exc_waits)
-                if fd._expires():
-                    self._remove_timeout(fd)
-
-    def _remove_bad_file_descriptors(self):
-        for fd in (self._read_waits | self._write_waits | self._exc_waits):
+        ready, bad = self._poller.poll(timeout)
+        for fd in bad:
+            # TODO: do not enqueue the exception (socket.error) so that it does not crash
+            # when closing an already closed socket. See rtmplite issue #28
+            # self._enqueue(fd.task, exc_info=...)
+            if fd._expires():
+                self._remove_timeout(fd)
+        for fd in ready:
             try:
-                select.select([fd], [fd], [fd], 0.0)
+                input = (fd._eval() if isinstance(fd, FDAction) else None)
+                self._enqueue(fd.task, input=input)
             except:
-                # TODO: do not enqueue the exception (socket.error) so that it does not crash
-                # when closing an already closed socket. See rtmplite issue #28
-                # self._enqueue(fd.task, exc_info=sys.exc_info())
-                fd._remove_from_fdsets(self._read_waits,
-                                       self._write_waits,
-                                       self._exc_waits)
-                if fd._expires():
-                    self._remove_timeout(fd)
+                self._enqueue(fd.task, exc_info=sys.exc_info())
+            if fd._expires():
+                self._remove_timeout(fd)
 
     def _add_timeout(self, item, handler):
         item.handle_expiration = handler
@@ -1073,21 +1454,30 @@ class TaskManager(object):
                 self._handle_queue_action(task, output)
             elif isinstance(output, _SmartQueueAction):
                 self._handle_smart_queue_action(task, output)
+            elif isinstance(output, _EventWait):
+                self._handle_event_wait(task, output)
         else:
             # Return any other output as input and send task to
             # end of queue
             self._enqueue(task, input=output)
 
     def _handle_fdready(self, task, output):
-        output._add_to_fdsets(self._read_waits,
-                              self._write_waits,
-                              self._exc_waits)
+        self._poller.register(output)
         if output._expires():
             self._add_timeout(output,
-                              (lambda:
-                               output._remove_from_fdsets(self._read_waits,
-                                                          self._write_waits,
-                                                          self._exc_waits)))
+                              (lambda: self._poller.unregister(output)))
+
+    def _handle_event_wait(self, task, output):
+        event = output.event
+        if event._set:
+            event._set = False
+            self._enqueue(task)
+        else:
+            entry = (self, output)
+            event._waits.append(entry)
+            if output._expires():
+                self._add_timeout(output,
+                                  (lambda: event._waits.remove(entry)))
 
     def _handle_queue_action(self, task, output):
         get_waits, put_waits = self._queue_waits[output.queue]
@@ -60,7 +60,7 @@ throw an exception and display the error message.
 
 '''
 
-import os, sys, time, struct, socket, traceback, multitask, amf, threading, Queue
+import os, sys, time, struct, socket, traceback, collections, threading, Queue, mmap, bisect, multitask, amf
 
 _debug = False
 
@@ -71,46 +71,94 @@ def truncate(data, max=100):
     return data and len(data)>max and data[:max] + '...(%d)'%(len(data),) or data
     
 class SockStream(object):
-    '''A class that represents a socket as a stream'''
+    '''A class that represents a socket as a stream. The socket is read with recv_into straight into a bytearray, and
+    read() hands out the bytes between a read offset and the end of the received data, so a small read costs the same no
+    matter how much is buffered. The unread bytes are only moved to the front when the free space at the end runs low.'''
+    READ_SIZE = 64 * 1024 # bytes asked from the socket at a time
+    
     def __init__(self, sock):
-        self.sock, self.buffer = sock, ''
+        self.sock, self.buffer = sock, bytearray(SockStream.READ_SIZE)
+        self.start = self.end = 0 # unread data is self.buffer[self.start:self.end]
         self.bytesWritten = self.bytesRead = 0
     
     def close(self):
         self.sock.close()
+    
+    def __len__(self):
+        return self.end - self.start
+    
+    def _reserve(self, count):
+        '''Make room to receive the rest of a read of count bytes, compacting or growing the buffer as needed.'''
+        needed = max(count - (self.end - self.start), SockStream.READ_SIZE / 4)
+        if len(self.buffer) - self.end >= needed: return
+        if self.start: # move the unread data to the front
+            length = self.end - self.start
+            self.buffer[:length] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, length
+        if len(self.buffer) - self.end < needed: # still too small, e.g. for a large message
+            self.buffer.extend(bytearray(needed - (len(self.buffer) - self.end)))
         
-    def read(self, count):
+    def _recv_into(self):
+        # the view must not outlive the call, a bytearray can't be resized while it is exported
+        return self.sock.recv_into(memoryview(self.buffer)[self.end:])
+        
+    def fill(self, count):
+        '''Receive from the socket until at least count bytes are buffered (generator).'''
         try:
-            while True:
-                if len(self.buffer) >= count: # do not have data in buffer
-                    data, self.buffer = self.buffer[:count], self.buffer[count:]
-                    raise StopIteration(data)
-                if _debug: print 'socket.read[%d] calling recv()'%(count,)
-                data = (yield multitask.recv(self.sock, 4096)) # read more from socket
-                if not data: raise ConnectionClosed
-                if _debug: print 'socket.read[%d] %r'%(len(data), truncate(data))
-                self.bytesRead += len(data)
-                self.buffer += data
-        except StopIteration: raise
+            while self.end - self.start < count:
+                self._reserve(count)
+                if _debug: print 'socket.fill[%d] calling recv_into()'%(count,)
+                received = (yield multitask.FDAction(self.sock, self._recv_into, read=True)) # read more from socket
+                if not received: raise ConnectionClosed
+                if _debug: print 'socket.fill[%d] %r'%(received, truncate(str(self.buffer[self.end:self.end + received])))
+                self.bytesRead += received
+                self.end += received
+        except ConnectionClosed: raise
         except: raise ConnectionClosed # anything else is treated as connection closed.
         
+    def consumed(self, count):
+        '''Drop count bytes from the front of the buffered data, which the caller has already decoded in place.'''
+        self.start += count
+        if self.start == self.end: self.start = self.end = 0 # empty, start over at the front
+        
+    def read(self, count):
+        yield self.fill(count)
+        data = str(buffer(self.buffer, self.start, count))
+        self.consumed(count)
+        raise StopIteration(data)
+        
     def unread(self, data):
-        self.buffer = data + self.buffer
+        if self.start >= len(data): # fits in front of the unread data
+            self.start -= len(data)
+            self.buffer[self.start:self.start + len(data)] = data
+        else:
+            self.buffer[self.start:self.start] = data
+            self.end += len(data)
             
     def write(self, data):
-        while len(data) > 0: # write in 4K chunks each time
-            chunk, data = data[:4096], data[4096:]
-            self.bytesWritten += len(chunk)
-            if _debug: print 'socket.write[%d] %r'%(len(chunk), truncate(chunk))
-            try: yield multitask.send(self.sock, chunk)
+        '''Write all of data, in up to READ_SIZE pieces that are views into it rather than copies (generator). data may
+        be shared with other streams, it is never modified.'''
+        offset = 0
+        while offset < len(data):
+            chunk = buffer(data, offset, SockStream.READ_SIZE)
+            if _debug: print 'socket.write[%d] %r'%(len(chunk), truncate(str(chunk)))
+            try: sent = (yield multitask.send(self.sock, chunk))
             except: raise ConnectionClosed
+            self.bytesWritten += sent
+            offset += sent
                                 
 
+# precompiled formats for decoding chunk headers in place: 3-byte time, 3-byte size and type of a full or message header,
+# 3-byte time of a time header, and the little-endian stream id and extended time stamp
+_TIME_SIZE_TYPE, _TIME, _STREAM_ID, _EXTENDED_TIME = struct.Struct('>BHBHB'), struct.Struct('>BH'), struct.Struct('<I'), struct.Struct('>I')
+
 class Header(object):
     FULL, MESSAGE, TIME, SEPARATOR, MASK = 0x00, 0x40, 0x80, 0xC0, 0xC0
+    __slots__ = ('channel', 'time', 'size', 'type', 'streamId', 'hdrdata', 'extendedTime', 'currentTime', 'hdrtype', 'delta')
     
     def __init__(self, channel=0, time=0, size=None, type=None, streamId=0):
         self.channel, self.time, self.size, self.type, self.streamId = channel, time, size, type, streamId
+        self.extendedTime, self.currentTime, self.hdrtype, self.delta = None, 0, Header.FULL, 0
         if channel<64: self.hdrdata = chr(channel)
         elif channel<(64+256): self.hdrdata = '\x00'+chr(channel-64)
         else: self.hdrdata = '\x01'+chr((channel-64)%256)+chr((channel-64)/256) 
@@ -141,9 +189,12 @@ class Message(object):
     CHUNK_SIZE,   ABORT,   ACK,   USER_CONTROL, WIN_ACK_SIZE, SET_PEER_BW, AUDIO, VIDEO, DATA3, SHAREDOBJ3, RPC3, DATA, SHAREDOBJ, RPC = \
     0x01,         0x02,    0x03,  0x04,         0x05,         0x06,        0x08,  0x09,  0x0F,  0x10,       0x11, 0x12, 0x13,      0x14
     type_name = dict(enumerate('unknown chunk-size abort ack user-control win-ack-size set-peer-bw unknown audio video unknown unknown unknown unknown unknown data3 sharedobj3 rpc3 data sharedobj rpc'.split()))
+    __slots__ = ('header', 'data', 'encodings', 'lane')
     
     def __init__(self, hdr=None, data=''):
         self.header, self.data = hdr or Header(), data
+        self.encodings = None # chunked forms of data, shared with the duplicates of this message
+        self.lane = None # WriteQueue lane to go out in, None for the one of its type
     
     # define properties type, streamId and time to access self.header.(property)
     for p in ['type', 'streamId', 'time']:
@@ -157,19 +208,103 @@ class Message(object):
         return ("<Message header=%r data=%r>"% (self.header, truncate(self.data)))
     
     def dup(self):
-        return Message(self.header.dup(), self.data[:])
+        '''Return a copy with its own header. The payload is immutable and is shared, as are its chunked forms, so
+        that sending the same message to many clients only chunks it once per distinct set of chunk headers.'''
+        if self.encodings is None: self.encodings = dict()
+        msg = Message(self.header.dup(), self.data)
+        msg.encodings = self.encodings
+        return msg
                 
+def videoFrame(message):
+    '''The frame type of a video message: 1 for a key frame, 2 for an inter frame, 3 for a disposable inter frame. 0 for
+    anything else, which includes the AVC sequence headers and any message that is not video.'''
+    data = message.data
+    if message.type != Message.VIDEO or not data: return 0
+    frame = ord(data[0]) >> 4
+    if frame > 3 or ord(data[0]) & 0x0F == 7 and data[1:2] == '\x00': return 0
+    return frame
+
+class WriteQueue(object):
+    '''The messages waiting for Protocol.write(), in lanes by priority: protocol control messages and commands, then
+    the catch-up of a joining player, then audio, then video, then data. popleft() takes from a lane only when the lanes
+    before it are empty, and each lane keeps the order its messages came in. Commands, audio, video and data each have
+    chunk streams of their own (see Protocol.chunkStream), so the messages of a chunk stream never pass each other, but
+    e.g. an onStatus command can pass an onMetaData queued before it. A message whose lane is set goes in that lane
+    whatever its type: the catch-up is set to CATCHUP, so that it arrives in the order it was sent, metadata and
+    sequence headers before the frames they apply to, behind the control messages but ahead of the live media queued
+    after it. A None appended closes the queue: it is what popleft() gives once all the lanes are empty, and nothing is
+    queued after it.'''
+    CONTROL, CATCHUP, AUDIO, VIDEO, DATA = range(5) # the lanes
+    
+    def __init__(self):
+        self.lanes = tuple(collections.deque() for i in range(5))
+        self.bytes, self.closing = 0, False # payload bytes queued, and whether a None was appended
+        
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes) + (1 if self.closing else 0)
+    
+    def __iter__(self):
+        '''The queued messages in the order popleft() gives them.'''
+        for lane in self.lanes:
+            for message in lane: yield message
+        if self.closing: yield None
+    
+    def lane(self, message):
+        if message.lane is not None: return message.lane
+        if message.type < Message.AUDIO or message.type == Message.RPC or message.type == Message.RPC3: return WriteQueue.CONTROL
+        if message.type == Message.AUDIO: return WriteQueue.AUDIO
+        if message.type == Message.VIDEO: return WriteQueue.VIDEO
+        return WriteQueue.DATA
+    
+    def append(self, message):
+        if self.closing: return
+        if message is None: self.closing = True
+        else:
+            self.lanes[self.lane(message)].append(message)
+            self.bytes += len(message.data)
+    
+    def popleft(self):
+        for lane in self.lanes:
+            if lane:
+                message = lane.popleft()
+                self.bytes -= len(message.data)
+                return message
+        if self.closing: return None
+        raise IndexError('pop from an empty WriteQueue')
+    
+    def clear(self):
+        for lane in self.lanes: lane.clear()
+        self.bytes, self.closing = 0, False
+    
+    def oldestMediaTime(self):
+        '''The timestamp of the oldest audio or video message queued, or None if there are none.'''
+        times = [lane[0].time for lane in self.lanes[WriteQueue.AUDIO:WriteQueue.DATA] if lane]
+        for message in self.lanes[WriteQueue.CATCHUP]: # after the metadata and sequence headers of its start
+            if message.type == Message.AUDIO or message.type == Message.VIDEO: times.append(message.time); break
+        return min(times) if times else None
+    
 class Protocol(object):
     PING_SIZE, DEFAULT_CHUNK_SIZE, PROTOCOL_CHANNEL_ID = 1536, 128, 2 # constants
+    MAX_CHUNK_SIZE = 0xFFFFFF # largest chunk size a message length can use
     READ_WIN_SIZE, WRITE_WIN_SIZE = 1000000L, 1073741824L
     
+    HEADER_SIZE = {Header.FULL: 11, Header.MESSAGE: 7, Header.TIME: 3, Header.SEPARATOR: 0} # message header bytes by type
+    POLICY_REQUEST = '<policy-file-request/>\x00' # what a Flash player asks for the cross domain policy with, and the answer
+    POLICY = '''<!DOCTYPE cross-domain-policy SYSTEM "http://www.macromedia.com/xml/dtds/cross-domain-policy.dtd">
+                    <cross-domain-policy>
+                      <allow-access-from domain="*" to-ports="1935" secure='false'/>
+                    </cross-domain-policy>'''
+    
     def __init__(self, sock):
         self.stream = SockStream(sock)
         self.lastReadHeaders, self.incompletePackets, self.lastWriteHeaders = dict(), dict(), dict()
+        self.needed = 1 # bytes the next chunk takes, at least
         self.readChunkSize = self.writeChunkSize = Protocol.DEFAULT_CHUNK_SIZE
         self.readWinSize0, self.readWinSize, self.writeWinSize0, self.writeWinSize = 0L, self.READ_WIN_SIZE, 0L, self.WRITE_WIN_SIZE
         self.nextChannelId = Protocol.PROTOCOL_CHANNEL_ID + 1
-        self.writeLock, self.writeQueue = threading.Lock(), Queue.Queue()
+        self.writeQueue, self.writeReady = WriteQueue(), multitask.Event() # messages for write(), and its wakeup
+        self.maxQueueBytes = self.maxQueueTime = 0 # limits of writeQueue in bytes and milliseconds of media, see dropMedia(). 0 for none
+        self.waitKeyFrame, self.dropped = set(), {} # streamIds whose video is dropped up to the next key frame, and messages dropped by streamId
             
     def messageReceived(self, msg): # override in subclass
         yield
@@ -201,19 +336,58 @@ class Protocol(object):
             yield self.connectionClosed()
                     
     def writeMessage(self, message):
-        self.writeQueue.put(message)
+        '''Queue message for write(), or None to close the stream once the messages before it are out. Does not block.
+        Returns False if the message was dropped instead, see dropMedia().'''
+        if self.writeQueue.closing: return False # nothing more goes out
+        if message is not None and (message.type == Message.AUDIO or message.type == Message.VIDEO):
+            if (self.maxQueueBytes or self.maxQueueTime) and self.dropMedia(message): return False
+        self.writeQueue.append(message)
+        self.writeReady.set()
+        return True
+    
+    def dropMedia(self, message):
+        '''Whether to drop an audio or video message rather than queue it, when the peer does not keep up. Once writeQueue
+        holds more than maxQueueBytes, or spans more than maxQueueTime milliseconds of media, the video frames of the
+        message's stream are dropped up to the next key frame that finds the queue back within both limits, and so are
+        the inter frames of the stream already queued. Audio, and the video sequence headers, still go through. Past twice
+        either limit the queue is discarded and the connection closed. Drops are counted by streamId in self.dropped.'''
+        lag = 0.0
+        if self.maxQueueBytes: lag = self.writeQueue.bytes / float(self.maxQueueBytes)
+        if self.maxQueueTime:
+            oldest = self.writeQueue.oldestMediaTime()
+            if oldest is not None: lag = max(lag, (message.time - oldest) / float(self.maxQueueTime))
+        if lag > 2:
+            if _debug: print 'Protocol.dropMedia closing lagging connection'
+            self.writeQueue.clear(); self.writeQueue.append(None); self.writeReady.set()
+            return True
+        frame, streamId = videoFrame(message), message.streamId
+        if not frame: return False
+        if streamId in self.waitKeyFrame:
+            if frame == 1 and lag <= 1: self.waitKeyFrame.discard(streamId); return False
+        elif lag > 1:
+            self.waitKeyFrame.add(streamId)
+            self.dropQueuedFrames(streamId)
+        else: return False
+        self.dropped[streamId] = self.dropped.get(streamId, 0) + 1
+        return True
+    
+    def dropQueuedFrames(self, streamId):
+        '''Removes the inter frames of the given stream from writeQueue, catch-up included. Its key frames stay, so the
+        picture still moves on now and then while the rest of the queue goes out.'''
+        for lane in (self.writeQueue.lanes[WriteQueue.CATCHUP], self.writeQueue.lanes[WriteQueue.VIDEO]):
+            for i in xrange(len(lane)):
+                message = lane.popleft()
+                if message.streamId == streamId and videoFrame(message) > 1:
+                    self.writeQueue.bytes -= len(message.data)
+                    self.dropped[streamId] = self.dropped.get(streamId, 0) + 1
+                else: lane.append(message)
             
     def parseCrossDomainPolicyRequest(self):
         # read the request
-        REQUEST = '<policy-file-request/>\x00'
-        data = (yield self.stream.read(len(REQUEST)))
-        if data == REQUEST:
+        data = (yield self.stream.read(len(Protocol.POLICY_REQUEST)))
+        if data == Protocol.POLICY_REQUEST:
             if _debug: print data
-            data = '''<!DOCTYPE cross-domain-policy SYSTEM "http://www.macromedia.com/xml/dtds/cross-domain-policy.dtd">
-                    <cross-domain-policy>
-                      <allow-access-from domain="*" to-ports="1935" secure='false'/>
-                    </cross-domain-policy>'''
-            yield self.stream.write(data)
+            yield self.stream.write(Protocol.POLICY)
             raise ConnectionClosed
         else:
             yield self.stream.unread(data)
@@ -230,141 +404,201 @@ class Protocol(object):
         # yield self.stream.write(data)
     
     def parseMessages(self):
-        '''Parses complete messages until connection closed. Raises ConnectionLost exception.'''
-        CHANNEL_MASK = 0x3F
+        '''Parses complete messages until connection closed. Raises ConnectionLost exception. The chunks are decoded
+        in place by readMessages(), and the scheduler only gets involved when more data has to be received (or a message
+        handler yields).'''
+        while True:
+            yield self.stream.fill(self.needed)
+            self.acknowledge()
+            for msg in self.readMessages():
+                if _debug: print 'Protocol.parseMessage msg=', msg
+                try:
+                    if msg.header.channel == Protocol.PROTOCOL_CHANNEL_ID:
+                        self.protocolMessage(msg)
+                    else: 
+                        yield self.messageReceived(msg)
+                except:
+                    if _debug: print 'Protocol.parseMessages exception', (traceback and traceback.print_exc() or None)
+    
+    def acknowledge(self):
+        '''Queues an acknowledgement for the peer once it has sent a window's worth of bytes since the last one.'''
+        if self.readWinSize is not None:
+            if self.stream.bytesRead > (self.readWinSize0 + self.readWinSize):
+                self.readWinSize0 = self.stream.bytesRead
+                ack = Message()
+                ack.type, ack.data = Message.ACK, struct.pack('>L', self.readWinSize0)
+                self.writeMessage(ack)
+    
+    def readMessages(self):
+        '''Decodes the chunks that are all there in the stream buffer, without copying anything but the payload, and
+        generates the messages they complete. A chunk is only taken from the buffer (and the channel state updated)
+        once all of it has arrived, otherwise self.needed is set to the number of bytes it takes and the generator ends.
+        Messages are generated as soon as they complete, so a new chunk size applies to the very next chunk.'''
+        stream, lastReadHeaders, incompletePackets = self.stream, self.lastReadHeaders, self.incompletePackets
         while True:
-            hdrsize = ord((yield self.stream.read(1))[0])  # read header size byte
-            channel = hdrsize & CHANNEL_MASK
+            buf, start, end = stream.buffer, stream.start, stream.end
+            pos = start + 1
+            if pos > end: self.needed = 1; return
+            hdrsize = buf[start]
+            channel, hdrtype = hdrsize & 0x3F, hdrsize & Header.MASK
             if channel == 0: # we need one more byte
-                channel = 64 + ord((yield self.stream.read(1))[0])
+                if pos + 1 > end: self.needed = pos + 1 - start; return
+                channel = 64 + buf[pos]; pos += 1
             elif channel == 1: # we need two more bytes
-                data = (yield self.stream.read(2))
-                channel = 64 + ord(data[0]) + 256 * ord(data[1])
-
-            hdrtype = hdrsize & Header.MASK   # read header type byte
-            if hdrtype == Header.FULL or not self.lastReadHeaders.has_key(channel):
-                header = Header(channel)
-                self.lastReadHeaders[channel] = header
-            else:
-                header = self.lastReadHeaders[channel]
+                if pos + 2 > end: self.needed = pos + 2 - start; return
+                channel = 64 + buf[pos] + 256 * buf[pos + 1]; pos += 2
             
-            if hdrtype < Header.SEPARATOR: # time or delta has changed
-                data = (yield self.stream.read(3))
-                header.time = struct.unpack('!I', '\x00' + data)[0]
-                
-            if hdrtype < Header.TIME: # size and type also changed
-                data = (yield self.stream.read(3))
-                header.size = struct.unpack('!I', '\x00' + data)[0]
-                header.type = ord((yield self.stream.read(1))[0])
-
-            if hdrtype < Header.MESSAGE: # streamId also changed
-                data = (yield self.stream.read(4))
-                header.streamId = struct.unpack('<I', data)[0]
-
-            if header.time == 0xFFFFFF: # if we have extended timestamp, read it
-                data = (yield self.stream.read(4))
-                header.extendedTime = struct.unpack('!I', data)[0]
-                if _debug: print 'extended time stamp', '%x'%(header.extendedTime,)
+            if pos + Protocol.HEADER_SIZE[hdrtype] > end: self.needed = pos + Protocol.HEADER_SIZE[hdrtype] - start; return
+            header = None if hdrtype == Header.FULL else lastReadHeaders.get(channel, None)
+            if header is None: time, size, type, streamId = 0, None, None, 0
+            else: time, size, type, streamId = header.time, header.size, header.type, header.streamId
+            if hdrtype < Header.TIME: # time, size and type changed
+                high, low, sizeHigh, sizeLow, type = _TIME_SIZE_TYPE.unpack_from(buf, pos)
+                time, size = (high << 16) | low, (sizeHigh << 16) | sizeLow
+                if hdrtype == Header.FULL: # streamId also changed
+                    streamId = _STREAM_ID.unpack_from(buf, pos + 7)[0]
+            elif hdrtype == Header.TIME: # only time or delta changed
+                high, low = _TIME.unpack_from(buf, pos)
+                time = (high << 16) | low
+            pos += Protocol.HEADER_SIZE[hdrtype]
+            
+            if time == 0xFFFFFF: # if we have extended timestamp, read it
+                if pos + 4 > end: self.needed = pos + 4 - start; return
+                extendedTime = _EXTENDED_TIME.unpack_from(buf, pos)[0]; pos += 4
+                if _debug: print 'extended time stamp', '%x'%(extendedTime,)
             else:
-                header.extendedTime = None
-                
+                extendedTime = None
+            
+            pending = incompletePackets.get(channel, None) # are we continuing an incomplete packet?
+            count = min(size - (len(pending) if pending else 0), self.readChunkSize) # how much more
+            if pos + count > end: self.needed = pos + count - start; return
+            
+            # the whole chunk is there, update the channel state and take it
+            if header is None:
+                header = lastReadHeaders[channel] = Header(channel)
+            header.time, header.size, header.type, header.streamId, header.extendedTime = time, size, type, streamId, extendedTime
             if hdrtype == Header.FULL:
-                header.currentTime = header.extendedTime or header.time
+                header.currentTime = extendedTime or time
                 header.hdrtype = hdrtype
             elif hdrtype in (Header.MESSAGE, Header.TIME):
                 header.hdrtype = hdrtype
-
-            #print header.type, '0x%02x'%(hdrtype,), header.time, header.currentTime
             
-            # if _debug: print 'R', header, header.currentTime, header.extendedTime, '0x%x'%(hdrsize,)
-             
-            data = self.incompletePackets.get(channel, "") # are we continuing an incomplete packet?
+            if pending is None and count == size: # the common case of a message in a single chunk
+                data = str(buffer(buf, pos, count))
+            else:
+                if pending is None: pending = incompletePackets[channel] = bytearray()
+                pending.extend(buffer(buf, pos, count))
+            stream.consumed(pos + count - start)
             
-            count = min(header.size - (len(data)), self.readChunkSize) # how much more
+            if pending is not None:
+                if len(pending) < size: continue # we don't have all data
+                data = str(pending)
+                del incompletePackets[channel]
             
-            data += (yield self.stream.read(count))
-
-            # check if we need to send Ack
-            if self.readWinSize is not None:
-                if self.stream.bytesRead > (self.readWinSize0 + self.readWinSize):
-                    self.readWinSize0 = self.stream.bytesRead
-                    ack = Message()
-                    ack.type, ack.data = Message.ACK, struct.pack('>L', self.readWinSize0)
-                    self.writeMessage(ack)
-                    
-            if len(data) < header.size: # we don't have all data
-                self.incompletePackets[channel] = data
-            else: # we have all data
-                if hdrtype in (Header.MESSAGE, Header.TIME):
-                    header.currentTime = header.currentTime + (header.extendedTime or header.time)
-                elif hdrtype == Header.SEPARATOR:
-                    if header.hdrtype in (Header.MESSAGE, Header.TIME):
-                        header.currentTime = header.currentTime + (header.extendedTime or header.time)
-                if len(data) == header.size:
-                    if channel in self.incompletePackets:
-                        del self.incompletePackets[channel]
-                else:
-                    data, self.incompletePackets[channel] = data[:header.size], data[header.size:]
-                
-                hdr = Header(channel=header.channel, time=header.currentTime, size=header.size, type=header.type, streamId=header.streamId)
-                msg = Message(hdr, data)
-                if _debug: print 'Protocol.parseMessage msg=', msg
-                try:
-                    if channel == Protocol.PROTOCOL_CHANNEL_ID:
-                        self.protocolMessage(msg)
-                    else: 
-                        yield self.messageReceived(msg)
-                except:
-                    if _debug: print 'Protocol.parseMessages exception', (traceback and traceback.print_exc() or None)
+            if hdrtype in (Header.MESSAGE, Header.TIME):
+                header.currentTime = header.currentTime + (extendedTime or time)
+            elif hdrtype == Header.SEPARATOR:
+                if header.hdrtype in (Header.MESSAGE, Header.TIME):
+                    header.currentTime = header.currentTime + (extendedTime or time)
+            
+            yield Message(Header(channel=channel, time=header.currentTime, size=size, type=type, streamId=streamId), data)
 
     def write(self):
-        '''Writes messages to stream'''
-        while True:
-            while self.writeQueue.empty(): (yield multitask.sleep(0.01))
-            message = self.writeQueue.get() # TODO this should be used using multitask.Queue and remove previous wait.
-            if _debug: print 'Protocol.write msg=', message
-            if message is None: 
-                try: self.stream.close()  # just in case TCP socket is not closed, close it.
-                except: pass
-                break
-            
-            # get the header stored for the stream
-            if self.lastWriteHeaders.has_key(message.streamId):
-                header = self.lastWriteHeaders[message.streamId]
-            else:
-                if self.nextChannelId <= Protocol.PROTOCOL_CHANNEL_ID: self.nextChannelId = Protocol.PROTOCOL_CHANNEL_ID+1
-                header, self.nextChannelId = Header(self.nextChannelId), self.nextChannelId + 1
-                self.lastWriteHeaders[message.streamId] = header
-            if message.type < Message.AUDIO:
-                header = Header(Protocol.PROTOCOL_CHANNEL_ID)
-               
-            # now figure out the header data bytes
-            if header.streamId != message.streamId or header.time == 0 or message.time <= header.time:
-                header.streamId, header.type, header.size, header.time, header.delta = message.streamId, message.type, message.size, message.time, message.time
-                control = Header.FULL
-            elif header.size != message.size or header.type != message.type:
-                header.type, header.size, header.time, header.delta = message.type, message.size, message.time, message.time-header.time
-                control = Header.MESSAGE
-            else:
-                header.time, header.delta = message.time, message.time-header.time
-                control = Header.TIME
+        '''Writes messages to stream. Sleeps on writeReady while there is nothing to write, and sends the messages queued
+        by then, up to a READ_SIZE worth, in one piece. They are taken by priority, see WriteQueue, whole messages at a
+        time, so on a congested connection the control messages and audio overtake the video queued before them.'''
+        closing = False
+        while not closing:
+            while not self.writeQueue: (yield self.writeReady.wait())
+            chunks, size = [], 0
+            while self.writeQueue and size < SockStream.READ_SIZE:
+                message = self.writeQueue.popleft()
+                if _debug: print 'Protocol.write msg=', message
+                if message is None:
+                    closing = True
+                    break
+                try: data = self.encodeMessage(message)
+                except: print traceback.print_exc(); continue
+                chunks.append(data); size += len(data)
             
-            hdr = Header(channel=header.channel, time=header.delta if control in (Header.MESSAGE, Header.TIME) else header.time, size=header.size, type=header.type, streamId=header.streamId)
-            assert message.size == len(message.data)
+            if chunks:
+                try:
+                    yield self.stream.write(chunks[0] if len(chunks) == 1 else ''.join(chunks)) # a single message stays shared
+                except ConnectionClosed:
+                    yield self.connectionClosed()
+                except:
+                    print traceback.print_exc()
+        try: self.stream.close()  # just in case TCP socket is not closed, close it.
+        except: pass
 
-            data = ''
-            while len(message.data) > 0:
-                data += hdr.toBytes(control) # gather header bytes
-                count = min(self.writeChunkSize, len(message.data))
-                data += message.data[:count]
-                message.data = message.data[count:]
-                control = Header.SEPARATOR # incomplete message continuation
-            try:
-                yield self.stream.write(data)
-            except ConnectionClosed:
-                yield self.connectionClosed()
-            except:
-                print traceback.print_exc()
+    def encodeMessage(self, message):
+        '''Returns the chunks of message as they go on the wire, updating the header state of its stream. The chunked
+        form is kept in message.encodings (if it has any) keyed by the chunk size and headers that went into it, and
+        reused as is for any other client that would have produced the same bytes.'''
+        # get the header stored for the chunk stream
+        if message.type < Message.AUDIO:
+            header = Header(Protocol.PROTOCOL_CHANNEL_ID)
+        else:
+            header = self.chunkStream(message)
+           
+        # now figure out the header data bytes
+        if header.streamId != message.streamId or header.time == 0 or message.time <= header.time:
+            header.streamId, header.type, header.size, header.time, header.delta = message.streamId, message.type, message.size, message.time, message.time
+            control = Header.FULL
+        elif header.size != message.size or header.type != message.type:
+            header.type, header.size, header.time, header.delta = message.type, message.size, message.time, message.time-header.time
+            control = Header.MESSAGE
+        else:
+            header.time, header.delta = message.time, message.time-header.time
+            control = Header.TIME
+        
+        hdr = Header(channel=header.channel, time=header.delta if control in (Header.MESSAGE, Header.TIME) else header.time, size=header.size, type=header.type, streamId=header.streamId)
+        assert message.size == len(message.data)
+        
+        first = hdr.toBytes(control)
+        if message.encodings is not None:
+            key = (self.writeChunkSize, first) # the continuation headers follow from the first one
+            encoded = message.encodings.get(key, None)
+            if encoded is not None and encoded[0] is message.data: # unless the payload was replaced since
+                return encoded[1]
+        
+        data, chunkSize = message.data, self.writeChunkSize
+        if not data: return '' # nothing to send
+        separator = hdr.toBytes(Header.SEPARATOR)
+        parts = [first] # gather header bytes and payload, joined once at the end
+        for offset in xrange(0, len(data), chunkSize):
+            if offset: parts.append(separator) # incomplete message continuation
+            parts.append(data[offset:offset + chunkSize])
+        data = ''.join(parts)
+        if message.encodings is not None:
+            message.encodings[key] = (message.data, data)
+        if message.type == Message.CHUNK_SIZE: # applies to the chunks after this one
+            self.writeChunkSize = struct.unpack('>L', message.data)[0]
+        return data
+    
+    def chunkStream(self, message):
+        '''Returns the header of the chunk stream message goes out on, creating it as needed. Audio, video, commands and
+        the rest (data and shared objects) of each message stream have a chunk stream of their own, so that consecutive
+        messages of a kind compress to time-only or separator headers instead of forcing full headers on each other, and
+        so that each chunk stream goes through a single lane of the WriteQueue.'''
+        if message.type in (Message.AUDIO, Message.VIDEO, Message.RPC): kind = message.type
+        elif message.type == Message.RPC3: kind = Message.RPC
+        else: kind = Message.DATA
+        key = (message.streamId, kind)
+        if self.lastWriteHeaders.has_key(key):
+            return self.lastWriteHeaders[key]
+        if self.nextChannelId <= Protocol.PROTOCOL_CHANNEL_ID: self.nextChannelId = Protocol.PROTOCOL_CHANNEL_ID+1
+        header, self.nextChannelId = Header(self.nextChannelId), self.nextChannelId + 1
+        self.lastWriteHeaders[key] = header
+        return header
+    
+    def setChunkSize(self, size):
+        '''Tells the peer that our chunks will be size bytes from now on, and switches to that for the messages written
+        after this one. It goes out ahead of any media queued before it, as protocol control messages do.'''
+        if not 0 < size <= Protocol.MAX_CHUNK_SIZE: raise ValueError('invalid chunk size %r'%(size,))
+        msg = Message()
+        msg.type, msg.data = Message.CHUNK_SIZE, struct.pack('>L', size)
+        self.writeMessage(msg)
 
 class Command(object):
     ''' Class for command / data messages'''
@@ -447,43 +681,52 @@ def getfilename(path, name, root):
     return result
 
 class FLV(object):
-    '''An FLV file which converts between RTMP message and FLV tags.'''
+    '''An FLV file which converts between RTMP message and FLV tags. A recording also writes the timestamp and offset
+    of each of its key frames to a sidecar file, the path of the FLV file with INDEX after it, which lets a reader
+    seek with a binary search. A reader maps the file into memory and reads the tags from there.'''
+    INDEX, INDEX_ENTRY = '.idx', struct.Struct('>IQ') # timestamp in milliseconds, offset of the tag in the file
     def __init__(self):
-        self.fname = self.fp = self.type = None
+        self.fname = self.fp = self.type = self.index = self.map = None
         self.tsp = self.tsr = 0; self.tsr0 = None
+        self.offset = self.pos = self.start = 0; self.keyframes = []; self.times = self.offsets = self.indexed = None
     
     def open(self, path, type='read', mode=0775):
         '''Open the file for reading (type=read) or writing (type=record or append).'''
         if str(path).find('/../') >= 0 or str(path).find('\\..\\') >= 0: raise ValueError('Must not contain .. in name')
         if _debug: print 'opening file', path
-        self.tsp = self.tsr = 0; self.tsr0 = None; self.type = type
+        self.tsp = self.tsr = 0; self.tsr0 = None; self.type = type; self.fname = path
         if type in ('record', 'append'):
             try: os.makedirs(os.path.dirname(path), mode)
             except: pass
             self.fp = open(path, ('w' if type == 'record' else 'a')+'b')
+            self.index = open(path + FLV.INDEX, ('w' if type == 'record' else 'a')+'b')
             if type == 'record':
                 self.fp.write('FLV\x01\x05\x00\x00\x00\x09\x00\x00\x00\x00') # the header and first previousTagSize
                 self.writeDuration(0.0)
+            self.fp.seek(0, os.SEEK_END); self.offset = self.fp.tell()
         else: 
             self.fp = open(path, 'rb')
             magic, version, flags, offset = struct.unpack('!3sBBI', self.fp.read(9))
             if _debug: print 'FLV.open() hdr=', magic, version, flags, offset
             if magic != 'FLV': raise ValueError('This is not a FLV file')
             if version != 1: raise ValueError('Unsupported FLV file version')
-            if offset > 9: self.fp.seek(offset-9, os.SEEK_CUR)
-            self.fp.read(4) # ignore first previous tag size
+            self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self.start = self.pos = offset + 4 # ignore first previous tag size
         return self 
     
     def close(self):
         '''Close the underlying file for this object.'''
         if _debug: print 'closing flv file'
         if self.type == 'record' and self.tsr0 is not None: self.writeDuration((self.tsr - self.tsr0)/1000.0)
+        if self.index is not None: self.writeIndex(); self.index.close(); self.index = None
+        if self.map is not None: self.map.close(); self.map = None
         if self.fp is not None: self.fp.close(); self.fp = None
     
     def delete(self, path):
         '''Delete the underlying file for this object.'''
-        try: os.unlink(path)
-        except: pass
+        for name in (path, path + FLV.INDEX):
+            try: os.unlink(name)
+            except: pass
         
     def writeDuration(self, duration):
         if _debug: print 'writing duration', duration
@@ -502,6 +745,13 @@ class FLV(object):
         
     def write(self, message):
         '''Write a message to the file, assuming it was opened for writing or appending.'''
+        data = self.tag(message)
+        if data: self.fp.write(data); self.writeIndex()
+    
+    def tag(self, message):
+        '''Returns the FLV tag for an audio or video message, and its previous tag size, as write() would write them, or an
+        empty string for any other message. The tag is taken to go at the end of the file, and is indexed if it is a key
+        frame.'''
 #        if message.type == Message.VIDEO:
 #            self.videostarted = True
 #        elif not hasattr(self, "videostarted"): return
@@ -512,8 +762,30 @@ class FLV(object):
             self.tsr, ts = ts, ts - self.tsr0
             # if message.type == Message.AUDIO: print 'w', message.type, ts
             data = struct.pack('>BBHBHB', message.type, (length >> 16) & 0xff, length & 0x0ffff, (ts >> 16) & 0xff, ts & 0x0ffff, (ts >> 24) & 0xff) + '\x00\x00\x00' +  message.data
-            data += struct.pack('>I', len(data))
-            self.fp.write(data)
+            if videoFrame(message) == 1: self.keyframes.append(FLV.INDEX_ENTRY.pack(ts, self.offset))
+            self.offset += len(data) + 4
+            return data + struct.pack('>I', len(data))
+        return ''
+    
+    def writeIndex(self):
+        '''Appends the key frames of the tags made since the last call to the index file. Call it once the tags are
+        written, so that the index never points past the end of the file.'''
+        if self.keyframes and self.index is not None: self.index.write(''.join(self.keyframes))
+        self.keyframes = []
+    
+    def remap(self):
+        '''For file reader, maps the file again if it has grown since, as it does while it is being recorded.'''
+        if os.fstat(self.fp.fileno()).st_size > len(self.map):
+            self.map.close(); self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    def tagAt(self, pos):
+        '''For file reader, the type, body length and timestamp of the tag at offset pos, or None unless all of it and
+        its previous tag size are in the mapped file.'''
+        if pos + 11 > len(self.map): return None
+        type, len0, len1, ts0, ts1, ts2 = struct.unpack_from('>BBHBHB', self.map, pos)
+        length = (len0 << 16) | len1; ts = (ts0 << 16) | (ts1 & 0x0ffff) | (ts2 << 24)
+        if pos + 15 + length > len(self.map): return None
+        return type, length, ts
     
     def reader(self, stream):
         '''A generator to periodically read the file and dispatch them to the stream. The supplied stream
@@ -521,14 +793,15 @@ class FLV(object):
         if _debug: print 'reader started'
         try:
             while self.fp is not None:
-                bytes = self.fp.read(11)
-                if len(bytes) == 0:
+                tag = self.tagAt(self.pos)
+                if tag is None: self.remap(); tag = self.tagAt(self.pos)
+                if tag is None:
                     response = Command(name='onStatus', id=stream.id, args=[amf.Object(level='status',code='NetStream.Play.Stop', description='File ended', details=None)])
                     stream.send(response.toMessage())
                     break
-                type, len0, len1, ts0, ts1, ts2, sid0, sid1 = struct.unpack('>BBHBHBBH', bytes)
-                length = (len0 << 16) | len1; ts = (ts0 << 16) | (ts1 & 0x0ffff) | (ts2 << 24)
-                body = self.fp.read(length); ptagsize, = struct.unpack('>I', self.fp.read(4))
+                type, length, ts = tag
+                body = self.map[self.pos+11:self.pos+11+length]; ptagsize, = struct.unpack_from('>I', self.map, self.pos+11+length)
+                self.pos += 15 + length
                 if ptagsize != (length+11): 
                     if _debug: print 'invalid previous tag-size found:', ptagsize, '!=', (length+11),'ignored.'
                 if stream is None or stream.client is None: break # if it is closed
@@ -551,34 +824,167 @@ class FLV(object):
         except: 
             if _debug: print 'closing the reader', (sys and sys.exc_info() or None)
             traceback.print_exc()
+            if self.map is not None: self.map.close(); self.map = None
             if self.fp is not None: self.fp.close(); self.fp = None
+    
+    def loadIndex(self):
+        '''For file reader, loads the (timestamp, offset) of the key frames of the file: from the sidecar file the recording
+        wrote, else from the keyframes of its onMetaData, as other tools write them, else by going through the headers of
+        its tags once. Entries that do not point at a whole video tag are left out.'''
+        entries, size = [], FLV.INDEX_ENTRY.size
+        try:
+            data = open(self.fname + FLV.INDEX, 'rb').read()
+            entries = [FLV.INDEX_ENTRY.unpack_from(data, i) for i in xrange(0, len(data) - size + 1, size)]
+        except IOError: pass
+        if not entries:
+            tag = self.tagAt(self.start)
+            if tag is not None and tag[0] == Message.DATA:
+                try:
+                    amfReader = amf.AMF0(self.map[self.start+11:self.start+11+tag[1]])
+                    name, obj = amfReader.read(), amfReader.read()
+                    get = lambda obj, name: obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+                    keyframes = get(obj, 'keyframes')
+                    entries = [(int(t * 1000), int(p)) for t, p in zip(get(keyframes, 'times'), get(keyframes, 'filepositions'))]
+                except: entries = []
+        entries = [(ts, pos) for ts, pos in entries if pos >= self.start and (self.tagAt(pos) or (None,))[0] == Message.VIDEO]
+        if not entries:
+            pos, every = self.start, []
+            while True:
+                tag = self.tagAt(pos)
+                if tag is None: break
+                type, length, ts = tag
+                if type == Message.VIDEO and ord(self.map[pos+11:pos+12] or '\x00') >> 4 == 1 and self.map[pos+11:pos+13] != '\x17\x00': entries.append((ts, pos))
+                elif type == Message.AUDIO: every.append((ts, pos))
+                pos += 15 + length
+            entries = entries or every # audio only, so any audio tag will do
+        self.times, self.offsets = [ts for ts, pos in entries], [pos for ts, pos in entries]
+        self.indexed = len(self.map)
+        if _debug: print 'FLV.loadIndex()', len(entries), 'key frames'
             
     def seek(self, offset):
-        '''For file reader, try seek to the given time. The offset is in millisec'''
+        '''For file reader, seek to the last key frame at or before the given time, found with a binary search of the index
+        (see loadIndex). The offset is in millisec. The tags from the key frame up to the time are sent without waiting.'''
         if self.type == 'read':
             if _debug: print 'FLV.seek() offset=', offset, 'current tsp=', self.tsp
-            self.fp.seek(0, os.SEEK_SET)
-            magic, version, flags, length = struct.unpack('!3sBBI', self.fp.read(9))
-            if length > 9: self.fp.seek(length-9, os.SEEK_CUR)
-            self.fp.seek(4, os.SEEK_CUR) # ignore first previous tag size
-            self.tsp, ts = int(offset), 0
-            while self.tsp > 0 and ts < self.tsp:
-                bytes = self.fp.read(11)
-                if not bytes: break
-                type, len0, len1, ts0, ts1, ts2, sid0, sid1 = struct.unpack('>BBHBHBBH', bytes)
-                length = (len0 << 16) | len1; ts = (ts0 << 16) | (ts1 & 0x0ffff) | (ts2 << 24)
-                self.fp.seek(length, os.SEEK_CUR)
-                ptagsize, = struct.unpack('>I', self.fp.read(4))
-                if ptagsize != (length+11): break
-            if _debug: print 'FLV.seek() new ts=', ts, 'tell', self.fp.tell()
+            self.remap()
+            if self.times is None or self.indexed != len(self.map): self.loadIndex()
+            self.tsp = int(offset)
+            i = bisect.bisect_right(self.times, self.tsp) - 1
+            self.pos = self.offsets[i] if i > 0 else self.start # from the start for the first one, for the headers before it
+            if _debug: print 'FLV.seek() new ts=', self.times[i] if i > 0 else 0, 'pos', self.pos
                 
         
+class GopCache(object):
+    '''The latest group of pictures of a published stream, for players that join it: the metadata, the audio and video
+    sequence headers, and the audio and video messages since the last key frame. Frames are only kept while they fit
+    in size bytes; past that the group is dropped and caching resumes with the next key frame. The cache keeps copies
+    without chunked forms, so that size bounds its memory: the ones the live message gets as it goes out to players
+    stay with it, and each joining player chunks its catch-up once.'''
+    def __init__(self, size):
+        self.size, self.metadata, self.videoHeader, self.audioHeader = size, None, None, None
+        self.frames, self.bytes = None, 0 # None until the first key frame
+        
+    def add(self, message):
+        '''Remember a copy of message if a joining player needs it.'''
+        data = message.data
+        message = Message(message.header.dup(), data)
+        if message.type == Message.VIDEO and data:
+            if ord(data[0]) & 0x0F == 7 and len(data) > 1 and data[1] == '\x00': # AVC sequence header
+                self.videoHeader = message; return
+            if ord(data[0]) >> 4 == 1: # key frame, starts a new group
+                self.frames, self.bytes = [], 0
+        elif message.type == Message.AUDIO and data:
+            if ord(data[0]) >> 4 == 10 and len(data) > 1 and data[1] == '\x00': # AAC sequence header
+                self.audioHeader = message; return
+        elif message.type in (Message.DATA, Message.DATA3):
+            self.metadata = message; return
+        else: return
+        if self.frames is not None:
+            if self.bytes + len(data) > self.size: self.frames, self.bytes = None, 0
+            else: self.frames.append(message); self.bytes += len(data)
+        
+    def messages(self):
+        '''Returns copies of what a joining player should get, in order, to be sent as they are.'''
+        return [Message(m.header.dup(), m.data) for m in [m for m in (self.metadata, self.videoHeader, self.audioHeader)
+                if m is not None] + (self.frames or [])]
+        
+class FLVRecorder(object):
+    '''Records a published stream to an FLV file from a thread of its own, so that live delivery never waits on the disk.
+    write() only puts the message on a bounded queue, and drops it if the queue is full. The thread writes all it finds
+    queued in one piece, and fsyncs the file every syncInterval seconds (never if 0). written, dropped, batches,
+    writeTime and maxWriteTime (seconds spent in writes, in all and at most in one) count what it did, and depth() is
+    the number of messages queued.'''
+    QUEUE_SIZE, SYNC_INTERVAL = 4096, 1.0 # defaults, about a minute of audio and video, and how often to fsync
+    def __init__(self, queueSize=QUEUE_SIZE, syncInterval=SYNC_INTERVAL):
+        self.flv, self.queue, self.syncInterval = FLV(), Queue.Queue(queueSize), syncInterval
+        self.written = self.dropped = self.batches = 0
+        self.writeTime = self.maxWriteTime = 0.0
+        self.thread, self.closed = None, False
+        
+    def open(self, path, type='record'):
+        '''Opens the file as FLV.open() does, for record or append, and starts the thread that writes to it.'''
+        self.flv.open(path, type)
+        self.thread = threading.Thread(target=self.run, name='FLVRecorder ' + str(path))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+    
+    def depth(self):
+        return self.queue.qsize()
+    
+    def stats(self):
+        '''Returns the counters as a dict, with the seconds spent in writes in all and at most in one, for reporting.'''
+        return {'written': self.written, 'dropped': self.dropped, 'batches': self.batches, 'queued': self.depth(),
+                'write_time': self.writeTime, 'max_write_time': self.maxWriteTime, 'closed': self.closed}
+    
+    def write(self, message):
+        '''Queues an audio or video message to be written, or drops it if the writer is that far behind. Does not block.'''
+        if self.closed or (message.type != Message.AUDIO and message.type != Message.VIDEO): return
+        try: self.queue.put_nowait(message)
+        except Queue.Full: self.dropped += 1
+    
+    def close(self):
+        '''Lets the thread write what is queued and close the file. Does not block.'''
+        if self.closed: return
+        self.closed = True
+        try: self.queue.put_nowait(None)
+        except Queue.Full: pass # the thread checks closed once it has written what is queued
+    
+    def run(self):
+        fp, lastSync, done = self.flv.fp, time.time(), False
+        try:
+            while not done:
+                try: messages = [self.queue.get(timeout=self.syncInterval or 1.0)]
+                except Queue.Empty: messages = []
+                try:
+                    while True: messages.append(self.queue.get_nowait())
+                except Queue.Empty: pass
+                if None in messages: messages, done = messages[:messages.index(None)], True
+                if messages:
+                    start = time.time()
+                    fp.write(''.join(map(self.flv.tag, messages)))
+                    self.flv.writeIndex()
+                    elapsed = time.time() - start
+                    self.written, self.batches = self.written + len(messages), self.batches + 1
+                    self.writeTime, self.maxWriteTime = self.writeTime + elapsed, max(self.maxWriteTime, elapsed)
+                if done or self.syncInterval and time.time() - lastSync >= self.syncInterval:
+                    fp.flush(); self.flv.index.flush()
+                    if self.syncInterval: os.fsync(fp.fileno())
+                    lastSync = time.time()
+                done = done or self.closed and self.queue.empty()
+        except:
+            if _debug: print 'FLVRecorder exception', (sys and sys.exc_info())
+        finally:
+            self.closed = True
+            self.flv.close()
+            
 class Stream(object):
     '''The stream object that is used for RTMP stream.'''
     count = 0;
     def __init__(self, client):
         self.client, self.id, self.name = client, 0, ''
         self.recordfile = self.playfile = None # so that it doesn't complain about missing attribute
+        self.gop = None # GopCache of a published stream
         self.queue = multitask.Queue()
         self._name = 'Stream[' + str(Stream.count) + ']'; Stream.count += 1
         if _debug: print self, 'created'
@@ -597,6 +1003,12 @@ class Stream(object):
         '''Generator to receive new Message on this stream, or None if stream is closed.'''
         return self.queue.get()
     
+    def pending(self):
+        '''Removes and returns the messages already queued on this stream, the ones recv() would give without waiting.'''
+        messages = []
+        while len(self.queue): messages.append(self.queue.get_nowait())
+        return messages
+    
     def send(self, msg):
         '''Method to send a Message or Command on this stream.'''
         if isinstance(msg, Command):
@@ -612,6 +1024,10 @@ class Client(Protocol):
         self.server, self.agent, self.streams, self._nextCallId, self._nextStreamId, self.objectEncoding = \
           server,      None,         {},           2,                1,                  0.0
         self.queue = multitask.Queue() # receive queue used by application
+        self.start()
+    
+    def start(self):
+        '''Starts the tasks that parse the messages of the client and write the ones queued for it.'''
         multitask.add(self.parse()); multitask.add(self.write())
 
     def recv(self):
@@ -781,12 +1197,19 @@ class App(object):
     
 class FlashServer(object):
     '''A RTMP server to record and stream Flash video.'''
+    CHUNK_SIZE = 4096 # default outbound chunk size, large enough for most audio and video frames to go in one chunk
+    GOP_CACHE_SIZE = 4 * 1024 * 1024 # default bytes of the latest group of pictures kept per published stream
+    QUEUE_BYTES, QUEUE_TIME = 4 * 1024 * 1024, 10000 # default limits of each client's write queue, see Protocol.dropMedia()
     def __init__(self):
         '''Construct a new FlashServer. It initializes the local members.'''
         self.sock = self.server = None;
         self.apps = dict({'*': App}) # supported applications: * means any as in {'*': App}
         self.clients = dict()  # list of clients indexed by scope. First item in list is app instance.
         self.root = '';
+        self.chunkSize = FlashServer.CHUNK_SIZE # size of the chunks we send, negotiated with every client
+        self.gopCacheSize = FlashServer.GOP_CACHE_SIZE # bytes of frames kept per published stream for joining players, 0 for none
+        self.queueBytes, self.queueTime = FlashServer.QUEUE_BYTES, FlashServer.QUEUE_TIME # write queue limits of every client, 0 for none
+        self.recordQueueSize, self.recordSyncInterval = FLVRecorder.QUEUE_SIZE, FLVRecorder.SYNC_INTERVAL # of the FLVRecorder of each recorded stream
         
     def start(self, host='0.0.0.0', port=1935):
         '''This should be used to start listening for RTMP connections on the given port, which defaults to 1935.'''
@@ -795,7 +1218,7 @@ class FlashServer(object):
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             sock.bind((host, port))
             if _debug: print 'listening on ', sock.getsockname()
-            sock.listen(5)
+            sock.listen(socket.SOMAXCONN) # players arrive in bursts
             server = self.server = Server(sock) # start rtmp server on that socket
             multitask.add(self.serverlistener())
     
@@ -806,6 +1229,10 @@ class FlashServer(object):
             except: pass
         self.server = None
         
+    def spawn(self, task):
+        '''Runs a task of its own for the given generator, e.g. the reader of a file being played.'''
+        multitask.add(task)
+        
     def serverlistener(self):
         '''Server listener (generator). It accepts all connections and invokes client listener'''
         try:
@@ -815,52 +1242,62 @@ class FlashServer(object):
                 if not client:                # if the server aborted abnormally,
                     break                     #    hence close the listener.
                 if _debug: print 'client connection received', client, args
-                if client.objectEncoding != 0 and client.objectEncoding != 3:
-                #if client.objectEncoding != 0:
-                    yield client.rejectConnection(reason='Unsupported encoding ' + str(client.objectEncoding) + '. Please use NetConnection.defaultObjectEncoding=ObjectEncoding.AMF0')
-                    yield client.connectionClosed()
-                else:
-                    client.path = str(client.agent.app) if hasattr(client.agent, 'app') else str(client.agent['app']) if isinstance(client.agent, dict) else None
-                    if not client.path:
-                        yield client.rejectConnection(reason='Missing app path')
-                        break
-                    name, ignore, scope = client.path.partition('/')
-                    if '*' not in self.apps and name not in self.apps:
-                        yield client.rejectConnection(reason='Application not found: ' + name)
-                    else: # create application instance as needed and add in our list
-                        if _debug: print 'name=', name, 'name in apps', str(name in self.apps)
-                        app = self.apps[name] if name in self.apps else self.apps['*'] # application class
-                        if client.path in self.clients: inst = self.clients[client.path][0]
-                        else: inst = app()
-                        
-                        win_ack = Message()
-                        win_ack.type, win_ack.data = Message.WIN_ACK_SIZE, struct.pack('>L', client.writeWinSize)
-                        client.writeMessage(win_ack)
-                        
-#                        set_peer_bw = Message()
-#                        set_peer_bw.type, set_peer_bw.data = Message.SET_PEER_BW, struct.pack('>LB', client.writeWinSize, 1)
-#                        client.writeMessage(set_peer_bw)
-                        
-                        try: 
-                            result = inst.onConnect(client, *args)
-                        except: 
-                            if _debug: print sys.exc_info()
-                            yield client.rejectConnection(reason='Exception on onConnect'); 
-                            continue
-                        if result is True or result is None:
-                            if client.path not in self.clients: 
-                                self.clients[client.path] = [inst]; inst._clients=self.clients[client.path]
-                            self.clients[client.path].append(client)
-                            if result is True:
-                                yield client.accept() # TODO: else how to kill this task when rejectConnection() later
-                            multitask.add(self.clientlistener(client)) # receive messages from client.
-                        else: 
-                            yield client.rejectConnection(reason='Rejected in onConnect')
+                if self.connecthandler(client, args):
+                    multitask.add(self.clientlistener(client)) # receive messages from client.
         except GeneratorExit: pass # terminate
         except StopIteration: raise
         except: 
             if _debug: print 'serverlistener exception', traceback.print_exc()
             
+    def connecthandler(self, client, args):
+        '''Accepts or rejects the connect command of a client, creating the application instance of its path as needed.
+        Returns True if the client joined the instance, and its messages are to be handled from now on.'''
+        if client.objectEncoding != 0 and client.objectEncoding != 3:
+        #if client.objectEncoding != 0:
+            client.rejectConnection(reason='Unsupported encoding ' + str(client.objectEncoding) + '. Please use NetConnection.defaultObjectEncoding=ObjectEncoding.AMF0')
+            client.writeMessage(None) # close once the rejection is out
+            return False
+        client.path = str(client.agent.app) if hasattr(client.agent, 'app') else str(client.agent['app']) if isinstance(client.agent, dict) else None
+        if not client.path:
+            client.rejectConnection(reason='Missing app path')
+            return False
+        name, ignore, scope = client.path.partition('/')
+        if '*' not in self.apps and name not in self.apps:
+            client.rejectConnection(reason='Application not found: ' + name)
+            return False
+        # create application instance as needed and add in our list
+        if _debug: print 'name=', name, 'name in apps', str(name in self.apps)
+        app = self.apps[name] if name in self.apps else self.apps['*'] # application class
+        if client.path in self.clients: inst = self.clients[client.path][0]
+        else: inst = app()
+        
+        win_ack = Message()
+        win_ack.type, win_ack.data = Message.WIN_ACK_SIZE, struct.pack('>L', client.writeWinSize)
+        client.writeMessage(win_ack)
+        if self.chunkSize != client.writeChunkSize:
+            client.setChunkSize(self.chunkSize)
+        client.maxQueueBytes, client.maxQueueTime = self.queueBytes, self.queueTime
+        
+#        set_peer_bw = Message()
+#        set_peer_bw.type, set_peer_bw.data = Message.SET_PEER_BW, struct.pack('>LB', client.writeWinSize, 1)
+#        client.writeMessage(set_peer_bw)
+        
+        try: 
+            result = inst.onConnect(client, *args)
+        except: 
+            if _debug: print sys.exc_info()
+            client.rejectConnection(reason='Exception on onConnect')
+            return False
+        if result is True or result is None:
+            if client.path not in self.clients: 
+                self.clients[client.path] = [inst]; inst._clients=self.clients[client.path]
+            self.clients[client.path].append(client)
+            if result is True:
+                client.accept() # TODO: else how to kill this task when rejectConnection() later
+            return True
+        client.rejectConnection(reason='Rejected in onConnect')
+        return False
+            
     def clientlistener(self, client):
         '''Client listener (generator). It receives a command and invokes client handler, or receives a new stream and invokes streamlistener.'''
         try:
@@ -878,8 +1315,10 @@ class FlashServer(object):
         except:
             if _debug: print 'clientlistener exception', (sys and sys.exc_info() or None)
             traceback.print_exc()
-            
-        # client is disconnected, clear our state for application instance.
+        self.disconnecthandler(client)
+        
+    def disconnecthandler(self, client):
+        '''A client that joined an application instance is disconnected, clear our state for the instance.'''
         if _debug: print 'cleaning up client', client.path
         inst = None
         if client.path in self.clients:
@@ -933,16 +1372,23 @@ class FlashServer(object):
         yield
         
     def streamlistener(self, stream):
-        '''Stream listener (generator). It receives stream message and invokes streamhandler.'''
+        '''Stream listener (generator). It receives stream messages, along with any others queued by then, and handles
+        them in order: media goes out to the players right here, commands through streamhandler.'''
         stream.recordfile = None # so that it doesn't complain about missing attribute
         while True:
             msg = (yield stream.recv())
-            if not msg:
-                if _debug: print 'stream closed'
-                self.closehandler(stream)
-                break
-            # if _debug: msg
-            multitask.add(self.streamhandler(stream, msg))
+            for msg in [msg] + stream.pending():
+                if not msg:
+                    if _debug: print 'stream closed'
+                    self.closehandler(stream)
+                    raise StopIteration
+                # if _debug: msg
+                if msg.type == Message.RPC or msg.type == Message.RPC3:
+                    yield self.streamhandler(stream, msg)
+                else: # audio or video message, no task of its own
+                    try: self.mediahandler(stream, msg)
+                    except:
+                        if _debug: print 'exception in mediahandler', (sys and sys.exc_info())
             
     def streamhandler(self, stream, message):
         '''A generator to handle a single message on the stream.'''
@@ -959,7 +1405,7 @@ class FlashServer(object):
                 elif cmd.name == 'seek':
                     yield self.seekhandler(stream, cmd) 
             else: # audio or video message
-                yield self.mediahandler(stream, message)
+                self.mediahandler(stream, message)
         except GeneratorExit: pass
         except StopIteration: raise
         except: 
@@ -975,11 +1421,12 @@ class FlashServer(object):
             if (stream.name in inst.publishers):
                 raise ValueError, 'Stream name already in use'
             inst.publishers[stream.name] = stream # store the client for publisher
+            stream.gop = GopCache(self.gopCacheSize) if self.gopCacheSize else None
             inst.onPublish(stream.client, stream)
             
             path = getfilename(stream.client.path, stream.name, self.root)
             if stream.mode in ('record', 'append'): 
-                stream.recordfile = FLV().open(path, stream.mode)
+                stream.recordfile = FLVRecorder(self.recordQueueSize, self.recordSyncInterval).open(path, stream.mode)
             # elif stream.mode == 'live': FLV().delete(path) # TODO: this is commented out to avoid accidental delete
             response = Command(name='onStatus', id=cmd.id, args=[amf.Object(level='status', code='NetStream.Publish.Start', description='', details=None)])
             yield stream.send(response)
@@ -1003,12 +1450,18 @@ class FlashServer(object):
                 if os.path.exists(path):
                     stream.playfile = FLV().open(path)
                     if start > 0: stream.playfile.seek(start)
-                    multitask.add(stream.playfile.reader(stream))
+                    self.spawn(stream.playfile.reader(stream))
                 elif start >= 0: raise ValueError, 'Stream name not found'
             if _debug: print 'playing stream=', name, 'start=', start
             inst.onPlay(stream.client, stream)
             response = Command(name='onStatus', id=cmd.id, args=[amf.Object(level='status',code='NetStream.Play.Start', description=stream.name, details=None)])
-            yield stream.send(response)
+            stream.send(response)
+            publisher = inst.publishers.get(name, None)
+            if publisher is not None and publisher.gop is not None and stream.playfile is None:
+                for m in publisher.gop.messages(): # catch up to live before the next live message comes along
+                    m.lane = WriteQueue.CATCHUP # in order, ahead of live media but behind control messages
+                    if inst.onPlayData(stream.client, stream, m): stream.send(m)
+            yield
         except ValueError, E: # some error occurred. inform the app.
             if _debug: print 'error in playing stream', str(E)
             response = Command(name='onStatus', id=cmd.id, args=[amf.Object(level='error',code='NetStream.Play.StreamNotFound',description=str(E),details=None)])
@@ -1029,17 +1482,19 @@ class FlashServer(object):
             yield stream.send(response)
             
     def mediahandler(self, stream, message):
-        '''Handle incoming media on the stream, by sending to other stream in this application instance.'''
+        '''Handle incoming media on the stream, by sending to other stream in this application instance. Only queues the
+        message for the players' writers, so it is a plain method rather than a generator.'''
         if stream.client is not None:
             inst = self.clients[stream.client.path][0]
             result = inst.onPublishData(stream.client, stream, message)
             if result:
+                if stream.gop is not None: stream.gop.add(message)
                 for s in (inst.players.get(stream.name, [])):
                     #if _debug: print 'D', stream.name, s.name
-                    m = message.dup()
+                    m = message.dup() # a header of its own, but the payload and its chunked forms are shared
                     result = inst.onPlayData(s.client, s, m)
                     if result:
-                        yield s.send(m)
+                        s.send(m)
                 if stream.recordfile is not None:
                     stream.recordfile.write(message)
 
@@ -1050,6 +1505,11 @@ if __name__ == '__main__':
     parser.add_option('-i', '--host',    dest='host',    default='0.0.0.0', help="listening IP address. Default '0.0.0.0'")
     parser.add_option('-p', '--port',    dest='port',    default=1935, type="int", help='listening port number. Default 1935')
     parser.add_option('-r', '--root',    dest='root',    default='./',       help="document root directory. Default './'")
+    parser.add_option('-c', '--chunk-size', dest='chunkSize', default=FlashServer.CHUNK_SIZE, type="int", help='outbound chunk size. Default %d'%FlashServer.CHUNK_SIZE)
+    parser.add_option('-g', '--gop-cache', dest='gopCacheSize', default=FlashServer.GOP_CACHE_SIZE, type="int", help='bytes of frames cached per published stream for joining players, 0 for none. Default %d'%FlashServer.GOP_CACHE_SIZE)
+    parser.add_option('-q', '--queue-bytes', dest='queueBytes', default=FlashServer.QUEUE_BYTES, type="int", help='bytes queued for a client before its video is dropped to the next key frame, twice that and it is disconnected, 0 for no limit. Default %d'%FlashServer.QUEUE_BYTES)
+    parser.add_option('-t', '--queue-time', dest='queueTime', default=FlashServer.QUEUE_TIME, type="int", help='milliseconds of media queued for a client before the same, 0 for no limit. Default %d'%FlashServer.QUEUE_TIME)
+    parser.add_option('-s', '--sync', dest='recordSyncInterval', default=FLVRecorder.SYNC_INTERVAL, type="float", help='seconds between fsyncs of the files streams are recorded to, 0 for none. Default %s'%FLVRecorder.SYNC_INTERVAL)
     parser.add_option('-d', '--verbose', dest='verbose', default=False, action='store_true', help='enable debug trace')
     (options, args) = parser.parse_args()
     
@@ -1057,7 +1517,9 @@ if __name__ == '__main__':
 #    _debug = True
     try:
         agent = FlashServer()
-        agent.root = options.root
+        agent.root, agent.chunkSize, agent.gopCacheSize = options.root, options.chunkSize, options.gopCacheSize
+        agent.queueBytes, agent.queueTime = options.queueBytes, options.queueTime
+        agent.recordSyncInterval = options.recordSyncInterval
         agent.start(options.host, options.port)
         if _debug: print time.asctime(), 'Flash Server Starts - %s:%d' % (options.host, options.port)
         multitask.run()
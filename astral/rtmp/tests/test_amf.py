@@ -0,0 +1,209 @@
+import datetime
+import unittest2
+from nose.tools import eq_, ok_
+
+from astral.rtmp.amf import AMF0, AMF3, BytesIO, Class, Object, undefined
+
+
+def encode(codec, *values):
+    output = BytesIO()
+    writer = codec(output)
+    for value in values:
+        writer.write(value)
+    output.seek(0)
+    return output.read()
+
+
+def decode(codec, data, count=1):
+    reader = codec(data)
+    return [reader.read() for i in range(count)]
+
+
+class UTC(datetime.tzinfo):
+    def utcoffset(self, dt):
+        return datetime.timedelta(0)
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+
+class BytesIOTest(unittest2.TestCase):
+    def test_read_past_end(self):
+        data = BytesIO('\x01\x02')
+        eq_(data.read_u8(), 1)
+        eq_(data.peek(), '\x02')
+        eq_(data.read(5), '\x02')
+        ok_(data.eof())
+        eq_(data.peek(), None)
+        self.assertRaises(EOFError, data.read, 1)
+        self.assertRaises(EOFError, data.read_u16)
+
+    def test_short_value(self):
+        self.assertRaises(EOFError, BytesIO('\x00\x00\x00').read_double)
+
+    def test_written_then_read(self):
+        data = BytesIO()
+        data.write_u16(0x0102)
+        data.write('abc')
+        data.write_double(1.5)
+        eq_(data.remaining(), 0)
+        data.seek(0)
+        eq_(data.read_u16(), 0x0102)
+        eq_(data.read(3), 'abc')
+        eq_(data.read_double(), 1.5)
+
+    def test_overwrite(self):
+        data = BytesIO()
+        data.write('abcdef')
+        data.seek(2)
+        data.write('XY')
+        eq_(data.getvalue(), 'abXYef')
+
+    def test_u29(self):
+        for value in (0, 0x7f, 0x80, 0x3fff, 0x4000, 0x1fffff, 0x200000,
+                0x1fffffff):
+            data = BytesIO()
+            data.write_u29(value)
+            data.seek(0)
+            eq_(data.read_u29(), value)
+        self.assertRaises(ValueError, BytesIO().write_u29, 0x20000000)
+
+    def test_memoryview(self):
+        eq_(BytesIO(memoryview('\x00\x05')).read_u16(), 5)
+
+
+class AMF0Test(unittest2.TestCase):
+    def round_trip(self, value):
+        eq_(decode(AMF0, encode(AMF0, value)), [value])
+
+    def test_values(self):
+        for value in (1.5, -2.0, 0.0, True, False, None, u'', u'connect',
+                u'\xe9t\xe9', [1.0, u'a', None], {u'a': 1.0, u'b': u'c'}):
+            self.round_trip(value)
+
+    def test_undefined(self):
+        ok_(decode(AMF0, encode(AMF0, undefined))[0] is undefined)
+
+    def test_integer_is_number(self):
+        eq_(encode(AMF0, 3), '\x00@\x08\x00\x00\x00\x00\x00\x00')
+
+    def test_long_string(self):
+        value = u'x' * 0x10000
+        data = encode(AMF0, value)
+        eq_(data[0], chr(AMF0.LONG_STRING))
+        eq_(decode(AMF0, data), [value])
+
+    def test_object(self):
+        obj, = decode(AMF0, encode(AMF0, Object(level='status',
+            code='NetStream.Play.Start', details=None)))
+        eq_((obj.level, obj.code, obj.details),
+                (u'status', u'NetStream.Play.Start', None))
+
+    def test_typed_object(self):
+        value = Object(name='cam')
+        value._classname = 'Stream'
+        obj, = decode(AMF0, encode(AMF0, value))
+        eq_((obj._classname, obj.name), (u'Stream', u'cam'))
+
+    def test_date(self):
+        value = datetime.datetime(2011, 5, 4, 3, 2, 1, tzinfo=UTC())
+        eq_(decode(AMF0, encode(AMF0, value)), [value])
+
+    def test_same_object_is_a_reference(self):
+        shared = Object(id='peer')
+        data = encode(AMF0, [shared, shared])
+        ok_(chr(AMF0.REFERENCE) in data)
+        first, second = decode(AMF0, data)[0]
+        ok_(first is second)
+
+    def test_equal_objects_are_not_references(self):
+        data = encode(AMF0, [{u'a': 1.0}, {u'a': 1.0}])
+        first, second = decode(AMF0, data)[0]
+        eq_(first, second)
+        ok_(first is not second)
+
+    def test_many_objects(self):
+        peers = [Object(id='peer%d' % i, port=1935.0) for i in range(500)]
+        decoded, = decode(AMF0, encode(AMF0, peers + peers[:10]))
+        eq_([p.id for p in decoded], [p.id for p in peers + peers[:10]])
+        ok_(decoded[500] is decoded[0])
+
+    def test_several_values(self):
+        eq_(decode(AMF0, encode(AMF0, u'_result', 1.0, None), 3),
+                [u'_result', 1.0, None])
+
+    def test_embedded_amf3(self):
+        eq_(decode(AMF0, chr(AMF0.TYPE_AMF3) + encode(AMF3, [1, u'a'])),
+                [[1, u'a']])
+
+
+class AMF3Test(unittest2.TestCase):
+    def round_trip(self, value):
+        eq_(decode(AMF3, encode(AMF3, value)), [value])
+
+    def test_values(self):
+        for value in (True, False, None, 1.5, u'', u'connect',
+                u'\xe9t\xe9', [1, u'a', None], {u'a': 1, u'b': u'c'}):
+            self.round_trip(value)
+
+    def test_undefined(self):
+        ok_(decode(AMF3, encode(AMF3, undefined))[0] is undefined)
+
+    def test_integers(self):
+        for value in (0, 1, -1, 0x7f, 0x80, 0x3fff, 0x4000, 0x1fffff,
+                0x200000, 0x0fffffff, -0x10000000):
+            data = encode(AMF3, value)
+            eq_(data[0], chr(AMF3.INTEGER))
+            eq_(decode(AMF3, data), [value])
+        eq_(decode(AMF3, encode(AMF3, 0x10000000)), [0x10000000])
+
+    def test_long_string(self):
+        self.round_trip(u'x' * 1000)
+
+    def test_repeated_strings_are_references(self):
+        data = encode(AMF3, [u'cam', u'cam', u'cam'])
+        eq_(data.count('cam'), 1)
+        eq_(decode(AMF3, data), [[u'cam', u'cam', u'cam']])
+
+    def test_mixed_array(self):
+        self.round_trip({0: u'a', 1: u'b', u'name': u'cam'})
+
+    def test_anonymous_object(self):
+        obj, = decode(AMF3, encode(AMF3, Object(level='status',
+            code='NetStream.Play.Start')))
+        eq_((obj.level, obj.code), (u'status', u'NetStream.Play.Start'))
+
+    def test_typed_objects_share_traits(self):
+        class_ = Class()
+        class_.name, class_.encoding, class_.attrs = 'Peer', AMF3.DYNAMIC, [
+                'id', 'port']
+        peers = [Object(_class=class_, id='peer%d' % i, port=1935, online=True)
+                for i in range(3)]
+        data = encode(AMF3, peers)
+        eq_(data.count('Peer'), 1)
+        decoded, = decode(AMF3, data)
+        eq_([(p.id, p.port, p.online) for p in decoded],
+                [(u'peer%d' % i, 1935, True) for i in range(3)])
+        eq_(decoded[0]._class.name, u'Peer')
+        eq_(decoded[0]._class.attrs, [u'id', u'port'])
+        ok_(decoded[0]._class is decoded[2]._class)
+
+    def test_same_object_is_a_reference(self):
+        shared = Object(id='peer')
+        first, second = decode(AMF3, encode(AMF3, [shared, shared]))[0]
+        ok_(first is second)
+
+    def test_self_reference(self):
+        value = [1]
+        value.append(value)
+        decoded, = decode(AMF3, encode(AMF3, value))
+        ok_(decoded[1] is decoded)
+
+    def test_date(self):
+        self.round_trip(datetime.datetime(2011, 5, 4, 3, 2, 1))
+
+    def test_byte_array(self):
+        output = BytesIO()
+        AMF3(output).writeByteArray('\x00\xff')
+        output.seek(0)
+        eq_(decode(AMF3, output.read()), ['\x00\xff'])
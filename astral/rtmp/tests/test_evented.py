@@ -0,0 +1,270 @@
+import os
+import shutil
+import socket
+import tempfile
+import time
+import tornado.testing
+from nose.tools import eq_, ok_
+
+from astral.rtmp import amf, multitask
+from astral.rtmp.evented import EventedFlashServer, Task
+from astral.rtmp.rtmp import App, Command, FLV, Header, Message, Protocol
+
+
+class RecordingApp(App):
+    calls = []
+
+    def onConnect(self, client, *args):
+        self.calls.append(('connect', client.path))
+        return App.onConnect(self, client, *args)
+
+    def onDisconnect(self, client):
+        self.calls.append(('disconnect', client.path))
+
+    def onPublish(self, client, stream):
+        self.calls.append(('publish', stream.name))
+
+    def onPlay(self, client, stream):
+        self.calls.append(('play', stream.name))
+
+    def onPublishData(self, client, stream, message):
+        self.calls.append(('data', message.time))
+        return True
+
+
+class RawClient(object):
+    """The client end of an RTMP connection, decoded with a Protocol."""
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setblocking(0)
+        self.protocol = Protocol(self.sock)
+        self.messages, self.closed = [], False
+
+    def send(self, data):
+        self.sock.setblocking(1)
+        self.sock.sendall(data)
+        self.sock.setblocking(0)
+
+    def send_message(self, message, streamId=0):
+        message.streamId = streamId
+        self.send(self.protocol.encodeMessage(message))
+
+    def call(self, name, *args, **kwargs):
+        self.send_message(Command(name=name, id=kwargs.get('id', 0),
+            cmdData=kwargs.get('cmdData'), args=list(args)).toMessage(),
+            kwargs.get('streamId', 0))
+
+    def receive(self):
+        stream = self.protocol.stream
+        stream._reserve(self.protocol.needed)
+        try:
+            received = stream._recv_into()
+        except socket.error:
+            return
+        if not received:
+            self.closed = True
+            return
+        stream.end += received
+
+    def read_messages(self):
+        self.receive()
+        for message in self.protocol.readMessages():
+            if message.header.channel == Protocol.PROTOCOL_CHANNEL_ID:
+                self.protocol.protocolMessage(message)
+            self.messages.append(message)
+
+    def commands(self):
+        return [Command.fromMessage(m) for m in self.messages
+                if m.type == Message.RPC]
+
+    def close(self):
+        self.sock.close()
+
+
+class BaseEventedTest(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(BaseEventedTest, self).setUp()
+        RecordingApp.calls = []
+        self.root = tempfile.mkdtemp()
+        self.server = EventedFlashServer(io_loop=self.io_loop)
+        self.server.apps = {'live': RecordingApp}
+        self.server.root = self.root + '/'
+        self.server.start('127.0.0.1', 0)
+        self.port = self.server.sock.getsockname()[1]
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.stop()
+        shutil.rmtree(self.root)
+        super(BaseEventedTest, self).tearDown()
+
+    def spin(self, seconds=0.01):
+        """Run the IOLoop for a little while."""
+        self.io_loop.add_timeout(time.time() + seconds, self.stop)
+        self.wait()
+
+    def run_until(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            self.spin()
+        ok_(condition())
+
+    def client(self):
+        client = RawClient(self.port)
+        self.clients.append(client)
+        ping = ''.join(chr(i % 256) for i in range(Protocol.PING_SIZE))
+        client.send('\x03' + ping)
+        stream = client.protocol.stream
+        self.run_until(lambda: client.receive() or
+                len(stream) >= 2 * Protocol.PING_SIZE + 1)
+        eq_(str(stream.buffer[stream.start:stream.end]), '\x03' + ping * 2)
+        stream.consumed(len(stream))
+        client.send(ping)
+        return client
+
+    def connect(self, app='live'):
+        client = self.client()
+        client.call('connect', id=1, cmdData=amf.Object(app=app,
+            objectEncoding=0.0))
+        self.run_until(lambda: client.read_messages() or client.commands())
+        return client
+
+    def create_stream(self, client):
+        client.call('createStream', id=2)
+        self.run_until(lambda: client.read_messages() or
+                len(client.commands()) > 1)
+        return int(client.commands()[-1].args[0])
+
+    def statuses(self, client):
+        return [cmd.args[0].code for cmd in client.commands()
+                if cmd.name == 'onStatus']
+
+
+class EventedFlashServerTest(BaseEventedTest):
+    def test_handshake(self):
+        self.client()
+
+    def test_policy_request(self):
+        client = RawClient(self.port)
+        self.clients.append(client)
+        client.send(Protocol.POLICY_REQUEST)
+        self.run_until(lambda: client.receive() or client.closed)
+        stream = client.protocol.stream
+        eq_(str(stream.buffer[stream.start:stream.end]), Protocol.POLICY)
+
+    def test_connect(self):
+        client = self.connect()
+        result = client.commands()[0]
+        eq_(result.name, '_result')
+        eq_(result.args[0].code, 'NetConnection.Connect.Success')
+        eq_([m.type for m in client.messages[:2]], [Message.WIN_ACK_SIZE,
+            Message.CHUNK_SIZE])
+        eq_(client.protocol.readChunkSize, self.server.chunkSize)
+        eq_(RecordingApp.calls, [('connect', 'live')])
+        eq_(len(self.server.clients['live']), 2)
+
+    def test_unknown_application(self):
+        client = self.connect('other')
+        eq_(client.commands()[0].name, '_error')
+        eq_(client.commands()[0].args[0].code,
+                'NetConnection.Connect.Rejected')
+        eq_(self.server.clients, {})
+
+    def test_publish_to_players(self):
+        players = [self.connect() for i in range(3)]
+        for player in players:
+            player.call('play', 'cam', streamId=self.create_stream(player))
+        publisher = self.connect()
+        streamId = self.create_stream(publisher)
+        publisher.call('publish', 'cam', 'live', streamId=streamId)
+        self.run_until(lambda: publisher.read_messages() or
+                self.statuses(publisher))
+        eq_(self.statuses(publisher), ['NetStream.Publish.Start'])
+        for i in range(20):
+            publisher.send_message(Message(Header(time=i + 1, size=3,
+                type=Message.VIDEO), ('\x17' if i % 10 == 0 else '\x27') +
+                '\x01' + chr(i)), streamId)
+        for player in players:
+            self.run_until(lambda: player.read_messages() or len([m
+                for m in player.messages if m.type == Message.VIDEO]) == 20)
+            eq_([m.data[2] for m in player.messages
+                if m.type == Message.VIDEO], [chr(i) for i in range(20)])
+            eq_(self.statuses(player), ['NetStream.Play.Start'])
+        eq_([call for call in RecordingApp.calls if call[0] != 'data'],
+                [('connect', 'live')] * 3 + [('play', 'cam')] * 3 +
+                [('connect', 'live'), ('publish', 'cam')])
+        eq_([call[1] for call in RecordingApp.calls if call[0] == 'data'],
+                range(1, 21))
+
+    def test_disconnect(self):
+        publisher = self.connect()
+        streamId = self.create_stream(publisher)
+        publisher.call('publish', 'cam', 'live', streamId=streamId)
+        self.run_until(lambda: publisher.read_messages() or
+                self.statuses(publisher))
+        inst = self.server.clients['live'][0]
+        ok_('cam' in inst.publishers)
+        publisher.close()
+        self.clients.remove(publisher)
+        self.run_until(lambda: 'live' not in self.server.clients)
+        eq_(inst.publishers, {})
+        eq_(RecordingApp.calls[-1], ('disconnect', 'live'))
+
+    def test_play_file(self):
+        flv = FLV().open(os.path.join(self.root, 'clip.flv'),
+                'record')
+        for i in range(5):
+            flv.write(Message(Header(time=i * 10, size=3,
+                type=Message.VIDEO), '\x17\x01' + chr(i)))
+        flv.close()
+        player = self.connect()
+        player.call('play', 'clip', streamId=self.create_stream(player))
+        self.run_until(lambda: player.read_messages() or
+                'NetStream.Play.Stop' in self.statuses(player))
+        eq_(self.statuses(player), ['NetStream.Play.Start',
+            'NetStream.Play.Stop'])
+        eq_([m.data[2] for m in player.messages if m.type == Message.VIDEO],
+                [chr(i) for i in range(5)])
+
+
+class TaskTest(tornado.testing.AsyncTestCase):
+    def test_nested_generators_and_sleep(self):
+        steps = []
+        def child():
+            steps.append('child')
+            yield
+            raise StopIteration(2)
+        def parent():
+            steps.append((yield child()))
+            yield multitask.sleep(0.01)
+            steps.append('woke')
+            self.stop()
+        Task(parent(), self.io_loop).step()
+        eq_(steps, ['child', 2])
+        self.wait()
+        eq_(steps, ['child', 2, 'woke'])
+
+    def test_error_propagates_to_parent(self):
+        caught = []
+        def child():
+            raise ValueError
+            yield
+        def parent():
+            try:
+                yield child()
+            except ValueError:
+                caught.append(True)
+        Task(parent(), self.io_loop).step()
+        eq_(caught, [True])
+
+    def test_cannot_wait_on_queue(self):
+        caught = []
+        def waiter():
+            try:
+                yield multitask.Queue().get()
+            except TypeError:
+                caught.append(True)
+        Task(waiter(), self.io_loop).step()
+        eq_(caught, [True])
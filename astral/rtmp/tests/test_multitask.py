@@ -0,0 +1,139 @@
+import select
+import socket
+import unittest2
+from nose.tools import eq_, ok_
+
+from astral.rtmp import multitask
+
+
+class SelectPollerTest(unittest2.TestCase):
+    poller = multitask.SelectPoller
+
+    def setUp(self):
+        self.manager = multitask.TaskManager(self.poller())
+        self.left, self.right = socket.socketpair()
+        self.results = []
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def reader(self, sock, count=1, timeout=None):
+        try:
+            for i in range(count):
+                self.results.append((yield multitask.recv(sock, 1024,
+                    timeout=timeout)))
+        except multitask.Timeout:
+            self.results.append(multitask.Timeout)
+
+    def test_round_trip(self):
+        def writer():
+            for data in ('ping', 'pong'):
+                yield multitask.send(self.left, data)
+                yield multitask.sleep(0.01)
+        self.manager.add(self.reader(self.right, 2))
+        self.manager.add(writer())
+        self.manager.run()
+        eq_(self.results, ['ping', 'pong'])
+        ok_(not self.manager.has_io_waits())
+
+    def test_read_and_write_waits_on_one_socket(self):
+        def writer():
+            yield multitask.sleep(0.01)
+            yield multitask.send(self.right, 'out')
+        self.manager.add(self.reader(self.right))
+        self.manager.add(writer())
+        self.manager.add(self.reader(self.left))
+        self.manager.run_next(timeout=0)
+        self.left.send('in')
+        self.manager.run()
+        eq_(sorted(self.results), ['in', 'out'])
+
+    def test_timeout_drops_wait(self):
+        self.manager.add(self.reader(self.right, timeout=0.01))
+        self.manager.run()
+        eq_(self.results, [multitask.Timeout])
+        ok_(not self.manager.has_io_waits())
+
+    def test_closed_socket_dropped(self):
+        def closer():
+            yield multitask.sleep(0.01)
+            self.right.close()
+        self.manager.add(self.reader(self.right))
+        self.manager.add(closer())
+        self.manager.run_next(timeout=0)
+        ok_(self.manager.has_io_waits())
+        for i in range(300):
+            if not self.manager.has_io_waits():
+                break
+            self.manager.run_next(timeout=0.01)
+        ok_(not self.manager.has_io_waits())
+        eq_(self.results, [])
+
+    def test_many_connections(self):
+        pairs = [socket.socketpair() for i in range(50)]
+        for left, right in pairs:
+            self.manager.add(self.reader(right))
+        self.manager.run_next(timeout=0)
+        for left, right in pairs:
+            left.send('x')
+        self.manager.run()
+        eq_(self.results, ['x'] * len(pairs))
+        for left, right in pairs:
+            left.close()
+            right.close()
+
+
+@unittest2.skipUnless(hasattr(select, 'poll'), "no poll() here")
+class PollPollerTest(SelectPollerTest):
+    poller = multitask.PollPoller
+
+    def test_fd_reused_after_close(self):
+        self.manager.add(self.reader(self.right))
+        self.manager.run_next(timeout=0)
+        fd = self.right.fileno()
+        self.right.close()
+        left, right = socket.socketpair()
+        if left.fileno() == fd:
+            left, right = right, left
+        eq_(right.fileno(), fd)
+        try:
+            self.manager.add(self.reader(right))
+            self.manager.run_next(timeout=0)
+            left.send('new')
+            self.manager.run()
+            eq_(self.results, ['new'])
+        finally:
+            left.close()
+            right.close()
+
+
+@unittest2.skipUnless(hasattr(select, 'epoll'), "no epoll() here")
+class EpollPollerTest(PollPollerTest):
+    poller = multitask.EpollPoller
+
+
+class QueueTest(unittest2.TestCase):
+    def setUp(self):
+        self.manager = multitask.TaskManager(multitask.SelectPoller())
+        self.results = []
+
+    def test_get_nowait(self):
+        queue = multitask.Queue([1, 2])
+        eq_(queue.get_nowait(self.manager), 1)
+        eq_(queue.get_nowait(self.manager), 2)
+        self.assertRaises(IndexError, queue.get_nowait, self.manager)
+
+    def test_get_nowait_resumes_put(self):
+        queue = multitask.Queue([1], maxsize=1)
+        def putter():
+            yield queue.put(2, timeout=1)
+            self.results.append('put')
+        self.manager.add(putter())
+        self.manager.run_next(timeout=0)
+        eq_(self.results, [])
+        eq_(queue.get_nowait(self.manager), 1)
+        self.manager.run()
+        eq_(self.results, ['put'])
+        eq_(queue.get_nowait(self.manager), 2)
+        ok_(not self.manager.has_timeouts())
@@ -0,0 +1,886 @@
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import unittest2
+from nose.tools import eq_, ok_
+
+from astral.rtmp import multitask
+from astral.rtmp.rtmp import (SockStream, ConnectionClosed, Header, Message,
+        Protocol, Command, Stream, App, FlashServer, GopCache, WriteQueue, FLV,
+        FLVRecorder)
+
+
+class SockStreamTest(unittest2.TestCase):
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+        self.left.setblocking(0)
+        self.stream = SockStream(self.right)
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def run_tasks(self, *tasks):
+        manager = multitask.TaskManager()
+        for task in tasks:
+            manager.add(task)
+        manager.run()
+
+    def writer(self, data):
+        while data:
+            sent = yield multitask.send(self.left, data)
+            data = data[sent:]
+
+    def read(self, *counts):
+        results = []
+        def reader():
+            try:
+                for count in counts:
+                    results.append((yield self.stream.read(count)))
+            except ConnectionClosed:
+                results.append(ConnectionClosed)
+        self.run_tasks(reader())
+        return results
+
+    def test_small_reads(self):
+        self.left.send('\x03abcdefgh')
+        eq_(self.read(1, 3, 3, 1), ['\x03', 'abc', 'def', 'g'])
+        eq_(len(self.stream), 1)
+        eq_(self.stream.bytesRead, 9)
+
+    def test_read_larger_than_buffer(self):
+        data = ''.join(chr(i % 256) for i in xrange(SockStream.READ_SIZE * 3))
+        results = []
+        def reader():
+            results.append((yield self.stream.read(4)))
+            results.append((yield self.stream.read(len(data) - 4)))
+        self.run_tasks(self.writer(data), reader())
+        eq_(results, [data[:4], data[4:]])
+
+    def test_compaction_keeps_data(self):
+        chunks = ['%06d' % i for i in xrange(40000)]
+        results = []
+        def reader():
+            for i in xrange(len(chunks)):
+                results.append((yield self.stream.read(6)))
+        self.run_tasks(self.writer(''.join(chunks)), reader())
+        eq_(results, chunks)
+        ok_(len(self.stream.buffer) <= SockStream.READ_SIZE * 2)
+
+    def test_unread(self):
+        self.left.send('<policy')
+        self.stream.unread(self.read(3)[0])
+        eq_(self.read(7), ['<policy'])
+        self.stream.unread('abc')
+        eq_(len(self.stream), 3)
+        eq_(self.read(3), ['abc'])
+
+    def test_write(self):
+        data = ''.join(chr(i % 256) for i in xrange(SockStream.READ_SIZE * 4))
+        received = []
+        def reader():
+            while sum(map(len, received)) < len(data):
+                received.append((yield multitask.recv(self.left, 65536)))
+        self.right.setblocking(0)
+        self.run_tasks(self.stream.write(data), reader())
+        eq_(''.join(received), data)
+        eq_(self.stream.bytesWritten, len(data))
+
+    def test_connection_closed(self):
+        self.left.send('ab')
+        self.left.close()
+        eq_(self.read(1, 2), ['a', ConnectionClosed])
+
+
+class RecordingProtocol(Protocol):
+    def __init__(self, sock):
+        Protocol.__init__(self, sock)
+        self.messages = []
+
+    def messageReceived(self, msg):
+        self.messages.append(msg)
+        yield
+
+
+class ParseMessagesTest(unittest2.TestCase):
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+        self.protocol = RecordingProtocol(self.right)
+
+    def tearDown(self):
+        self.right.close()
+
+    def parse(self, data, step=None):
+        """Send data (step bytes at a time) and parse it until the sender
+        hangs up.
+        """
+        self.left.setblocking(0)
+        def writer():
+            for offset in xrange(0, len(data), step or len(data) or 1):
+                remaining = data[offset:offset + (step or len(data))]
+                while remaining:
+                    sent = yield multitask.send(self.left, remaining)
+                    remaining = remaining[sent:]
+            self.left.close()
+        manager = multitask.TaskManager()
+        manager.add(writer())
+        manager.add(self.protocol.parseMessages())
+        try:
+            manager.run()
+        except ConnectionClosed:
+            pass
+        return self.protocol.messages
+
+    def chunks(self, header, data, control=Header.FULL, chunk_size=128):
+        result = ''
+        for offset in xrange(0, len(data), chunk_size):
+            result += header.toBytes(control) + data[offset:offset + chunk_size]
+            control = Header.SEPARATOR
+        return result
+
+    def test_single_chunk_messages(self):
+        first = Header(channel=4, time=10, size=5, type=Message.AUDIO,
+                streamId=1)
+        second = Header(channel=4, time=20, size=3, type=Message.VIDEO)
+        data = (self.chunks(first, 'audio')
+                + self.chunks(second, 'abc', control=Header.MESSAGE))
+        messages = self.parse(data)
+        eq_([msg.data for msg in messages], ['audio', 'abc'])
+        eq_([msg.time for msg in messages], [10, 30])
+        eq_([msg.type for msg in messages], [Message.AUDIO, Message.VIDEO])
+        eq_([msg.streamId for msg in messages], [1, 1])
+
+    def test_multi_chunk_message_byte_by_byte(self):
+        payload = ''.join(chr(i % 256) for i in xrange(1000))
+        header = Header(channel=6, time=5, size=len(payload),
+                type=Message.VIDEO, streamId=1)
+        delta = Header(channel=6, time=40)
+        data = (self.chunks(header, payload)
+                + self.chunks(delta, payload, control=Header.TIME))
+        messages = self.parse(data, step=1)
+        eq_([msg.data for msg in messages], [payload, payload])
+        eq_([msg.time for msg in messages], [5, 45])
+        eq_(self.protocol.incompletePackets, {})
+
+    def test_interleaved_channels(self):
+        video = 'v' * 300
+        audio = 'a' * 50
+        video_header = Header(channel=6, time=0, size=len(video),
+                type=Message.VIDEO, streamId=1)
+        audio_header = Header(channel=4, time=0, size=len(audio),
+                type=Message.AUDIO, streamId=1)
+        video_chunks = self.chunks(video_header, video)
+        first = len(video_header.toBytes(Header.FULL)) + 128
+        data = (video_chunks[:first] + self.chunks(audio_header, audio)
+                + video_chunks[first:])
+        messages = self.parse(data, step=7)
+        eq_([msg.data for msg in messages], [audio, video])
+
+    def test_large_channel_ids(self):
+        data = ''.join(self.chunks(Header(channel=channel, time=1, size=2,
+            type=Message.DATA, streamId=1), 'hi') for channel in (70, 400))
+        eq_([msg.header.channel for msg in self.parse(data, step=1)],
+                [70, 400])
+
+    def test_extended_time(self):
+        payload = 'x' * 200
+        header = Header(channel=5, time=0x1000000, size=len(payload),
+                type=Message.VIDEO, streamId=1)
+        messages = self.parse(self.chunks(header, payload), step=3)
+        eq_(messages[0].time, 0x1000000)
+        eq_(messages[0].data, payload)
+
+    def test_chunk_size_applies_to_next_chunk(self):
+        chunk_size = Header(channel=Protocol.PROTOCOL_CHANNEL_ID, time=0,
+                size=4, type=Message.CHUNK_SIZE)
+        payload = 'y' * 1000
+        header = Header(channel=6, time=0, size=len(payload),
+                type=Message.VIDEO, streamId=1)
+        data = (self.chunks(chunk_size, struct.pack('>L', 512))
+                + self.chunks(header, payload, chunk_size=512))
+        messages = self.parse(data)
+        eq_(self.protocol.readChunkSize, 512)
+        eq_([msg.data for msg in messages], [payload])
+
+
+class EncodeMessageTest(unittest2.TestCase):
+    def setUp(self):
+        self.protocol = Protocol(None)
+
+    def message(self, data, time=10, streamId=1):
+        return Message(Header(time=time, size=len(data), type=Message.VIDEO,
+            streamId=streamId), data)
+
+    def test_chunks(self):
+        data = 'x' * 300
+        encoded = self.protocol.encodeMessage(self.message(data))
+        header = Header(channel=3, time=10, size=300, type=Message.VIDEO,
+                streamId=1)
+        eq_(encoded, header.toBytes(Header.FULL) + data[:128]
+                + header.toBytes(Header.SEPARATOR) + data[128:256]
+                + header.toBytes(Header.SEPARATOR) + data[256:])
+
+    def test_header_compression(self):
+        self.protocol.encodeMessage(self.message('a' * 10, time=10))
+        encoded = self.protocol.encodeMessage(self.message('b' * 10, time=30))
+        eq_(encoded, Header(channel=3, time=20).toBytes(Header.TIME)
+                + 'b' * 10)
+
+    def test_audio_and_video_on_own_chunk_streams(self):
+        def media(message_type, time):
+            return Message(Header(time=time, size=10, type=message_type,
+                streamId=1), 'm' * 10)
+        self.protocol.encodeMessage(media(Message.VIDEO, 10))
+        self.protocol.encodeMessage(media(Message.AUDIO, 10))
+        video = self.protocol.encodeMessage(media(Message.VIDEO, 40))
+        audio = self.protocol.encodeMessage(media(Message.AUDIO, 33))
+        eq_(video, Header(channel=3, time=30).toBytes(Header.TIME) + 'm' * 10)
+        eq_(audio, Header(channel=4, time=23).toBytes(Header.TIME) + 'm' * 10)
+
+    def test_commands_and_data_on_own_chunk_streams(self):
+        channels = []
+        for message_type in (Message.DATA, Message.RPC, Message.DATA3,
+                Message.RPC3):
+            message = Message(Header(time=10, size=1, type=message_type,
+                streamId=1), 'x')
+            self.protocol.encodeMessage(message)
+            channels.append(self.protocol.chunkStream(message).channel)
+        eq_(channels, [3, 4, 3, 4])
+
+    def test_set_chunk_size(self):
+        written = []
+        self.protocol.writeMessage = written.append
+        self.protocol.setChunkSize(4096)
+        before = self.protocol.encodeMessage(self.message('a' * 300))
+        eq_(before.count(Header(channel=3).toBytes(Header.SEPARATOR)), 2)
+        encoded = self.protocol.encodeMessage(written[0])
+        eq_(encoded[-4:], struct.pack('>L', 4096))
+        eq_(self.protocol.writeChunkSize, 4096)
+        after = self.protocol.encodeMessage(self.message('b' * 300, time=50))
+        eq_(len(after), 4 + 300) # a time header and one chunk
+
+    def test_invalid_chunk_size(self):
+        self.assertRaises(ValueError, self.protocol.setChunkSize, 0)
+        self.assertRaises(ValueError, self.protocol.setChunkSize,
+                Protocol.MAX_CHUNK_SIZE + 1)
+
+    def test_duplicates_share_encoding(self):
+        original = self.message('y' * 1000)
+        other = Protocol(None)
+        first = self.protocol.encodeMessage(original.dup())
+        ok_(other.encodeMessage(original.dup()) is first)
+        eq_(len(original.encodings), 1)
+
+    def test_different_headers_not_shared(self):
+        original = self.message('y' * 1000)
+        other = Protocol(None)
+        other.writeChunkSize = 512
+        first = self.protocol.encodeMessage(original.dup())
+        second = other.encodeMessage(original.dup())
+        ok_(first != second)
+        eq_(len(original.encodings), 2)
+
+    def test_replaced_payload_not_shared(self):
+        original = self.message('y' * 1000)
+        self.protocol.encodeMessage(original.dup())
+        replaced = original.dup()
+        replaced.data = 'z' * 1000
+        encoded = Protocol(None).encodeMessage(replaced)
+        ok_('z' * 128 in encoded)
+        ok_('y' not in encoded)
+
+
+class WriteQueueTest(unittest2.TestCase):
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+        self.protocol = Protocol(self.right)
+        self.writes = []
+        write = self.protocol.stream.write
+        def counting_write(data):
+            self.writes.append(len(data))
+            return write(data)
+        self.protocol.stream.write = counting_write
+        self.manager = multitask.TaskManager()
+        self.manager.add(self.protocol.write())
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def message(self, data, time=10):
+        return Message(Header(time=time, size=len(data), type=Message.VIDEO,
+            streamId=1), data)
+
+    def step(self, count=5):
+        for i in range(count):
+            self.manager.run_next(timeout=0)
+
+    def test_idle_writer_sleeps(self):
+        self.step()
+        ok_(not self.manager.has_runnable())
+        ok_(not self.manager.has_timeouts())
+        ok_(not self.manager.has_io_waits())
+
+    def test_wakes_up_for_message(self):
+        self.step()
+        self.protocol.writeMessage(self.message('a' * 10))
+        self.step()
+        eq_(self.left.recv(1024), Header(channel=3, time=10, size=10,
+            type=Message.VIDEO, streamId=1).toBytes(Header.FULL) + 'a' * 10)
+
+    def test_queued_messages_coalesced(self):
+        expected = Protocol(None)
+        messages = [self.message(c * 100, time=10 * (i + 1))
+                for i, c in enumerate('abc')]
+        data = ''.join(expected.encodeMessage(message)
+                for message in messages)
+        for message in messages:
+            self.protocol.writeMessage(message)
+        self.step()
+        eq_(self.writes, [len(data)])
+        eq_(self.left.recv(1024), data)
+
+    def test_close_after_queued_messages(self):
+        self.protocol.writeMessage(self.message('a' * 10))
+        self.protocol.writeMessage(None)
+        self.manager.run()
+        ok_(self.left.recv(1024).endswith('a' * 10))
+        eq_(self.left.recv(1024), '')
+
+    def test_audio_and_control_overtake_queued_video(self):
+        video = self.message('v' * 100)
+        audio = Message(Header(time=10, size=10, type=Message.AUDIO,
+            streamId=1), 'a' * 10)
+        ack = Message()
+        ack.type, ack.data = Message.ACK, struct.pack('>L', 1000)
+        for message in (video, audio, ack):
+            self.protocol.writeMessage(message)
+        expected = Protocol(None)
+        data = ''.join(expected.encodeMessage(message)
+                for message in (ack, audio, video))
+        self.step()
+        eq_(self.left.recv(1024), data)
+
+    def join(self):
+        """Plays a stream whose publisher filled its GOP cache, and returns
+        the server, the publisher and what is in the cache.
+        """
+        server = FlashServer()
+        inst = App()
+        server.clients['live'] = [inst]
+        publisher = Stream(FakeClient())
+        server.publishhandler(publisher, Command(name='publish', id=1,
+            args=['cam', 'live'])).next()
+        metadata = Command(type=Message.DATA, name='onMetaData',
+                args=[{'width': 640.0}]).toMessage()
+        gop = [metadata, video('\x17\x00avc'), audio('\xaf\x00aac'),
+                video('\x17\x01key', 40), audio('\xaf\x01a1', 40),
+                video('\x27\x01inter', 80), audio('\xaf\x01a2', 80)]
+        for message in gop:
+            server.mediahandler(publisher, message)
+        self.protocol.path = 'live'
+        player = Stream(self.protocol)
+        player.id = 1
+        for ignore in server.playhandler(player, Command(name='play', id=2,
+                args=['cam'])):
+            pass
+        return server, publisher, gop
+
+    def received(self):
+        self.step()
+        self.left.setblocking(0)
+        reader = Protocol(None)
+        reader.stream.buffer = bytearray(self.left.recv(64 * 1024))
+        reader.stream.end = len(reader.stream.buffer)
+        received = list(reader.readMessages())
+        eq_(Command.fromMessage(received[0]).args[0].code,
+                'NetStream.Play.Start')
+        return received[1:]
+
+    def test_joining_player_gets_gop_in_order(self):
+        server, publisher, gop = self.join()
+        server.mediahandler(publisher, audio('\xaf\x01live', 120))
+        eq_([m.data for m in self.received()], [m.data for m in gop] +
+                ['\xaf\x01live'])
+
+    def test_control_overtakes_queued_catchup(self):
+        server, publisher, gop = self.join()
+        ack = Message()
+        ack.type, ack.data = Message.WIN_ACK_SIZE, struct.pack('>L', 1000)
+        self.protocol.writeMessage(ack)
+        eq_([(m.type, m.data) for m in self.received()],
+                [(Message.WIN_ACK_SIZE, ack.data)] +
+                [(m.type, m.data) for m in gop])
+
+
+class WriteQueueLanesTest(unittest2.TestCase):
+    def message(self, message_type, data):
+        return Message(Header(size=len(data), type=message_type), data)
+
+    def test_lanes_by_priority(self):
+        queue = WriteQueue()
+        messages = [self.message(message_type, data) for message_type, data
+                in ((Message.DATA, 'd'), (Message.VIDEO, 'v1'),
+                    (Message.AUDIO, 'a1'), (Message.RPC, 'r'),
+                    (Message.VIDEO, 'v2'), (Message.AUDIO, 'a2'),
+                    (Message.CHUNK_SIZE, 'c'), (Message.VIDEO, 'g1'),
+                    (Message.AUDIO, 'g2'))]
+        messages[-2].lane = messages[-1].lane = WriteQueue.CATCHUP
+        for message in messages:
+            queue.append(message)
+        eq_(queue.bytes, 15)
+        order = ['r', 'c', 'g1', 'g2', 'a1', 'a2', 'v1', 'v2', 'd']
+        eq_([m.data for m in queue], order)
+        eq_([queue.popleft().data for i in range(len(queue))], order)
+        eq_(queue.bytes, 0)
+        self.assertRaises(IndexError, queue.popleft)
+
+    def test_close(self):
+        queue = WriteQueue()
+        queue.append(self.message(Message.VIDEO, 'v'))
+        queue.append(None)
+        queue.append(self.message(Message.AUDIO, 'a'))
+        eq_(list(queue), [queue.lanes[WriteQueue.VIDEO][0], None])
+        eq_(queue.popleft().data, 'v')
+        eq_(queue.popleft(), None)
+        eq_(len(queue), 1)
+
+    def test_oldest_media_time(self):
+        queue = WriteQueue()
+        eq_(queue.oldestMediaTime(), None)
+        for message_type, time in ((Message.RPC, 5), (Message.VIDEO, 20),
+                (Message.AUDIO, 30), (Message.VIDEO, 40)):
+            message = self.message(message_type, 'x')
+            message.time = time
+            queue.append(message)
+        eq_(queue.oldestMediaTime(), 20)
+        queue.popleft()
+        queue.popleft()
+        eq_(queue.oldestMediaTime(), 20)
+        queue.popleft()
+        eq_(queue.oldestMediaTime(), 40)
+
+    def test_oldest_media_time_of_catchup(self):
+        queue = WriteQueue()
+        for message_type, time in ((Message.DATA, 0), (Message.VIDEO, 20),
+                (Message.AUDIO, 10)):
+            message = self.message(message_type, 'x')
+            message.time, message.lane = time, WriteQueue.CATCHUP
+            queue.append(message)
+        live = self.message(Message.AUDIO, 'x')
+        live.time = 30
+        queue.append(live)
+        eq_(queue.oldestMediaTime(), 20)
+        queue.popleft()
+        queue.popleft()
+        eq_(queue.oldestMediaTime(), 10)
+
+
+class QueueLimitTest(unittest2.TestCase):
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+        self.protocol = Protocol(self.right)
+        self.protocol.maxQueueBytes, self.protocol.maxQueueTime = 1000, 1000
+        self.player = Stream(self.protocol)
+        self.player.id = 1
+        self.manager = multitask.TaskManager()
+        self.manager.add(self.protocol.write())
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def send(self, message_type, data, time=0):
+        self.player.send(Message(Header(time=time, size=len(data),
+            type=message_type), data))
+
+    def sent(self):
+        return [(m.type, m.data[:2]) for m in self.protocol.writeQueue]
+
+    def drain(self):
+        self.left.setblocking(False)
+        while (self.protocol.writeQueue or self.manager.has_runnable() or
+                self.manager.has_io_waits()):
+            self.manager.run_next(timeout=0)
+            try:
+                self.left.recv(65536)
+            except socket.error:
+                pass
+
+    def test_within_limits(self):
+        for i in range(9):
+            self.send(Message.VIDEO, '\x27\x01' + 'v' * 98, time=i * 10)
+        eq_(len(self.protocol.writeQueue), 9)
+        eq_(self.protocol.writeQueue.bytes, 900)
+        eq_(self.protocol.dropped, {})
+        self.drain()
+        eq_(self.protocol.writeQueue.bytes, 0)
+        eq_(self.protocol.writeQueue.oldestMediaTime(), None)
+
+    def test_video_dropped_to_next_key_frame(self):
+        self.send(Message.VIDEO, '\x17\x01' + 'k' * 1098)
+        self.send(Message.VIDEO, '\x27\x01' + 'v' * 98, time=10)
+        self.send(Message.AUDIO, '\xaf\x01' + 'a' * 8, time=10)
+        self.send(Message.VIDEO, '\x17\x00' + 'h' * 8, time=20)
+        self.send(Message.VIDEO, '\x17\x01' + 'k' * 98, time=30)
+        eq_(self.sent(), [(Message.AUDIO, '\xaf\x01'),
+            (Message.VIDEO, '\x17\x01'), (Message.VIDEO, '\x17\x00')])
+        eq_(self.protocol.dropped, {1: 2})
+        self.drain()
+        self.send(Message.VIDEO, '\x27\x01' + 'v' * 98, time=40)
+        self.send(Message.VIDEO, '\x17\x01' + 'k' * 98, time=50)
+        self.send(Message.VIDEO, '\x27\x01' + 'v' * 98, time=60)
+        eq_(self.sent(), [(Message.VIDEO, '\x17\x01'),
+            (Message.VIDEO, '\x27\x01')])
+        eq_(self.protocol.dropped, {1: 3})
+
+    def test_queued_inter_frames_dropped(self):
+        self.send(Message.VIDEO, '\x17\x01' + 'k' * 98)
+        self.send(Message.VIDEO, '\x27\x01' + 'v' * 398, time=10)
+        self.send(Message.AUDIO, '\xaf\x01' + 'a' * 98, time=10)
+        self.send(Message.VIDEO, '\x27\x01' + 'v' * 398, time=20)
+        self.send(Message.AUDIO, '\xaf\x01' + 'a' * 8, time=20)
+        self.send(Message.VIDEO, '\x27\x01' + 'v' * 98, time=30)
+        eq_(self.sent(), [(Message.AUDIO, '\xaf\x01'),
+            (Message.AUDIO, '\xaf\x01'), (Message.VIDEO, '\x17\x01')])
+        eq_(self.protocol.dropped, {1: 3})
+        eq_(self.protocol.writeQueue.bytes, 210)
+        eq_(self.protocol.writeQueue.oldestMediaTime(), 0)
+        self.drain()
+        eq_(self.protocol.writeQueue.bytes, 0)
+
+    def test_queued_catchup_inter_frames_dropped(self):
+        for data, time in (('\x17\x00' + 'h' * 8, 0),
+                ('\x17\x01' + 'k' * 298, 0), ('\x27\x01' + 'v' * 398, 10),
+                ('\x27\x01' + 'v' * 398, 20)):
+            message = Message(Header(time=time, size=len(data),
+                type=Message.VIDEO), data)
+            message.lane = WriteQueue.CATCHUP
+            self.player.send(message)
+        self.send(Message.VIDEO, '\x27\x01' + 'v' * 198, time=30)
+        eq_(self.sent(), [(Message.VIDEO, '\x17\x00'),
+            (Message.VIDEO, '\x17\x01')])
+        eq_(self.protocol.dropped, {1: 3})
+        eq_(self.protocol.writeQueue.bytes, 310)
+
+    def test_time_limit(self):
+        self.send(Message.AUDIO, '\xaf\x01', time=0)
+        self.send(Message.VIDEO, '\x27\x01', time=500)
+        self.send(Message.VIDEO, '\x27\x01', time=1500)
+        eq_(self.sent(), [(Message.AUDIO, '\xaf\x01')])
+        eq_(self.protocol.dropped, {1: 2})
+
+    def test_disconnect_past_twice_the_limit(self):
+        for i in range(25):
+            self.send(Message.AUDIO, '\xaf\x01' + 'a' * 98, time=i * 10)
+        eq_(list(self.protocol.writeQueue), [None])
+        eq_(self.protocol.writeQueue.bytes, 0)
+        self.manager.run()
+        eq_(self.left.recv(1024), '')
+
+    def test_no_limits(self):
+        self.protocol.maxQueueBytes = self.protocol.maxQueueTime = 0
+        for i in range(50):
+            self.send(Message.VIDEO, '\x27\x01' + 'v' * 98, time=i * 100)
+        eq_(len(self.protocol.writeQueue), 50)
+        eq_(self.protocol.dropped, {})
+
+
+class FakeClient(object):
+    path = 'live'
+
+    def __init__(self):
+        self.written = []
+
+    def writeMessage(self, message):
+        self.written.append(message)
+
+
+class StreamListenerTest(unittest2.TestCase):
+    def setUp(self):
+        self.server = FlashServer()
+        self.inst = App()
+        self.server.clients['live'] = [self.inst]
+        self.publisher = Stream(FakeClient())
+        self.players = [Stream(FakeClient()) for i in range(3)]
+        for player in self.players:
+            player.name = 'cam'
+        self.inst.players['cam'] = list(self.players)
+        self.manager = multitask.TaskManager()
+
+    def media(self, count):
+        return [Message(Header(time=i, size=1, type=(Message.VIDEO if i % 2
+            else Message.AUDIO)), chr(i)) for i in range(count)]
+
+    def feed(self, *messages):
+        def producer():
+            for message in messages:
+                yield self.publisher.queue.put(message)
+        self.manager.add(self.server.streamlistener(self.publisher))
+        self.manager.add(producer())
+        self.manager.run()
+
+    def test_media_reaches_players_in_order(self):
+        self.publisher.name = 'cam'
+        messages = self.media(20)
+        self.feed(*(messages + [None]))
+        for player in self.players:
+            eq_([m.data for m in player.client.written],
+                    [m.data for m in messages])
+
+    def test_no_task_per_message(self):
+        self.publisher.name = 'cam'
+        added = []
+        add, multitask.add = multitask.add, added.append
+        try:
+            self.feed(*(self.media(20) + [None]))
+        finally:
+            multitask.add = add
+        eq_(added, [])
+
+    def test_command_handled_before_later_media(self):
+        publish = Command(name='publish', id=1, args=['cam', 'live'])
+        message = publish.toMessage()
+        message.streamId = 1
+        messages = self.media(5)
+        client = self.publisher.client
+        self.feed(message, *(messages + [None]))
+        eq_(client.written[0].type, Message.RPC)
+        for player in self.players:
+            eq_([m.data for m in player.client.written],
+                    [m.data for m in messages])
+        ok_('cam' not in self.inst.publishers) # closed again
+
+    def test_joining_player_gets_gop(self):
+        publish = Command(name='publish', id=1, args=['cam', 'live'])
+        frames = [video('\x17\x01key'), audio('\xaf\x01a1'),
+                video('\x27\x01inter')]
+        self.feed(publish.toMessage(), video('\x17\x00avc'), *frames)
+        player = Stream(FakeClient())
+        play = Command(name='play', id=2, args=['cam'])
+        self.manager.add(self.server.streamlistener(player))
+        self.manager.add(put(player, play.toMessage()))
+        self.manager.run()
+        written = player.client.written
+        eq_(written[0].type, Message.RPC) # NetStream.Play.Start
+        eq_([m.data for m in written[1:]],
+                ['\x17\x00avc'] + [m.data for m in frames])
+        self.manager.add(put(self.publisher, video('\x27\x01live')))
+        self.manager.run()
+        eq_(written[-1].data, '\x27\x01live')
+
+
+def put(stream, message):
+    yield stream.queue.put(message)
+
+
+def video(data, time=0):
+    return Message(Header(time=time, size=len(data), type=Message.VIDEO),
+            data)
+
+
+def audio(data, time=0):
+    return Message(Header(time=time, size=len(data), type=Message.AUDIO),
+            data)
+
+
+class FLVRecorderTest(unittest2.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def media(self, count):
+        return [Message(Header(time=i * 10, size=2, type=(Message.VIDEO
+            if i % 2 else Message.AUDIO)), chr(i) * 2) for i in range(count)]
+
+    def record(self, flv, messages, name):
+        path = os.path.join(self.directory, name)
+        flv.open(path, 'record')
+        for message in messages:
+            flv.write(message)
+        flv.close()
+        return path
+
+    def test_same_file_as_flv(self):
+        messages = self.media(50)
+        messages.insert(3, Command(name='onStatus').toMessage())
+        expected = open(self.record(FLV(), messages, 'flv.flv')).read()
+        recorder = FLVRecorder(syncInterval=0.01)
+        path = self.record(recorder, messages, 'recorder.flv')
+        recorder.thread.join(5)
+        ok_(not recorder.thread.is_alive())
+        eq_(open(path).read(), expected)
+        eq_(recorder.written, 50)
+        eq_(recorder.dropped, 0)
+        ok_(recorder.batches >= 1)
+
+    def test_drops_when_queue_is_full(self):
+        recorder = FLVRecorder(queueSize=10) # not opened, so nothing drains it
+        for message in self.media(15):
+            recorder.write(message)
+        eq_(recorder.depth(), 10)
+        eq_(recorder.dropped, 5)
+        recorder.close()
+        ok_(recorder.closed)
+
+    def test_stats(self):
+        recorder = FLVRecorder(syncInterval=0.01)
+        self.record(recorder, self.media(20), 'stats.flv')
+        recorder.thread.join(5)
+        stats = recorder.stats()
+        eq_((stats['written'], stats['dropped'], stats['queued']), (20, 0, 0))
+        eq_(stats['batches'], recorder.batches)
+        ok_(0 <= stats['max_write_time'] <= stats['write_time'])
+        ok_(stats['closed'])
+
+class FLVIndexTest(unittest2.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cam.flv')
+        flv = FLV().open(self.path, 'record')
+        flv.write(Message(Header(time=0, size=3, type=Message.VIDEO),
+            '\x17\x00\x00')) # AVC sequence header
+        for i in range(100): # a key frame a second, audio in between
+            flv.write(Message(Header(time=i * 100, size=3,
+                type=Message.VIDEO), ('\x27' if i % 10 else '\x17') + '\x01' +
+                chr(i)))
+            flv.write(Message(Header(time=i * 100 + 50, size=2,
+                type=Message.AUDIO), '\xaf' + chr(i)))
+        flv.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def play(self, offset=None, count=3):
+        flv = FLV().open(self.path)
+        if offset is not None:
+            flv.seek(offset)
+        stream = Stream(FakeClient())
+        stream.id = 1
+        reader = flv.reader(stream)
+        while len(stream.client.written) < count:
+            reader.next()
+        flv.close()
+        for ignore in reader: # ends now that the file is closed
+            pass
+        return [m.data for m in stream.client.written[:count]]
+
+    def test_recording_writes_index(self):
+        data = open(self.path + FLV.INDEX).read()
+        eq_(len(data), 10 * FLV.INDEX_ENTRY.size)
+        flv = open(self.path, 'rb').read()
+        for i in range(10):
+            ts, pos = FLV.INDEX_ENTRY.unpack_from(data,
+                    i * FLV.INDEX_ENTRY.size)
+            eq_(ts, i * 1000)
+            eq_(flv[pos], chr(Message.VIDEO))
+            eq_(flv[pos + 11:pos + 14], '\x17\x01' + chr(i * 10))
+
+    def test_reads_every_tag(self):
+        eq_(len(self.play(count=202)), 202)
+
+    def test_seek_to_key_frame_before(self):
+        eq_(self.play(3500), ['\x17\x01\x1e', '\xaf\x1e', '\x27\x01\x1f'])
+
+    def test_seek_to_first_key_frame_keeps_headers(self):
+        eq_(self.play(500)[1], '\x17\x00\x00') # after the metadata
+
+    def test_seek_without_sidecar(self):
+        os.unlink(self.path + FLV.INDEX)
+        eq_(self.play(3500), ['\x17\x01\x1e', '\xaf\x1e', '\x27\x01\x1f'])
+
+    def test_stale_sidecar_entries_are_ignored(self):
+        open(self.path + FLV.INDEX, 'wb').write(FLV.INDEX_ENTRY.pack(3000, 7))
+        eq_(self.play(3500), ['\x17\x01\x1e', '\xaf\x1e', '\x27\x01\x1f'])
+
+class GopCacheTest(unittest2.TestCase):
+    def setUp(self):
+        self.cache = GopCache(100)
+
+    def data(self):
+        return [m.data for m in self.cache.messages()]
+
+    def test_nothing_before_key_frame(self):
+        self.cache.add(video('\x27\x01inter'))
+        self.cache.add(audio('\xaf\x01a'))
+        eq_(self.data(), [])
+
+    def test_key_frame_starts_group(self):
+        self.cache.add(video('\x17\x01key1'))
+        self.cache.add(video('\x27\x01inter'))
+        self.cache.add(video('\x17\x01key2'))
+        self.cache.add(audio('\xaf\x01a'))
+        eq_(self.data(), ['\x17\x01key2', '\xaf\x01a'])
+
+    def test_headers_and_metadata_first(self):
+        metadata = Message(Header(type=Message.DATA), 'onMetaData')
+        self.cache.add(video('\x17\x01key'))
+        self.cache.add(video('\x17\x00avc'))
+        self.cache.add(audio('\xaf\x00aac'))
+        self.cache.add(metadata)
+        eq_(self.data(), ['onMetaData', '\x17\x00avc', '\xaf\x00aac',
+            '\x17\x01key'])
+
+    def test_oversized_group_dropped(self):
+        self.cache.add(video('\x17\x00avc'))
+        self.cache.add(video('\x17\x01' + 'k' * 60))
+        self.cache.add(video('\x27\x01' + 'i' * 60))
+        eq_(self.data(), ['\x17\x00avc'])
+        self.cache.add(video('\x27\x01inter'))
+        eq_(self.data(), ['\x17\x00avc'])
+        self.cache.add(video('\x17\x01key'))
+        eq_(self.data(), ['\x17\x00avc', '\x17\x01key'])
+
+    def test_chunked_forms_not_cached(self):
+        key = video('\x17\x01' + 'k' * 50)
+        self.cache.add(key)
+        live = key.dup()
+        Protocol(None).encodeMessage(live)
+        eq_(len(key.encodings), 1)
+        cached = self.cache.messages()
+        eq_([m.encodings for m in cached], [None])
+        eq_(cached[0].data, key.data)
+        ok_(cached[0].header is not key.header)
+        Protocol(None).encodeMessage(cached[0].dup())
+        eq_([m.encodings for m in self.cache.messages()], [None])
+
+
+class EventTest(unittest2.TestCase):
+    def setUp(self):
+        self.manager = multitask.TaskManager()
+        self.event = multitask.Event()
+        self.woken = []
+
+    def waiter(self, timeout=None):
+        try:
+            yield self.event.wait(timeout=timeout)
+            self.woken.append(True)
+        except multitask.Timeout:
+            self.woken.append(multitask.Timeout)
+
+    def test_set_wakes_waiter(self):
+        self.manager.add(self.waiter())
+        self.manager.run_next(timeout=0)
+        eq_(self.woken, [])
+        self.event.set()
+        self.manager.run()
+        eq_(self.woken, [True])
+        ok_(not self.event.is_set())
+
+    def test_set_before_wait(self):
+        self.event.set()
+        self.manager.add(self.waiter())
+        self.manager.run()
+        eq_(self.woken, [True])
+        ok_(not self.event.is_set())
+
+    def test_timeout(self):
+        self.manager.add(self.waiter(timeout=0.01))
+        self.manager.run()
+        eq_(self.woken, [multitask.Timeout])
+        self.event.set()
+        ok_(self.event.is_set())
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Overhead of the tunnel traffic counters.
+
+Times a read_into()/write_from() round trip of a tunnel connection over a
+socketpair, which includes the counter updates, against the counter updates
+on their own, and reports the share of the hot path that goes to counting:
+
+    $ python benchmarks/counter_overhead.py --size 4096
+
+"""
+import socket
+import time
+import timeit
+from optparse import OptionParser
+
+from astral.net.buffer import RingBuffer
+from astral.net.tunnel import Tunnel, BufferedDispatcher
+
+COUNTER_UPDATES = """
+counter.bytes_in += received
+counter.reads += 1
+buffered = len(buffer)
+if buffered > counter.peak_buffered:
+    counter.peak_buffered = buffered
+counter.bytes_out += received
+counter.writes += 1
+"""
+
+
+def round_trip(size, count):
+    tunnel = Tunnel('127.0.0.1', 1, bind_ip='127.0.0.1')
+    left, right = socket.socketpair()
+    connection = BufferedDispatcher(tunnel, left)
+    connection.read_size.size = size
+    buffer = RingBuffer(size * 4)
+    payload = 'x' * size
+    start = time.time()
+    for i in range(count):
+        right.send(payload)
+        connection.read_into(buffer)
+        connection.write_from(buffer)
+        right.recv(size)
+    elapsed = time.time() - start
+    connection.close()
+    right.close()
+    tunnel.close()
+    return elapsed / count
+
+
+def counter_updates(size, count):
+    setup = ("from astral.net.counters import TrafficCounter\n"
+            "counter = TrafficCounter()\n"
+            "buffer = 'x' * %d\nreceived = %d" % (size, size))
+    return min(timeit.repeat(COUNTER_UPDATES, setup, repeat=3,
+        number=count)) / count
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-s', '--size', dest='size', type='int', default=4096,
+            help='Bytes moved per read/write')
+    parser.add_option('-n', '--count', dest='count', type='int',
+            default=100000, help='Round trips to time')
+    options, args = parser.parse_args()
+
+    per_trip = round_trip(options.size, options.count)
+    per_update = counter_updates(options.size, options.count)
+    print "read_into + write_from round trip: %8.2f us" % (per_trip * 1e6)
+    print "counter updates in that trip:      %8.2f us" % (per_update * 1e6)
+    print "counting share of the hot path:    %8.2f %%" % (
+            per_update / per_trip * 100)
+
+
+if __name__ == '__main__':
+    main()
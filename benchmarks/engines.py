@@ -0,0 +1,148 @@
+"""
+Tunnel engines shared by the tunnel benchmarks.
+
+'legacy' is the tunnel as it was before the ring buffers and the IOLoop, kept
+around for comparison: asyncore channels polled with select(), 512 byte reads
+and str buffers. 'ring' is astral.net.tunnel on the Tornado IOLoop, and
+'splice' the same with splice(2) forwarding.
+
+"""
+import asyncore
+import socket
+import time
+
+from tornado import ioloop
+
+from astral.net import tunnel
+
+
+class LegacyTunnel(asyncore.dispatcher, object):
+    """The original tunnel: 512 byte reads, str concatenation and slicing of
+    the whole buffer for every write.
+    """
+    def __init__(self, source_ip, source_port):
+        super(LegacyTunnel, self).__init__()
+        self.source_ip = source_ip
+        self.source_port = source_port
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(('127.0.0.1', 0))
+        self.listen(5)
+
+    @property
+    def bind_port(self):
+        return self.socket.getsockname()[1]
+
+    def handle_accept(self):
+        conn, addr = self.accept()
+        LegacySender(LegacyReceiver(conn), self.source_ip, self.source_port)
+
+
+class LegacyReceiver(asyncore.dispatcher, object):
+    def __init__(self, connection):
+        super(LegacyReceiver, self).__init__(connection)
+        self.from_remote_buffer = ''
+        self.to_remote_buffer = ''
+        self.sender = None
+
+    def handle_connect(self):
+        pass
+
+    def handle_read(self):
+        self.from_remote_buffer += self.recv(512)
+
+    def writable(self):
+        return (len(self.to_remote_buffer) > 0)
+
+    def handle_write(self):
+        sent = self.send(self.to_remote_buffer)
+        self.to_remote_buffer = self.to_remote_buffer[sent:]
+
+    def handle_close(self):
+        self.close()
+        if self.sender:
+            self.sender.close()
+
+
+class LegacySender(asyncore.dispatcher, object):
+    def __init__(self, receiver, destination_ip, destination_port):
+        super(LegacySender, self).__init__()
+        self.receiver = receiver
+        receiver.sender = self
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((destination_ip, destination_port))
+
+    def handle_connect(self):
+        pass
+
+    def handle_read(self):
+        self.receiver.to_remote_buffer += self.recv(512)
+
+    def writable(self):
+        return len(self.receiver.from_remote_buffer) > 0
+
+    def handle_write(self):
+        sent = self.send(self.receiver.from_remote_buffer)
+        self.receiver.from_remote_buffer = self.receiver.from_remote_buffer[
+                sent:]
+
+    def handle_close(self):
+        self.close()
+        self.receiver.close()
+
+
+class AsyncoreEngine(object):
+    def tunnel(self, source_ip, source_port):
+        return LegacyTunnel(source_ip, source_port)
+
+    def run_until(self, condition):
+        while not condition():
+            asyncore.loop(timeout=0.01, count=1)
+
+    def run_for(self, seconds):
+        deadline = time.time() + seconds
+        self.run_until(lambda: time.time() >= deadline)
+
+    def close(self, tunnels):
+        for t in tunnels:
+            t.close()
+        asyncore.close_all()
+
+
+class IOLoopEngine(object):
+    splice = False
+
+    def __init__(self):
+        self.io_loop = ioloop.IOLoop.instance()
+
+    def tunnel(self, source_ip, source_port):
+        return tunnel.Tunnel(source_ip, source_port, bind_ip='127.0.0.1',
+                splice=self.splice, io_loop=self.io_loop)
+
+    def run_until(self, condition):
+        def check():
+            if condition():
+                self.io_loop.stop()
+        checker = ioloop.PeriodicCallback(check, 10, self.io_loop)
+        checker.start()
+        self.io_loop.start()
+        checker.stop()
+
+    def run_for(self, seconds):
+        self.io_loop.add_timeout(time.time() + seconds, self.io_loop.stop)
+        self.io_loop.start()
+
+    def close(self, tunnels):
+        for t in tunnels:
+            t.handle_close()
+
+
+class SpliceEngine(IOLoopEngine):
+    splice = True
+
+
+ENGINES = {
+    'legacy': AsyncoreEngine,
+    'ring': IOLoopEngine,
+    'splice': SpliceEngine,
+}
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+Encoding and decoding of the AMF payloads an RTMP server deals with.
+
+Times astral.rtmp.amf on a suite of typical payloads: the commands of a
+connection's life as Command messages (connect, its _result, createStream,
+play, publish, onStatus), onMetaData with and without the keyframes index
+some tools add to it, a list of objects like the one a shared object update
+carries, and the same values in AMF3. Reports, for each payload, its size and
+the microseconds it took to encode and to decode, and checks that what is
+decoded is what was encoded:
+
+    $ python benchmarks/rtmp_amf.py --count 2000
+
+A payload the codec cannot round trip is reported as failing rather than
+timed.
+
+"""
+import time
+from optparse import OptionParser
+
+from astral.rtmp.amf import AMF0, AMF3, BytesIO, Object
+from astral.rtmp.rtmp import Command, Message
+
+
+def status(code, description):
+    return Object(level='status', code=code, description=description,
+            details=None)
+
+
+def metadata(keyframes=0):
+    data = {'duration': 7200.0, 'width': 1280.0, 'height': 720.0,
+            'videodatarate': 2000.0, 'framerate': 25.0, 'videocodecid': 7.0,
+            'audiodatarate': 128.0, 'audiosamplerate': 44100.0,
+            'audiosamplesize': 16.0, 'stereo': True, 'audiocodecid': 10.0,
+            'encoder': 'Lavf52.87.1', 'filesize': 1.9e9}
+    if keyframes:
+        data['keyframes'] = Object(
+                times=[i * 2.0 for i in range(keyframes)],
+                filepositions=[13.0 + i * 524288 for i in range(keyframes)])
+    return data
+
+
+def peers(count):
+    return [Object(id='peer%d' % i, ip='10.0.%d.%d' % (i / 256, i % 256),
+        port=1935.0, online=True) for i in range(count)]
+
+COMMANDS = (
+    ('connect', Command(name='connect', id=1.0, cmdData=Object(app='live',
+        flashVer='WIN 10,0,32,18', swfUrl=None,
+        tcUrl='rtmp://127.0.0.1:1935/live', fpad=False, capabilities=15.0,
+        audioCodecs=3191.0, videoCodecs=252.0, videoFunction=1.0,
+        pageUrl=None, objectEncoding=0.0))),
+    ('_result', Command(name='_result', id=1.0, cmdData=Object(
+        fmsVer='FMS/3,5,1,516', capabilities=31.0, mode=1.0),
+        args=[Object(level='status', code='NetConnection.Connect.Success',
+            description='Connection succeeded.', objectEncoding=0.0,
+            details=None)])),
+    ('createStream', Command(name='createStream', id=2.0)),
+    ('play', Command(name='play', id=0.0, args=['cam', -2.0])),
+    ('publish', Command(name='publish', id=0.0, args=['cam', 'live'])),
+    ('onStatus', Command(name='onStatus', id=0.0, args=[status(
+        'NetStream.Play.Start', 'cam')])),
+    ('onMetaData', Command(type=Message.DATA, name='onMetaData',
+        args=[metadata()])),
+    ('keyframes', Command(type=Message.DATA, name='onMetaData',
+        args=[metadata(3600)])),
+)
+VALUES = (
+    ('peers', lambda: peers(500)),
+    ('metadata', metadata),
+)
+
+
+def same(a, b):
+    """Whether b is what decoding the encoding of a gives."""
+    if isinstance(a, Object):
+        a = dict((k, v) for k, v in a.__dict__.items()
+                if not k.startswith('_'))
+    if isinstance(b, Object):
+        b = dict((k, v) for k, v in b.__dict__.items()
+                if not k.startswith('_'))
+    if isinstance(a, dict) and isinstance(b, dict):
+        return (sorted(a) == sorted(b) and
+                all(same(a[k], b[k]) for k in a))
+    if isinstance(a, (list, tuple)) and isinstance(b, list):
+        return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def timed(count, function):
+    start = time.time()
+    for i in xrange(count):
+        result = function()
+    return (time.time() - start) / count, result
+
+
+def command(count, cmd):
+    elapsed, message = timed(count, cmd.toMessage)
+    decoded_elapsed, decoded = timed(count,
+            lambda: Command.fromMessage(message))
+    ok = (decoded.name == cmd.name and
+            same(list(decoded.args), list(cmd.args)) and
+            (message.type != Message.RPC or
+                same(decoded.cmdData, cmd.cmdData)))
+    return len(message.data), elapsed, decoded_elapsed, ok
+
+
+def value(count, codec, data):
+    def encode():
+        output = BytesIO()
+        codec(output).write(data)
+        output.seek(0)
+        return output.read()
+    elapsed, encoded = timed(count, encode)
+    decoded_elapsed, decoded = timed(count, lambda: codec(encoded).read())
+    return len(encoded), elapsed, decoded_elapsed, same(data, decoded)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--count', dest='count', type='int',
+            default=1000, help='Times each payload is encoded and decoded')
+    options, args = parser.parse_args()
+
+    cases = [('amf0', name, command, cmd) for name, cmd in COMMANDS]
+    for codec_name, codec in (('amf0', AMF0), ('amf3', AMF3)):
+        for name, make in VALUES:
+            cases.append((codec_name, name,
+                lambda count, data, codec=codec: value(count, codec, data),
+                make()))
+    print "%-6s %-14s %8s %12s %12s" % ("codec", "payload", "bytes",
+            "encode us", "decode us")
+    for codec_name, name, run, data in cases:
+        count = max(1, options.count / 100) if name in ('keyframes',
+                'peers') else options.count
+        try:
+            size, encode, decode, ok = run(count, data)
+        except Exception, e:
+            size, ok = 0, False
+        if ok:
+            print "%-6s %-14s %8d %12.1f %12.1f" % (codec_name, name, size,
+                    encode * 1e6, decode * 1e6)
+        else:
+            print "%-6s %-14s %8s %12s %12s" % (codec_name, name, '-',
+                    'fails', 'fails')
+
+
+if __name__ == '__main__':
+    main()
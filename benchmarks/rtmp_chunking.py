@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Wire overhead of chunking the media of an FLV for an RTMP player.
+
+Sends the audio and video tags of an FLV (a canned one by default, see
+rtmp_parse.py) through Protocol.write() over a socket, one message at a time as
+a live stream would, and reports the bytes that went out, how many of them
+were chunk headers, and the send() calls it took. The original setup, 128 byte
+chunks with audio and video sharing the chunk stream of their message stream,
+is compared with the negotiated 4096 byte chunks (see FlashServer.CHUNK_SIZE)
+and audio and video on chunk streams of their own:
+
+    $ python benchmarks/rtmp_chunking.py --seconds 60
+    $ python benchmarks/rtmp_chunking.py --chunk-size 65536
+
+"""
+import os
+import socket
+import tempfile
+import threading
+from optparse import OptionParser
+
+from astral.rtmp import multitask
+from astral.rtmp.rtmp import FlashServer, Header, Message, Protocol
+from rtmp_parse import CHANNELS, flv_tags, make_flv
+
+
+class SharedChunkStreamProtocol(Protocol):
+    """Protocol with a chunk stream per message stream, as it was."""
+    def chunkStream(self, message):
+        if message.streamId not in self.lastWriteHeaders:
+            self.lastWriteHeaders[message.streamId] = Header(
+                    self.nextChannelId)
+            self.nextChannelId += 1
+        return self.lastWriteHeaders[message.streamId]
+
+
+class CountingSocket(object):
+    def __init__(self, sock):
+        self.sock, self.sends = sock, 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, data):
+        self.sends += 1
+        return self.sock.send(data)
+
+    def close(self):
+        self.sock.close()
+
+
+def drain(sock, received):
+    while True:
+        data = sock.recv(256 * 1024)
+        if not data:
+            break
+        received.append(len(data))
+    sock.close()
+
+
+def send_all(tags, protocol_class, chunk_size):
+    left, right = socket.socketpair()
+    received = []
+    reader = threading.Thread(target=drain, args=(left, received))
+    reader.start()
+    sock = CountingSocket(right)
+    protocol = protocol_class(sock)
+    manager = multitask.TaskManager()
+    manager.add(protocol.write())
+    if chunk_size != protocol.writeChunkSize:
+        protocol.setChunkSize(chunk_size)
+    payload = 0
+    for tag_type, timestamp, data in tags:
+        protocol.writeMessage(Message(Header(channel=CHANNELS[tag_type],
+            time=timestamp, size=len(data), type=tag_type, streamId=1), data))
+        payload += len(data)
+        while protocol.writeQueue or manager.has_runnable():
+            manager.run_next()
+    protocol.writeMessage(None)
+    manager.run()
+    reader.join()
+    return protocol.stream.bytesWritten, payload, sock.sends
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-f', '--flv', dest='flv',
+            help='FLV file to send instead of the canned one')
+    parser.add_option('-t', '--seconds', dest='seconds', type='int',
+            default=60, help='Length of the canned FLV')
+    parser.add_option('-c', '--chunk-size', dest='chunk_size', type='int',
+            default=FlashServer.CHUNK_SIZE, help='Negotiated chunk size')
+    options, args = parser.parse_args()
+
+    path = options.flv
+    if not path:
+        fd, path = tempfile.mkstemp(suffix='.flv')
+        os.close(fd)
+        make_flv(path, options.seconds)
+    try:
+        tags = flv_tags(path)
+    finally:
+        if not options.flv:
+            os.unlink(path)
+
+    print "%d messages" % len(tags)
+    print "%-28s %12s %12s %10s %8s" % ("setup", "wire bytes",
+            "header bytes", "overhead", "sends")
+    for name, protocol_class, chunk_size in (
+            ('128, shared chunk stream', SharedChunkStreamProtocol,
+                Protocol.DEFAULT_CHUNK_SIZE),
+            ('128, chunk stream per type', Protocol,
+                Protocol.DEFAULT_CHUNK_SIZE),
+            ('%d, chunk stream per type' % options.chunk_size, Protocol,
+                options.chunk_size)):
+        wire, payload, sends = send_all(tags, protocol_class, chunk_size)
+        print "%-28s %12d %12d %9.2f%% %8d" % (name, wire, wire - payload,
+                (wire - payload) * 100.0 / payload, sends)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""
+The RTMP server on the multitask scheduler against the one on the IOLoop.
+
+Runs FlashServer, or EventedFlashServer (see astral.rtmp.evented), in a
+process of its own and connects --players players to it that play a stream.
+Then publishes the tags of an FLV (a canned one by default, see rtmp_parse.py)
+to that stream as fast as the server takes them, in 4096 byte chunks as
+publishing tools send them. Reports the time it took until every player had
+every tag, and the CPU time of the server process, from its start to the
+players hanging up, per message it took in and per message it sent out:
+
+    $ python benchmarks/rtmp_engines.py --players 1 --players 10 --players 50
+
+The publisher and the players run on a select() loop in this process and
+decode what they get with Protocol, which is slower than the server at it, so
+past a few players the time it took says more about them than about the
+server. The write queue limits of the server are off, so that it drops nothing
+for a player this process is late to read.
+
+"""
+import multiprocessing
+import os
+import resource
+import select
+import socket
+import struct
+import tempfile
+import time
+from optparse import OptionParser
+
+from astral.rtmp import amf, multitask
+from astral.rtmp.rtmp import (Command, FlashServer, Header, Message,
+        Protocol)
+from rtmp_parse import CHANNELS, flv_tags, make_flv
+
+
+def multitask_engine(port):
+    server = FlashServer()
+    server.queueBytes = server.queueTime = 0
+    server.start('127.0.0.1', 0)
+    port.send(server.sock.getsockname()[1])
+    multitask.run()
+
+
+def ioloop_engine(port):
+    from tornado import ioloop
+    from astral.rtmp.evented import EventedFlashServer
+    server = EventedFlashServer()
+    server.queueBytes = server.queueTime = 0
+    server.start('127.0.0.1', 0)
+    port.send(server.sock.getsockname()[1])
+    ioloop.IOLoop.instance().start()
+
+ENGINES = {'multitask': multitask_engine, 'ioloop': ioloop_engine}
+
+
+class Peer(object):
+    """One end of an RTMP connection to the server."""
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.protocol = Protocol(self.sock)
+        self.output = ''
+        self.media = 0 # audio, video and data messages received
+        ping = os.urandom(Protocol.PING_SIZE)
+        self.sock.sendall('\x03' + ping)
+        self.receive_bytes(2 * Protocol.PING_SIZE + 1)
+        self.sock.sendall(ping)
+        self.call('connect', cmdData=amf.Object(app='live',
+            objectEncoding=0.0))
+        self.wait_for('_result')
+        self.call('createStream')
+        self.streamId = int(self.wait_for('_result').args[0])
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def receive(self):
+        stream = self.protocol.stream
+        stream._reserve(self.protocol.needed)
+        received = stream._recv_into()
+        if not received:
+            raise EOFError
+        stream.end += received
+
+    def receive_bytes(self, count):
+        stream = self.protocol.stream
+        while len(stream) < count:
+            self.receive()
+        stream.consumed(count)
+
+    def messages(self):
+        for message in self.protocol.readMessages():
+            if message.header.channel == Protocol.PROTOCOL_CHANNEL_ID:
+                self.protocol.protocolMessage(message)
+            elif message.type in CHANNELS:
+                self.media += 1
+            yield message
+
+    def wait_for(self, name):
+        while True:
+            for message in self.messages():
+                if message.type == Message.RPC:
+                    cmd = Command.fromMessage(message)
+                    if cmd.name == name or cmd.name == 'onStatus' and \
+                            cmd.args[0].code == name:
+                        return cmd
+            self.receive()
+
+    def encode(self, message, streamId=0):
+        message.streamId = streamId
+        return self.protocol.encodeMessage(message)
+
+    def call(self, name, *args, **kwargs):
+        self.sock.sendall(self.encode(Command(name=name, id=1,
+            cmdData=kwargs.get('cmdData'), args=list(args)).toMessage(),
+            kwargs.get('streamId', 0)))
+
+    def read(self):
+        self.receive()
+        for message in self.messages():
+            pass
+
+    def write(self):
+        sent = self.sock.send(buffer(self.output, 0, 256 * 1024))
+        self.output = self.output[sent:]
+
+
+def run(tags, players, engine):
+    parent, child = multiprocessing.Pipe()
+    cpu_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    server = multiprocessing.Process(target=ENGINES[engine], args=(child,))
+    server.start()
+    port = parent.recv()
+    try:
+        peers = []
+        for i in range(players):
+            peer = Peer(port)
+            peer.call('play', 'cam', streamId=peer.streamId)
+            peer.wait_for('NetStream.Play.Start')
+            peers.append(peer)
+        publisher = Peer(port)
+        publisher.call('publish', 'cam', 'live', streamId=publisher.streamId)
+        publisher.wait_for('NetStream.Publish.Start')
+        chunk_size = Message()
+        chunk_size.type, chunk_size.data = Message.CHUNK_SIZE, struct.pack(
+                '>L', 4096)
+        publisher.output = publisher.encode(chunk_size) + ''.join(
+                publisher.encode(Message(Header(channel=CHANNELS[tag_type],
+                    time=timestamp, size=len(data), type=tag_type), data),
+                    publisher.streamId)
+                for tag_type, timestamp, data in tags)
+
+        start = time.time()
+        for peer in peers + [publisher]:
+            peer.sock.setblocking(0)
+        waiting = list(peers)
+        while waiting:
+            readable, writable, ignore = select.select(peers + [publisher],
+                    [publisher] if publisher.output else [], [], 5)
+            if not readable and not writable:
+                raise RuntimeError("The server stopped sending")
+            for peer in readable:
+                peer.read()
+            for peer in writable:
+                peer.write()
+            waiting = [peer for peer in waiting if peer.media < len(tags)]
+        elapsed = time.time() - start
+        for peer in peers + [publisher]:
+            peer.sock.close()
+    finally:
+        server.terminate()
+        server.join()
+    cpu_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (cpu_after.ru_utime + cpu_after.ru_stime - cpu_before.ru_utime -
+            cpu_before.ru_stime)
+    return elapsed, cpu
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-f', '--flv', dest='flv',
+            help='FLV file to publish instead of the canned one')
+    parser.add_option('-t', '--seconds', dest='seconds', type='int',
+            default=60, help='Length of the canned FLV')
+    parser.add_option('-n', '--players', dest='players', type='int',
+            action='append', help='Players of the stream (repeatable), '
+            'default 1, 10 and 50')
+    parser.add_option('-e', '--engine', dest='engines', action='append',
+            choices=ENGINES.keys(), help='Engine to benchmark (repeatable), '
+            'default all of %s' % ', '.join(sorted(ENGINES)))
+    options, args = parser.parse_args()
+
+    path = options.flv
+    if not path:
+        fd, path = tempfile.mkstemp(suffix='.flv')
+        os.close(fd)
+        make_flv(path, options.seconds)
+    try:
+        tags = flv_tags(path)
+    finally:
+        if not options.flv:
+            os.unlink(path)
+
+    print "%d messages, %.1f MB" % (len(tags),
+            sum(len(data) for t, ts, data in tags) / 1048576.0)
+    print "%-10s %8s %10s %10s %12s %12s" % ("engine", "players", "time s",
+            "cpu s", "us/message", "us/sent")
+    for players in options.players or [1, 10, 50]:
+        for name in options.engines or sorted(ENGINES):
+            elapsed, cpu = run(tags, players, name)
+            print "%-10s %8d %10.2f %10.2f %12.1f %12.2f" % (name, players,
+                    elapsed, cpu, cpu / len(tags) * 1e6,
+                    cpu / (len(tags) * players) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
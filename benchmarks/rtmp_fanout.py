@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Fan-out benchmark for media messages in astral.rtmp.rtmp.
+
+Replays the audio and video tags of an FLV (a canned one by default, see
+rtmp_parse.py) the way FlashServer.mediahandler hands them out: every message
+is duplicated for each player and chunked by that player's Protocol. Reports
+the CPU time per message and per message and player, for the shared chunked
+forms that are built once per distinct set of chunk headers against the
+original chunking of every copy:
+
+    $ python benchmarks/rtmp_fanout.py --players 1 --players 10 --players 50
+
+Sending is left out; the chunks would go out through views into the shared
+bytes either way.
+
+"""
+import os
+import tempfile
+import time
+from optparse import OptionParser
+
+from astral.rtmp.rtmp import Header, Message, Protocol
+from rtmp_parse import CHANNELS, flv_tags, make_flv
+
+
+def legacy_encode(protocol, message):
+    """Protocol.write as it was, minus the writing: the payload is copied
+    for the player and chunked by slicing and concatenation.
+    """
+    message = Message(message.header.dup(), message.data[:])
+    if protocol.lastWriteHeaders.has_key(message.streamId):
+        header = protocol.lastWriteHeaders[message.streamId]
+    else:
+        header, protocol.nextChannelId = (Header(protocol.nextChannelId),
+                protocol.nextChannelId + 1)
+        protocol.lastWriteHeaders[message.streamId] = header
+    if (header.streamId != message.streamId or header.time == 0
+            or message.time <= header.time):
+        header.streamId, header.type, header.size, header.time, header.delta = (
+                message.streamId, message.type, message.size, message.time,
+                message.time)
+        control = Header.FULL
+    elif header.size != message.size or header.type != message.type:
+        header.type, header.size, header.time, header.delta = (message.type,
+                message.size, message.time, message.time - header.time)
+        control = Header.MESSAGE
+    else:
+        header.time, header.delta = message.time, message.time - header.time
+        control = Header.TIME
+    hdr = Header(channel=header.channel, time=header.delta
+            if control in (Header.MESSAGE, Header.TIME) else header.time,
+            size=header.size, type=header.type, streamId=header.streamId)
+    data = ''
+    while len(message.data) > 0:
+        data += hdr.toBytes(control)
+        count = min(protocol.writeChunkSize, len(message.data))
+        data += message.data[:count]
+        message.data = message.data[count:]
+        control = Header.SEPARATOR
+    return data
+
+
+def shared_encode(protocol, message):
+    return protocol.encodeMessage(message.dup())
+
+ENCODERS = {'shared': shared_encode, 'legacy': legacy_encode}
+
+
+def fan_out(messages, players, encode):
+    protocols = [Protocol(None) for i in range(players)]
+    start = time.clock()
+    for message in messages:
+        for protocol in protocols:
+            encode(protocol, message)
+    return time.clock() - start
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-f', '--flv', dest='flv',
+            help='FLV file to replay instead of the canned one')
+    parser.add_option('-t', '--seconds', dest='seconds', type='int',
+            default=30, help='Length of the canned FLV')
+    parser.add_option('-n', '--players', dest='players', type='int',
+            action='append', help='Players to fan out to (repeatable), '
+            'default 1, 10 and 50')
+    options, args = parser.parse_args()
+
+    path = options.flv
+    if not path:
+        fd, path = tempfile.mkstemp(suffix='.flv')
+        os.close(fd)
+        make_flv(path, options.seconds)
+    try:
+        tags = flv_tags(path)
+    finally:
+        if not options.flv:
+            os.unlink(path)
+
+    print "%d messages, %d bytes" % (len(tags),
+            sum(len(data) for tag_type, timestamp, data in tags))
+    print "%-8s %8s %10s %14s %20s" % ("encoder", "players", "cpu s",
+            "us/message", "us/message/player")
+    for players in options.players or [1, 10, 50]:
+        for name in sorted(ENCODERS):
+            # fresh messages every run, the shared encodings stick to them
+            messages = [Message(Header(channel=CHANNELS[tag_type],
+                time=timestamp, size=len(data), type=tag_type, streamId=1),
+                data) for tag_type, timestamp, data in tags]
+            cpu = fan_out(messages, players, ENCODERS[name])
+            print "%-8s %8d %10.2f %14.2f %20.2f" % (name, players, cpu,
+                    cpu / len(messages) * 1e6,
+                    cpu / len(messages) / players * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Idle cost and latency of the RTMP writer tasks in astral.rtmp.rtmp.
+
+Starts the Protocol.write() task of --players connections with nothing to
+send, and reports the CPU the task manager burns over --seconds of idling,
+then the time from writeMessage() to the bytes arriving at the other end of a
+socket for one more, busy, connection. A listening socket stands in for the
+server's. The current writer, which sleeps until writeMessage() wakes it, is
+compared with the original one that polled its queue every 10 ms:
+
+    $ python benchmarks/rtmp_idle.py --players 1000 --seconds 5
+
+The idle writers never touch their socket, so they are given none.
+
+"""
+import os
+import Queue
+import socket
+import time
+from optparse import OptionParser
+
+from astral.rtmp import multitask
+from astral.rtmp.rtmp import ConnectionClosed, Header, Message, Protocol
+
+
+class PollingProtocol(Protocol):
+    """Protocol.write as it was, polling a Queue.Queue every 10 ms."""
+    def __init__(self, sock):
+        Protocol.__init__(self, sock)
+        self.writeQueue = Queue.Queue()
+
+    def writeMessage(self, message):
+        self.writeQueue.put(message)
+
+    def write(self):
+        while True:
+            while self.writeQueue.empty():
+                (yield multitask.sleep(0.01))
+            message = self.writeQueue.get()
+            if message is None:
+                self.stream.close()
+                break
+            try:
+                yield self.stream.write(self.encodeMessage(message))
+            except ConnectionClosed:
+                yield self.connectionClosed()
+
+WRITERS = {'event': Protocol, 'polling': PollingProtocol}
+
+
+def listener(sock):
+    """Stands in for FlashServer's listening socket, which the task manager
+    sleeps on when nobody has anything to do.
+    """
+    while True:
+        conn, remote = (yield multitask.accept(sock))
+        conn.close()
+
+
+def run_for(manager, seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        manager.run_next(timeout=max(0.0, end - time.time()))
+
+
+def idle_cpu(manager, seconds):
+    cpu_start = sum(os.times()[:2])
+    run_for(manager, seconds)
+    return sum(os.times()[:2]) - cpu_start
+
+
+def latencies(manager, protocol_class, count):
+    left, right = socket.socketpair()
+    protocol = protocol_class(right)
+    manager.add(protocol.write())
+    results = []
+    def prober():
+        for i in range(count):
+            data = 'x' * 100
+            start = time.time()
+            protocol.writeMessage(Message(Header(time=i + 1, size=len(data),
+                type=Message.VIDEO, streamId=1), data))
+            yield multitask.recv(left, 4096)
+            results.append(time.time() - start)
+            # let the idle writers have their turn in between
+            yield multitask.sleep(0.003)
+    manager.add(prober())
+    while len(results) < count:
+        manager.run_next()
+    protocol.writeMessage(None)
+    run_for(manager, 0.05)
+    left.close()
+    return sorted(results)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--players', dest='players', type='int',
+            default=1000, help='Idle connections')
+    parser.add_option('-t', '--seconds', dest='seconds', type='float',
+            default=5, help='How long to idle')
+    parser.add_option('-m', '--messages', dest='messages', type='int',
+            default=200, help='Messages to time the latency of')
+    parser.add_option('-w', '--writer', dest='writers', action='append',
+            choices=WRITERS.keys(), help='Writer to benchmark (repeatable), '
+            'default all of %s' % ', '.join(sorted(WRITERS)))
+    options, args = parser.parse_args()
+
+    print "%d idle players, %.1f s" % (options.players, options.seconds)
+    print "%-8s %12s %14s %14s %14s" % ("writer", "idle cpu %",
+            "median ms", "p99 ms", "max ms")
+    for name in options.writers or sorted(WRITERS):
+        manager = multitask.TaskManager()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        manager.add(listener(sock))
+        for i in range(options.players):
+            manager.add(WRITERS[name](None).write())
+        run_for(manager, 0.1) # get them all waiting
+        cpu = idle_cpu(manager, options.seconds)
+        results = latencies(manager, WRITERS[name], options.messages)
+        print "%-8s %12.1f %14.3f %14.3f %14.3f" % (name,
+                cpu / options.seconds * 100,
+                results[len(results) / 2] * 1e3,
+                results[int(len(results) * 0.99)] * 1e3, results[-1] * 1e3)
+        sock.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Join to first frame latency of players on a live stream of FlashServer.
+
+Publishes the tags of an FLV (a canned one by default, see rtmp_parse.py, with
+a key frame every 2 seconds) through FlashServer.mediahandler on a clock that
+follows the tag timestamps, and has --joins players join through
+FlashServer.playhandler at random points of it. Reports how long, on that
+clock, each player waited for its first key frame, and the bytes it was sent
+on joining, with and without the GOP cache. Players that join after the last
+key frame never get one without the cache, and are left out of its figures:
+
+    $ python benchmarks/rtmp_join.py --joins 500
+
+The time it takes to send the cache itself is measured for real and added.
+
+"""
+import os
+import random
+import tempfile
+import time
+from optparse import OptionParser
+
+from astral.rtmp.rtmp import (App, Command, FlashServer, Header, Message,
+        Stream)
+from rtmp_parse import CHANNELS, flv_tags, make_flv
+
+
+class Player(object):
+    """Stands in for a player's Client, noting when its first key frame came
+    along.
+    """
+    path = 'live'
+
+    def __init__(self, clock):
+        self.clock, self.first_frame, self.bytes = clock, None, 0
+
+    def writeMessage(self, message):
+        if self.first_frame is None and message.type == Message.VIDEO \
+                and ord(message.data[0]) >> 4 == 1:
+            self.first_frame = self.clock[0]
+        self.bytes += len(message.data)
+
+
+def run(tags, joins, gop_cache_size, seed):
+    server = FlashServer()
+    server.gopCacheSize = gop_cache_size
+    inst = App()
+    server.clients['live'] = [inst]
+    clock = [0.0]
+    publisher = Stream(Player(clock))
+    publisher.name = 'cam'
+    server.publishhandler(publisher, Command(name='publish', id=1,
+        args=['cam', 'live'])).next()
+    rng = random.Random(seed)
+    join_at = sorted(rng.randrange(len(tags)) for i in range(joins))
+    players = []
+    for i, (tag_type, timestamp, data) in enumerate(tags):
+        clock[0] = timestamp / 1000.0
+        while join_at and join_at[0] == i:
+            join_at.pop(0)
+            player = Stream(Player(clock))
+            start = time.time()
+            for ignore in server.playhandler(player, Command(name='play',
+                    id=2, args=['cam'])):
+                pass
+            player.client.sendTime = time.time() - start
+            player.client.joined, player.client.joinBytes = (clock[0],
+                    player.client.bytes)
+            players.append(player.client)
+        server.mediahandler(publisher, Message(Header(
+            channel=CHANNELS[tag_type], time=timestamp, size=len(data),
+            type=tag_type, streamId=1), data))
+    waits = sorted(p.first_frame - p.joined + p.sendTime for p in players
+            if p.first_frame is not None)
+    return waits, sum(p.joinBytes for p in players) / len(players)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-f', '--flv', dest='flv',
+            help='FLV file to publish instead of the canned one')
+    parser.add_option('-t', '--seconds', dest='seconds', type='int',
+            default=60, help='Length of the canned FLV')
+    parser.add_option('-j', '--joins', dest='joins', type='int',
+            default=500, help='Players joining')
+    parser.add_option('-s', '--seed', dest='seed', type='int', default=1,
+            help='Seed for the join points')
+    options, args = parser.parse_args()
+
+    path = options.flv
+    if not path:
+        fd, path = tempfile.mkstemp(suffix='.flv')
+        os.close(fd)
+        make_flv(path, options.seconds)
+    try:
+        tags = flv_tags(path)
+    finally:
+        if not options.flv:
+            os.unlink(path)
+
+    print "%d messages, %d joins" % (len(tags), options.joins)
+    print "%-10s %10s %10s %10s %10s %14s" % ("cache", "started",
+            "mean ms", "p50 ms", "p95 ms", "join bytes")
+    for name, size in (('none', 0), ('gop', FlashServer.GOP_CACHE_SIZE)):
+        waits, join_bytes = run(tags, options.joins, size, options.seed)
+        print "%-10s %10d %10.1f %10.1f %10.1f %14d" % (name, len(waits),
+                sum(waits) / len(waits) * 1e3, waits[len(waits) / 2] * 1e3,
+                waits[int(len(waits) * 0.95)] * 1e3, join_bytes)
+
+
+if __name__ == '__main__':
+    main()
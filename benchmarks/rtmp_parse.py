@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+"""
+Parsing benchmark for the RTMP chunk stream reader in astral.rtmp.rtmp.
+
+Feeds the bytes a publishing client would send (the handshake, then every tag
+of an FLV file as an RTMP message chunked at 128 bytes) over a socket to
+Protocol.parse(), and reports the messages and the CPU time it took to parse
+them. The current parser, which decodes whole chunks in place, is compared
+with the original one that went through the scheduler for every header field
+and kept a str buffer (both build the same, current, Header and Message
+objects).
+
+Without --flv a canned FLV of --seconds of 25 fps video (a 20K key frame every
+2 seconds and 3K frames in between) and 44 audio frames a second is made up:
+
+    $ python benchmarks/rtmp_parse.py --seconds 120
+    $ python benchmarks/rtmp_parse.py --flv recording.flv
+    $ python benchmarks/rtmp_parse.py --capture publish.rtmp
+
+--capture replays raw client to server bytes recorded elsewhere instead, and
+--save writes the capture that was derived from the FLV out to a file.
+
+"""
+import multiprocessing
+import os
+import socket
+import struct
+import tempfile
+import time
+from optparse import OptionParser
+
+from astral.rtmp import multitask
+from astral.rtmp.rtmp import (ConnectionClosed, FLV, Header, Message,
+        Protocol)
+
+CHANNELS = {Message.AUDIO: 4, Message.VIDEO: 6, Message.DATA: 5}
+FPS = 25
+KEY_FRAME_INTERVAL = 2 # seconds
+KEY_FRAME_SIZE, FRAME_SIZE = 20 * 1024, 3 * 1024
+AUDIO_RATE, AUDIO_FRAME_SIZE = 44, 200
+
+
+class LegacySockStream(object):
+    """SockStream as it was, with a str buffer sliced apart on every read."""
+    def __init__(self, sock):
+        self.sock, self.buffer = sock, ''
+        self.bytesWritten = self.bytesRead = 0
+
+    def close(self):
+        self.sock.close()
+
+    def read(self, count):
+        try:
+            while True:
+                if len(self.buffer) >= count:
+                    data, self.buffer = (self.buffer[:count],
+                            self.buffer[count:])
+                    raise StopIteration(data)
+                data = (yield multitask.recv(self.sock, 4096))
+                if not data:
+                    raise ConnectionClosed
+                self.bytesRead += len(data)
+                self.buffer += data
+        except StopIteration:
+            raise
+        except:
+            raise ConnectionClosed
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+    def write(self, data):
+        while len(data) > 0:
+            chunk, data = data[:4096], data[4096:]
+            self.bytesWritten += len(chunk)
+            try:
+                yield multitask.send(self.sock, chunk)
+            except:
+                raise ConnectionClosed
+
+
+class CountingProtocol(Protocol):
+    def __init__(self, sock):
+        Protocol.__init__(self, sock)
+        self.messages = 0
+
+    def messageReceived(self, msg):
+        self.messages += 1
+        yield
+
+
+class LegacyProtocol(CountingProtocol):
+    """The original parser, reading every header field through the
+    scheduler.
+    """
+    def __init__(self, sock):
+        CountingProtocol.__init__(self, sock)
+        self.stream = LegacySockStream(sock)
+
+    def parseMessages(self):
+        while True:
+            hdrsize = ord((yield self.stream.read(1))[0])
+            channel = hdrsize & 0x3F
+            if channel == 0:
+                channel = 64 + ord((yield self.stream.read(1))[0])
+            elif channel == 1:
+                data = (yield self.stream.read(2))
+                channel = 64 + ord(data[0]) + 256 * ord(data[1])
+
+            hdrtype = hdrsize & Header.MASK
+            if (hdrtype == Header.FULL
+                    or not self.lastReadHeaders.has_key(channel)):
+                header = Header(channel)
+                self.lastReadHeaders[channel] = header
+            else:
+                header = self.lastReadHeaders[channel]
+
+            if hdrtype < Header.SEPARATOR:
+                data = (yield self.stream.read(3))
+                header.time = struct.unpack('!I', '\x00' + data)[0]
+            if hdrtype < Header.TIME:
+                data = (yield self.stream.read(3))
+                header.size = struct.unpack('!I', '\x00' + data)[0]
+                header.type = ord((yield self.stream.read(1))[0])
+            if hdrtype < Header.MESSAGE:
+                data = (yield self.stream.read(4))
+                header.streamId = struct.unpack('<I', data)[0]
+            if header.time == 0xFFFFFF:
+                data = (yield self.stream.read(4))
+                header.extendedTime = struct.unpack('!I', data)[0]
+            else:
+                header.extendedTime = None
+
+            if hdrtype == Header.FULL:
+                header.currentTime = header.extendedTime or header.time
+                header.hdrtype = hdrtype
+            elif hdrtype in (Header.MESSAGE, Header.TIME):
+                header.hdrtype = hdrtype
+
+            data = self.incompletePackets.get(channel, "")
+            count = min(header.size - (len(data)), self.readChunkSize)
+            data += (yield self.stream.read(count))
+
+            if self.readWinSize is not None:
+                if self.stream.bytesRead > (self.readWinSize0
+                        + self.readWinSize):
+                    self.readWinSize0 = self.stream.bytesRead
+                    ack = Message()
+                    ack.type, ack.data = (Message.ACK,
+                            struct.pack('>L', self.readWinSize0))
+                    self.writeMessage(ack)
+
+            if len(data) < header.size:
+                self.incompletePackets[channel] = data
+            else:
+                if hdrtype in (Header.MESSAGE, Header.TIME):
+                    header.currentTime = header.currentTime + (
+                            header.extendedTime or header.time)
+                elif hdrtype == Header.SEPARATOR:
+                    if header.hdrtype in (Header.MESSAGE, Header.TIME):
+                        header.currentTime = header.currentTime + (
+                                header.extendedTime or header.time)
+                if channel in self.incompletePackets:
+                    del self.incompletePackets[channel]
+                hdr = Header(channel=header.channel, time=header.currentTime,
+                        size=header.size, type=header.type,
+                        streamId=header.streamId)
+                msg = Message(hdr, data)
+                try:
+                    if channel == Protocol.PROTOCOL_CHANNEL_ID:
+                        self.protocolMessage(msg)
+                    else:
+                        yield self.messageReceived(msg)
+                except:
+                    pass
+
+PARSERS = {'chunked': CountingProtocol, 'legacy': LegacyProtocol}
+
+
+def make_flv(path, seconds):
+    """Record a canned FLV of seconds worth of AVC video and AAC audio frames,
+    after their sequence headers.
+    """
+    flv = FLV().open(path, 'record')
+    key_frame = '\x17\x01' + os.urandom(KEY_FRAME_SIZE - 2)
+    frame = '\x27\x01' + os.urandom(FRAME_SIZE - 2)
+    audio = '\xaf\x01' + os.urandom(AUDIO_FRAME_SIZE - 2)
+    tags = [(0, Message.VIDEO, '\x17\x00' + os.urandom(40)),
+            (0, Message.AUDIO, '\xaf\x00' + os.urandom(2))]
+    for i in range(seconds * FPS):
+        data = key_frame if i % (FPS * KEY_FRAME_INTERVAL) == 0 else frame
+        tags.append((i * 1000 / FPS, Message.VIDEO, data))
+    for i in range(seconds * AUDIO_RATE):
+        tags.append((i * 1000 / AUDIO_RATE, Message.AUDIO, audio))
+    for timestamp, message_type, data in sorted(tags):
+        flv.write(Message(Header(time=timestamp, size=len(data),
+            type=message_type, streamId=1), data))
+    flv.close()
+
+
+def flv_tags(path):
+    """The (type, timestamp, data) of every audio, video and data tag in an
+    FLV file.
+    """
+    fp = open(path, 'rb')
+    magic, version, flags, offset = struct.unpack('!3sBBI', fp.read(9))
+    if magic != 'FLV':
+        raise ValueError("%s is not an FLV file" % path)
+    fp.seek(offset + 4)
+    tags = []
+    while True:
+        header = fp.read(11)
+        if len(header) < 11:
+            break
+        (tag_type, size_high, size_low, time_high, time_low,
+            time_extended) = struct.unpack('>BBHBHB', header[:8])
+        data = fp.read((size_high << 16) | size_low)
+        fp.read(4) # previous tag size
+        if tag_type in CHANNELS:
+            tags.append((tag_type, (time_extended << 24) | (time_high << 16)
+                | time_low, data))
+    fp.close()
+    return tags
+
+
+def chunk_message(channel, message_type, timestamp, data,
+        chunk_size=Protocol.DEFAULT_CHUNK_SIZE):
+    """The chunks of one message: a full header on the first one and a one
+    byte header on the rest.
+    """
+    header = Header(channel=channel, time=timestamp, size=len(data),
+            type=message_type, streamId=1)
+    chunks = []
+    control = Header.FULL
+    for offset in range(0, len(data), chunk_size):
+        chunks.append(header.toBytes(control))
+        chunks.append(data[offset:offset + chunk_size])
+        control = Header.SEPARATOR
+    return ''.join(chunks)
+
+
+def flv_capture(path):
+    """What a client publishing the FLV at path sends: the handshake and then
+    every tag as a message.
+    """
+    parts = ['\x03', os.urandom(Protocol.PING_SIZE),
+            os.urandom(Protocol.PING_SIZE)]
+    for tag_type, timestamp, data in flv_tags(path):
+        parts.append(chunk_message(CHANNELS[tag_type], tag_type, timestamp,
+            data))
+    return ''.join(parts)
+
+
+def feed(sock, parser_sock, capture):
+    # our copy of the parser's end would keep it from ever hanging up
+    parser_sock.close()
+    sock.sendall(capture)
+    sock.shutdown(socket.SHUT_WR)
+    # swallow the handshake replies until the parser hangs up
+    while sock.recv(64 * 1024):
+        pass
+    sock.close()
+
+
+def parse(capture, protocol_class):
+    left, right = socket.socketpair()
+    feeder = multiprocessing.Process(target=feed, args=(left, right,
+        capture))
+    feeder.start()
+    left.close()
+    protocol = protocol_class(right)
+    manager = multitask.TaskManager()
+    manager.add(protocol.parse())
+    cpu_start = sum(os.times()[:2])
+    start = time.time()
+    manager.run()
+    elapsed = time.time() - start
+    cpu = sum(os.times()[:2]) - cpu_start
+    right.close()
+    feeder.join()
+    return protocol.messages, elapsed, cpu
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-f', '--flv', dest='flv',
+            help='FLV file to derive the capture from')
+    parser.add_option('-t', '--seconds', dest='seconds', type='int',
+            default=120, help='Length of the canned FLV')
+    parser.add_option('-c', '--capture', dest='capture',
+            help='Recorded client to server bytes to parse instead')
+    parser.add_option('-s', '--save', dest='save',
+            help='Write the capture derived from the FLV to this file')
+    parser.add_option('-p', '--parser', dest='parsers', action='append',
+            choices=PARSERS.keys(), help='Parser to benchmark (repeatable), '
+            'default all of %s' % ', '.join(sorted(PARSERS)))
+    options, args = parser.parse_args()
+
+    if options.capture:
+        capture = open(options.capture, 'rb').read()
+    elif options.flv:
+        capture = flv_capture(options.flv)
+    else:
+        fd, path = tempfile.mkstemp(suffix='.flv')
+        os.close(fd)
+        try:
+            make_flv(path, options.seconds)
+            capture = flv_capture(path)
+        finally:
+            os.unlink(path)
+    if options.save:
+        open(options.save, 'wb').write(capture)
+
+    print "%d bytes of capture" % len(capture)
+    print "%-10s %10s %10s %10s %12s" % ("parser", "messages", "MB/s",
+            "cpu s", "us/message")
+    for name in options.parsers or sorted(PARSERS):
+        messages, elapsed, cpu = parse(capture, PARSERS[name])
+        print "%-10s %10d %10.1f %10.2f %12.2f" % (name, messages,
+                len(capture) / elapsed / 1024 / 1024, cpu,
+                cpu / max(messages, 1) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Delay of audio and protocol control messages to a player on a congested link.
+
+Publishes the tags of an FLV (a canned one by default, see rtmp_parse.py)
+through FlashServer.mediahandler on a clock that follows the tag timestamps, to
+a player whose writer goes out over a simulated link of --link times the
+bitrate of the stream, with a window acknowledgement queued for it every
+second. Reports how long each kind of message took from being queued to being
+written, for the write queue as it is, with lanes by priority (see
+WriteQueue), and for a single first in, first out queue as it was:
+
+    $ python benchmarks/rtmp_priority.py --link 1.1
+
+"""
+import os
+import struct
+import tempfile
+from optparse import OptionParser
+
+from astral.rtmp import multitask
+from astral.rtmp.rtmp import (App, Command, FlashServer, Header, Message,
+        Protocol, Stream, WriteQueue)
+from rtmp_parse import CHANNELS, flv_tags, make_flv
+from rtmp_slow_player import Link, Publisher
+
+
+class FifoWriteQueue(WriteQueue):
+    """All the messages in one lane, as it was."""
+    def lane(self, message):
+        return WriteQueue.CONTROL
+
+QUEUES = {'lanes': WriteQueue, 'fifo': FifoWriteQueue}
+KINDS = (('control', lambda m: m.type < Message.AUDIO),
+         ('audio', lambda m: m.type == Message.AUDIO),
+         ('video', lambda m: m.type == Message.VIDEO))
+
+
+class TimingProtocol(Protocol):
+    """Notes the clock at which each message it writes is queued, and the one
+    at which the last of its bytes got through the link.
+    """
+    def __init__(self, clock, link, queue_class):
+        Protocol.__init__(self, None)
+        self.stream, self.path, self.clock = link, 'live', clock
+        self.writeQueue = queue_class()
+        self.queued, self.batch, self.encoded, self.delays = {}, [], 0, []
+        link.written = self.written
+
+    def writeMessage(self, message):
+        if message is not None:
+            self.queued[id(message)] = self.clock[0]
+        return Protocol.writeMessage(self, message)
+
+    def encodeMessage(self, message):
+        data = Protocol.encodeMessage(self, message)
+        self.encoded += len(data)
+        self.batch.append((self.encoded, message))
+        return data
+
+    def written(self, count):
+        while self.batch and self.batch[0][0] <= count:
+            end, message = self.batch.pop(0)
+            self.delays.append((message,
+                self.clock[0] - self.queued.pop(id(message))))
+
+
+class TimingLink(Link):
+    """A Link that lets the bytes of a write through a packet at a time."""
+    PACKET = 1460
+
+    def write(self, data):
+        for offset in range(0, len(data), self.PACKET):
+            for result in Link.write(self, data[offset:offset +
+                    self.PACKET]):
+                yield result
+            self.written(self.bytesWritten)
+
+
+def run(tags, speed, bitrate, queue_class):
+    manager = multitask.TaskManager()
+    server = FlashServer()
+    inst = App()
+    server.clients['live'] = [inst]
+    publisher = Stream(Publisher())
+    server.publishhandler(publisher, Command(name='publish', id=1,
+        args=['cam', 'live'])).next()
+    clock = [0.0]
+    link = TimingLink(speed * bitrate)
+    protocol = TimingProtocol(clock, link, queue_class)
+    player = Stream(protocol)
+    player.id = 1
+    for ignore in server.playhandler(player, Command(name='play', id=2,
+            args=['cam'])):
+        pass
+    manager.add(protocol.write())
+    last, next_ack = 0, 0
+    for tag_type, timestamp, data in tags:
+        link.tick((timestamp - last) / 1000.0)
+        last, clock[0] = timestamp, timestamp / 1000.0
+        if timestamp >= next_ack:
+            ack = Message()
+            ack.type, ack.data = Message.ACK, struct.pack('>L', timestamp)
+            protocol.writeMessage(ack)
+            next_ack += 1000
+        server.mediahandler(publisher, Message(Header(
+            channel=CHANNELS[tag_type], time=timestamp, size=len(data),
+            type=tag_type, streamId=1), data))
+        while manager.has_runnable():
+            manager.run_next()
+    return protocol.delays
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-f', '--flv', dest='flv',
+            help='FLV file to publish instead of the canned one')
+    parser.add_option('-t', '--seconds', dest='seconds', type='int',
+            default=60, help='Length of the canned FLV')
+    parser.add_option('-l', '--link', dest='link', type='float', default=1.1,
+            help='Link speed in multiples of the bitrate')
+    options, args = parser.parse_args()
+
+    path = options.flv
+    if not path:
+        fd, path = tempfile.mkstemp(suffix='.flv')
+        os.close(fd)
+        make_flv(path, options.seconds)
+    try:
+        tags = flv_tags(path)
+    finally:
+        if not options.flv:
+            os.unlink(path)
+
+    bitrate = sum(len(data) for t, ts, data in tags) / (tags[-1][1] / 1000.0)
+    print "%d messages, %.1f KB/s, link %.1fx" % (len(tags), bitrate / 1024,
+            options.link)
+    print "%-6s %-8s %8s %10s %10s %10s" % ("queue", "kind", "count",
+            "p50 ms", "p99 ms", "max ms")
+    for name in sorted(QUEUES):
+        delays = run(tags, options.link, bitrate, QUEUES[name])
+        for kind, match in KINDS:
+            kind_delays = sorted(d for m, d in delays if match(m))
+            print "%-6s %-8s %8d %10.1f %10.1f %10.1f" % (name, kind,
+                    len(kind_delays),
+                    kind_delays[len(kind_delays) / 2] * 1e3,
+                    kind_delays[int(len(kind_delays) * 0.99)] * 1e3,
+                    kind_delays[-1] * 1e3)
+
+
+if __name__ == '__main__':
+    main()
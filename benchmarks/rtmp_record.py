@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+How a slow disk holds up live delivery from a stream being recorded.
+
+Publishes the tags of an FLV (a canned one by default, see rtmp_parse.py) in
+record mode through FlashServer.mediahandler, at --speed times the pace of
+their timestamps, to a file whose every write takes --delay milliseconds more
+than it would. Reports the time mediahandler took per message, which is time
+every player of the node waits, with the file written inline as it was and
+with FLVRecorder, along with what the recorder wrote, dropped and how long its
+writes took:
+
+    $ python benchmarks/rtmp_record.py --delay 20 --speed 4
+
+"""
+import os
+import shutil
+import tempfile
+import time
+from optparse import OptionParser
+
+from astral.rtmp import rtmp
+from astral.rtmp.rtmp import (App, Command, FlashServer, FLV, FLVRecorder,
+        Header, Message, Stream)
+from rtmp_parse import CHANNELS, flv_tags, make_flv
+from rtmp_slow_player import Publisher
+
+
+class SlowFile(object):
+    def __init__(self, fp, delay):
+        self.fp, self.delay = fp, delay
+
+    def write(self, data):
+        time.sleep(self.delay)
+        self.fp.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+
+class SlowFLV(FLV):
+    delay = 0
+
+    def open(self, path, type='read', mode=0775):
+        FLV.open(self, path, type, mode)
+        self.fp = SlowFile(self.fp, self.delay)
+        return self
+
+
+class InlineRecorder(SlowFLV):
+    """FLV written from mediahandler, as it was."""
+    written = dropped = batches = 0
+    writeTime = maxWriteTime = 0.0
+
+    def __init__(self, *args):
+        SlowFLV.__init__(self)
+
+    def write(self, message):
+        if message.type in (Message.AUDIO, Message.VIDEO):
+            self.written += 1
+        SlowFLV.write(self, message)
+
+
+class AsyncRecorder(FLVRecorder):
+    def __init__(self, *args):
+        FLVRecorder.__init__(self, *args)
+        self.flv = SlowFLV()
+
+RECORDERS = {'inline': InlineRecorder, 'thread': AsyncRecorder}
+
+
+def run(tags, recorder_class, speed, directory):
+    server = FlashServer()
+    server.root = directory
+    inst = App()
+    server.clients['live'] = [inst]
+    publisher = Stream(Publisher())
+    rtmp.FLVRecorder = recorder_class
+    try:
+        server.publishhandler(publisher, Command(name='publish', id=1,
+            args=['cam', 'record'])).next()
+    finally:
+        rtmp.FLVRecorder = FLVRecorder
+    recorder = publisher.recordfile
+    times = []
+    start = time.time()
+    for tag_type, timestamp, data in tags:
+        delay = start + timestamp / 1000.0 / speed - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        message = Message(Header(channel=CHANNELS[tag_type], time=timestamp,
+            size=len(data), type=tag_type, streamId=1), data)
+        before = time.time()
+        server.mediahandler(publisher, message)
+        times.append(time.time() - before)
+    recorder.close()
+    if getattr(recorder, 'thread', None):
+        recorder.thread.join()
+    return sorted(times), recorder
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-f', '--flv', dest='flv',
+            help='FLV file to publish instead of the canned one')
+    parser.add_option('-t', '--seconds', dest='seconds', type='int',
+            default=60, help='Length of the canned FLV')
+    parser.add_option('-d', '--delay', dest='delay', type='float', default=20,
+            help='Milliseconds added to each write to the file')
+    parser.add_option('-s', '--speed', dest='speed', type='float', default=4,
+            help='Publish at this many times the pace of the timestamps')
+    options, args = parser.parse_args()
+
+    path = options.flv
+    if not path:
+        fd, path = tempfile.mkstemp(suffix='.flv')
+        os.close(fd)
+        make_flv(path, options.seconds)
+    try:
+        tags = flv_tags(path)
+    finally:
+        if not options.flv:
+            os.unlink(path)
+
+    SlowFLV.delay = options.delay / 1000.0
+    print "%d messages, %.0f ms per write, %.1fx" % (len(tags), options.delay,
+            options.speed)
+    print "%-8s %10s %10s %10s %8s %8s %8s %12s" % ("recorder", "p50 us",
+            "p99 us", "max us", "written", "dropped", "batches",
+            "max write ms")
+    for name in sorted(RECORDERS):
+        directory = tempfile.mkdtemp()
+        try:
+            times, recorder = run(tags, RECORDERS[name], options.speed,
+                    directory)
+        finally:
+            shutil.rmtree(directory)
+        print "%-8s %10.1f %10.1f %10.1f %8d %8d %8d %12.1f" % (name,
+                times[len(times) / 2] * 1e6,
+                times[int(len(times) * 0.99)] * 1e6, times[-1] * 1e6,
+                recorder.written, recorder.dropped, recorder.batches,
+                recorder.maxWriteTime * 1e3)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Publisher to player relay benchmark for FlashServer in astral.rtmp.rtmp.
+
+Puts the audio and video tags of an FLV (a canned one by default, see
+rtmp_parse.py) on a published stream the way a publishing client's parser
+does, one message per scheduler pass, and has FlashServer.streamlistener hand
+them to --players players. Reports the CPU time per message and the time from
+a message being queued on the publisher's stream to it being queued for each
+player. The current listener, which sends media out inline and in batches, is
+compared with the original one that started a streamhandler task per message:
+
+    $ python benchmarks/rtmp_relay.py --players 1 --players 10
+
+"""
+import os
+import tempfile
+import time
+from optparse import OptionParser
+
+from astral.rtmp import multitask
+from astral.rtmp.rtmp import App, FlashServer, Header, Message, Stream
+from rtmp_parse import CHANNELS, flv_tags, make_flv
+
+
+class TaskPerMessageServer(FlashServer):
+    """FlashServer.streamlistener as it was, with a task per message."""
+    def __init__(self, manager):
+        FlashServer.__init__(self)
+        self.manager = manager
+
+    def streamlistener(self, stream):
+        while True:
+            msg = (yield stream.recv())
+            if not msg:
+                self.closehandler(stream)
+                break
+            self.manager.add(self.streamhandler(stream, msg))
+
+    def streamhandler(self, stream, message):
+        try:
+            yield self.mediahandler(stream, message)
+        except:
+            pass
+
+    def mediahandler(self, stream, message):
+        inst = self.clients[stream.client.path][0]
+        if inst.onPublishData(stream.client, stream, message):
+            for s in (inst.players.get(stream.name, [])):
+                m = message.dup()
+                if inst.onPlayData(s.client, s, m):
+                    yield s.send(m)
+
+
+class InlineServer(FlashServer):
+    def __init__(self, manager):
+        FlashServer.__init__(self)
+
+LISTENERS = {'inline': InlineServer, 'task': TaskPerMessageServer}
+
+
+class TimingClient(object):
+    """Stands in for a player's Client, noting when each message was queued
+    for writing.
+    """
+    path = 'live'
+
+    def __init__(self, queued, latencies):
+        self.queued, self.latencies = queued, latencies
+
+    def writeMessage(self, message):
+        self.latencies.append(time.time() - self.queued[message.time])
+
+
+def relay(tags, players, listener):
+    manager = multitask.TaskManager()
+    server = LISTENERS[listener](manager)
+    inst = App()
+    server.clients['live'] = [inst]
+    queued, latencies = {}, []
+    publisher = Stream(TimingClient(queued, latencies))
+    publisher.name = 'cam'
+    inst.players['cam'] = []
+    for i in range(players):
+        player = Stream(TimingClient(queued, latencies))
+        player.name = 'cam'
+        inst.players['cam'].append(player)
+    messages = [Message(Header(channel=CHANNELS[tag_type], time=i,
+        size=len(data), type=tag_type, streamId=1), data)
+        for i, (tag_type, timestamp, data) in enumerate(tags)]
+
+    def parser():
+        for message in messages:
+            queued[message.time] = time.time()
+            yield publisher.queue.put(message)
+            yield # the next message comes with the next read
+        yield publisher.queue.put(None)
+
+    manager.add(server.streamlistener(publisher))
+    manager.add(parser())
+    cpu_start = sum(os.times()[:2])
+    manager.run()
+    return sum(os.times()[:2]) - cpu_start, sorted(latencies)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-f', '--flv', dest='flv',
+            help='FLV file to relay instead of the canned one')
+    parser.add_option('-t', '--seconds', dest='seconds', type='int',
+            default=60, help='Length of the canned FLV')
+    parser.add_option('-n', '--players', dest='players', type='int',
+            action='append', help='Players (repeatable), default 1 and 10')
+    options, args = parser.parse_args()
+
+    path = options.flv
+    if not path:
+        fd, path = tempfile.mkstemp(suffix='.flv')
+        os.close(fd)
+        make_flv(path, options.seconds)
+    try:
+        tags = flv_tags(path)
+    finally:
+        if not options.flv:
+            os.unlink(path)
+
+    print "%d messages" % len(tags)
+    print "%-8s %8s %12s %12s %12s" % ("listener", "players", "us/message",
+            "median us", "p99 us")
+    for players in options.players or [1, 10]:
+        for name in sorted(LISTENERS):
+            cpu, latencies = relay(tags, players, name)
+            print "%-8s %8d %12.2f %12.1f %12.1f" % (name, players,
+                    cpu / len(tags) * 1e6,
+                    latencies[len(latencies) / 2] * 1e6,
+                    latencies[int(len(latencies) * 0.99)] * 1e6)
+
+
+if __name__ == '__main__':
+    main()
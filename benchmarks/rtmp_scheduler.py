@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Scheduler overhead of the multitask I/O backends against connection count.
+
+Opens --connections socket pairs with a task waiting to read on one end of
+each, like the reader tasks of idle RTMP players, and times message round
+trips over one more, busy, pair through the task manager. Reports the time
+per round trip for each of the select(), poll() and epoll() backends:
+
+    $ python benchmarks/rtmp_scheduler.py --connections 10 \\
+            --connections 1000 --connections 5000
+
+select() can't take file descriptors past FD_SETSIZE, so it is left out of
+the runs with more connections than that allows.
+
+"""
+import select
+import socket
+import time
+from optparse import OptionParser
+
+from astral.rtmp import multitask
+
+FD_SETSIZE = 1024
+POLLERS = {'select': multitask.SelectPoller}
+if hasattr(select, 'poll'):
+    POLLERS['poll'] = multitask.PollPoller
+if hasattr(select, 'epoll'):
+    POLLERS['epoll'] = multitask.EpollPoller
+
+
+def idle_reader(sock):
+    yield multitask.recv(sock, 4096)
+
+
+def echo(sock, count):
+    for i in range(count):
+        data = (yield multitask.recv(sock, 4096))
+        yield multitask.send(sock, data)
+
+
+def ping(sock, count, results):
+    start = time.time()
+    for i in range(count):
+        yield multitask.send(sock, 'ping')
+        yield multitask.recv(sock, 4096)
+    results.append(time.time() - start)
+
+
+def round_trips(poller, pairs, count):
+    manager = multitask.TaskManager(poller())
+    for left, right in pairs:
+        manager.add(idle_reader(right))
+    left, right = socket.socketpair()
+    results = []
+    manager.add(echo(right, count))
+    manager.add(ping(left, count, results))
+    while not results:
+        manager.run_next()
+    left.close()
+    right.close()
+    return results[0] / count
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-c', '--connections', dest='connections',
+            type='int', action='append', help='Idle connections '
+            '(repeatable), default 10, 100, 1000 and 5000')
+    parser.add_option('-n', '--count', dest='count', type='int',
+            default=2000, help='Round trips to time')
+    parser.add_option('-p', '--poller', dest='pollers', action='append',
+            choices=POLLERS.keys(), help='Backend to benchmark (repeatable), '
+            'default all of %s' % ', '.join(sorted(POLLERS)))
+    options, args = parser.parse_args()
+
+    names = options.pollers or sorted(POLLERS)
+    print "%12s %s" % ("connections",
+            " ".join("%12s" % ("%s us" % name) for name in names))
+    for connections in options.connections or [10, 100, 1000, 5000]:
+        pairs = [socket.socketpair() for i in range(connections)]
+        results = []
+        for name in names:
+            if name == 'select' and connections * 2 + 8 > FD_SETSIZE:
+                results.append("%12s" % "n/a")
+                continue
+            results.append("%12.1f" % (round_trips(POLLERS[name], pairs,
+                options.count) * 1e6))
+        print "%12d %s" % (connections, " ".join(results))
+        for left, right in pairs:
+            left.close()
+            right.close()
+
+
+if __name__ == '__main__':
+    main()
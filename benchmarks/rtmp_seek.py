@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Seeking in and reading from recorded FLV files.
+
+Records a canned FLV of --seconds (see rtmp_parse.py; at its bitrate an hour
+is about 330 MB) and seeks a reader to --seeks random times in it. Reports the
+time seek() took, the first seek on its own since that is when the key frame
+index is loaded, then how long the reader took over all the tags of the file.
+That is done for FLV as it is, with the index the recording wrote and without
+it (when the reader goes through the tag headers once to make its own), and
+for FLV as it was, which went through the tags from the start of the file on
+every seek and read them with three reads each:
+
+    $ python benchmarks/rtmp_seek.py --seconds 3600
+
+The file is read from the page cache after the first pass over it, so these
+are the costs in CPU and system calls rather than in disk I/O.
+
+"""
+import os
+import random
+import shutil
+import struct
+import tempfile
+import time
+from optparse import OptionParser
+
+from astral.rtmp import multitask
+from astral.rtmp.rtmp import Command, FLV, Header, Message
+from rtmp_parse import make_flv
+
+
+class LegacyFLV(FLV):
+    """The reader as it was, from the file object rather than a map of it."""
+    def open(self, path, type='read', mode=0775):
+        self.fp = open(path, 'rb')
+        self.type, self.tsp = type, 0
+        magic, version, flags, offset = struct.unpack('!3sBBI',
+                self.fp.read(9))
+        if offset > 9:
+            self.fp.seek(offset - 9, os.SEEK_CUR)
+        self.fp.read(4)
+        return self
+
+    def reader(self, stream):
+        while self.fp is not None:
+            bytes = self.fp.read(11)
+            if len(bytes) == 0:
+                stream.send(Command(name='onStatus', id=stream.id).toMessage())
+                break
+            type, len0, len1, ts0, ts1, ts2, sid0, sid1 = struct.unpack(
+                    '>BBHBHBBH', bytes)
+            length = (len0 << 16) | len1
+            ts = (ts0 << 16) | (ts1 & 0x0ffff) | (ts2 << 24)
+            body = self.fp.read(length)
+            ptagsize, = struct.unpack('>I', self.fp.read(4))
+            if stream is None or stream.client is None:
+                break
+            stream.send(Message(Header(0, ts, length, type, stream.id), body))
+            if ts > self.tsp:
+                diff, self.tsp = ts - self.tsp, ts
+                yield multitask.sleep(diff / 1000.0)
+
+    def seek(self, offset):
+        self.fp.seek(0, os.SEEK_SET)
+        magic, version, flags, length = struct.unpack('!3sBBI',
+                self.fp.read(9))
+        if length > 9:
+            self.fp.seek(length - 9, os.SEEK_CUR)
+        self.fp.seek(4, os.SEEK_CUR)
+        self.tsp, ts = int(offset), 0
+        while self.tsp > 0 and ts < self.tsp:
+            bytes = self.fp.read(11)
+            if not bytes:
+                break
+            type, len0, len1, ts0, ts1, ts2, sid0, sid1 = struct.unpack(
+                    '>BBHBHBBH', bytes)
+            length = (len0 << 16) | len1
+            ts = (ts0 << 16) | (ts1 & 0x0ffff) | (ts2 << 24)
+            self.fp.seek(length, os.SEEK_CUR)
+            ptagsize, = struct.unpack('>I', self.fp.read(4))
+            if ptagsize != (length + 11):
+                break
+
+
+class CountingStream(object):
+    id, client = 1, True
+
+    def __init__(self):
+        self.count = self.bytes = 0
+
+    def send(self, message):
+        self.count += 1
+        self.bytes += len(message.data)
+
+
+def run(flv_class, path, offsets):
+    flv = flv_class().open(path)
+    times = []
+    for offset in offsets:
+        before = time.time()
+        flv.seek(offset)
+        times.append(time.time() - before)
+    flv.close()
+    flv = flv_class().open(path)
+    stream = CountingStream()
+    before = time.time()
+    for ignore in flv.reader(stream):
+        pass
+    read = time.time() - before
+    flv.close()
+    return times[0], sorted(times[1:]), read, stream.count
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-t', '--seconds', dest='seconds', type='int',
+            default=1800, help='Length of the canned FLV')
+    parser.add_option('-n', '--seeks', dest='seeks', type='int', default=200,
+            help='Number of seeks to random times')
+    options, args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'canned.flv')
+        make_flv(path, options.seconds)
+        index = open(path + FLV.INDEX, 'rb').read()
+        random.seed(1)
+        offsets = [random.randrange(options.seconds * 1000)
+                for i in range(options.seeks + 1)]
+        print "%.1f MB, %d key frames, %d seeks" % (
+                os.path.getsize(path) / 1048576.0,
+                len(index) / FLV.INDEX_ENTRY.size, options.seeks)
+        print "%-8s %12s %12s %12s %10s %10s" % ("reader", "first ms",
+                "p50 ms", "max ms", "read s", "tags")
+        for name, flv_class, sidecar in (('legacy', LegacyFLV, True),
+                ('headers', FLV, False), ('index', FLV, True)):
+            if sidecar:
+                open(path + FLV.INDEX, 'wb').write(index)
+            elif os.path.exists(path + FLV.INDEX):
+                os.unlink(path + FLV.INDEX)
+            first, times, read, count = run(flv_class, path, offsets)
+            print "%-8s %12.3f %12.3f %12.3f %10.2f %10d" % (name,
+                    first * 1e3, times[len(times) / 2] * 1e3,
+                    times[-1] * 1e3, read, count)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
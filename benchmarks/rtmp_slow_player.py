@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+What a player on a link slower than the stream costs FlashServer.
+
+Publishes the tags of an FLV (a canned one by default, see rtmp_parse.py)
+through FlashServer.mediahandler on a clock that follows the tag timestamps, to
+players whose writers go out over simulated links of --link times the bitrate
+of the stream. Reports, for each player, the most it had queued on the server
+in bytes and in milliseconds of media, how far behind live it was at the end,
+the messages dropped for it and whether it was disconnected, with the write
+queue limits (see Protocol.dropMedia) off and on:
+
+    $ python benchmarks/rtmp_slow_player.py --link 0.5 --link 0.9 --link 4
+
+"""
+import os
+import tempfile
+from optparse import OptionParser
+
+from astral.rtmp import multitask
+from astral.rtmp.rtmp import (App, Command, FlashServer, Header, Message,
+        Protocol, Stream)
+from rtmp_parse import CHANNELS, flv_tags, make_flv
+
+
+class Link(object):
+    """Stands in for the SockStream of a player's Protocol, taking rate bytes
+    per second of the publisher's clock.
+    """
+    def __init__(self, rate):
+        self.rate, self.budget, self.ready = rate, 0.0, multitask.Event()
+        self.bytesWritten, self.closed = 0, False
+
+    def tick(self, seconds):
+        self.budget += self.rate * seconds
+        self.ready.set()
+
+    def write(self, data):
+        while self.budget < len(data):
+            yield self.ready.wait()
+        self.budget -= len(data)
+        self.bytesWritten += len(data)
+
+    def close(self):
+        self.closed = True
+
+
+class Publisher(object):
+    path = 'live'
+
+    def writeMessage(self, message):
+        pass
+
+
+def run(tags, links, queue_bytes, queue_time):
+    manager = multitask.TaskManager()
+    server = FlashServer()
+    inst = App()
+    server.clients['live'] = [inst]
+    publisher = Stream(Publisher())
+    server.publishhandler(publisher, Command(name='publish', id=1,
+        args=['cam', 'live'])).next()
+    players = []
+    for link in links:
+        protocol = Protocol(None)
+        protocol.stream, protocol.path = link, 'live'
+        protocol.maxQueueBytes, protocol.maxQueueTime = queue_bytes, queue_time
+        player = Stream(protocol)
+        player.id, player.peakBytes, player.peakTime = 1, 0, 0
+        for ignore in server.playhandler(player, Command(name='play', id=2,
+                args=['cam'])):
+            pass
+        manager.add(protocol.write())
+        players.append(player)
+    last = 0
+    for tag_type, timestamp, data in tags:
+        for link in links:
+            link.tick((timestamp - last) / 1000.0)
+        last = timestamp
+        server.mediahandler(publisher, Message(Header(
+            channel=CHANNELS[tag_type], time=timestamp, size=len(data),
+            type=tag_type, streamId=1), data))
+        while manager.has_runnable():
+            manager.run_next()
+        for player in players:
+            protocol = player.client
+            player.peakBytes = max(player.peakBytes, protocol.writeQueue.bytes)
+            oldest = protocol.writeQueue.oldestMediaTime()
+            if oldest is not None:
+                player.peakTime = max(player.peakTime, timestamp - oldest)
+    results = []
+    for player, link in zip(players, links):
+        protocol = player.client
+        oldest = protocol.writeQueue.oldestMediaTime()
+        behind = last - oldest if oldest is not None else 0
+        results.append((player.peakBytes, player.peakTime, behind,
+            sum(protocol.dropped.values()), link.closed))
+    return results
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-f', '--flv', dest='flv',
+            help='FLV file to publish instead of the canned one')
+    parser.add_option('-t', '--seconds', dest='seconds', type='int',
+            default=120, help='Length of the canned FLV')
+    parser.add_option('-l', '--link', dest='links', type='float',
+            action='append', help='Link speed of a player in multiples of the '
+            'bitrate (repeatable), default 0.5, 0.9 and 4')
+    parser.add_option('-q', '--queue-bytes', dest='queue_bytes', type='int',
+            default=FlashServer.QUEUE_BYTES, help='Write queue limit in bytes')
+    parser.add_option('-m', '--queue-time', dest='queue_time', type='int',
+            default=FlashServer.QUEUE_TIME,
+            help='Write queue limit in milliseconds')
+    options, args = parser.parse_args()
+
+    path = options.flv
+    if not path:
+        fd, path = tempfile.mkstemp(suffix='.flv')
+        os.close(fd)
+        make_flv(path, options.seconds)
+    try:
+        tags = flv_tags(path)
+    finally:
+        if not options.flv:
+            os.unlink(path)
+
+    speeds = options.links or [0.5, 0.9, 4]
+    bitrate = sum(len(data) for t, ts, data in tags) / (tags[-1][1] / 1000.0)
+    print "%d messages, %.1f KB/s" % (len(tags), bitrate / 1024)
+    print "%-8s %6s %12s %12s %12s %8s %8s" % ("limits", "link",
+            "peak KB", "peak ms", "behind ms", "dropped", "closed")
+    for name, queue_bytes, queue_time in (('off', 0, 0),
+            ('on', options.queue_bytes, options.queue_time)):
+        links = [Link(speed * bitrate) for speed in speeds]
+        for speed, (peak_bytes, peak_time, behind, dropped, closed) in zip(
+                speeds, run(tags, links, queue_bytes, queue_time)):
+            print "%-8s %6.1f %12.1f %12d %12d %8d %8s" % (name, speed,
+                    peak_bytes / 1024.0, peak_time, behind, dropped,
+                    'yes' if closed else 'no')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+Tunnel count against CPU benchmark for astral.net.tunnel.
+
+Opens a number of tunnels with one connection each, then measures the CPU time
+the tunnel process spends while every connection sits idle, and while data is
+pushed through a fixed number of them. The work being done is the same whatever
+the number of tunnels, so with O(active) wakeups the CPU figures should stay
+flat as the tunnel count grows. The clients and the source run in a child
+process so the CPU figures only cover the tunnels themselves.
+
+    $ python benchmarks/tunnel_scaling.py -t 10 -t 100 -t 1000 -t 3000
+
+Each tunnel uses three file descriptors, select() based engines give up past
+FD_SETSIZE (usually 1024).
+
+"""
+import multiprocessing
+import os
+import resource
+import socket
+import threading
+from optparse import OptionParser
+
+from engines import ENGINES
+
+CHUNK = os.urandom(64 * 1024)
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def push(upstream, client, byte_count):
+    def source():
+        sent = 0
+        while sent < byte_count:
+            sent += upstream.send(CHUNK[:min(len(CHUNK), byte_count - sent)])
+    thread = threading.Thread(target=source)
+    thread.start()
+    received = 0
+    while received < byte_count:
+        data = client.recv(256 * 1024)
+        if not data:
+            break
+        received += len(data)
+    thread.join()
+
+
+def peers(listener, ports, active, byte_count, connected, start):
+    raise_fd_limit()
+    pairs = []
+    for port in ports:
+        client = socket.create_connection(('127.0.0.1', port))
+        upstream, addr = listener.accept()
+        pairs.append((upstream, client))
+    connected.set()
+    start.wait()
+    threads = [threading.Thread(target=push, args=(upstream, client,
+        byte_count)) for upstream, client in pairs[:active]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for upstream, client in pairs:
+        upstream.close()
+        client.close()
+
+
+def cpu_time():
+    return sum(os.times()[:2])
+
+
+def run(implementation, tunnel_count, active, byte_count, idle_seconds):
+    engine = ENGINES[implementation]()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+    source_port = listener.getsockname()[1]
+    tunnels = [engine.tunnel('127.0.0.1', source_port)
+            for i in range(tunnel_count)]
+
+    connected = multiprocessing.Event()
+    start = multiprocessing.Event()
+    process = multiprocessing.Process(target=peers, args=(listener,
+        [t.bind_port for t in tunnels], active, byte_count, connected, start))
+    process.start()
+    try:
+        engine.run_until(lambda: connected.is_set()
+                or not process.is_alive())
+
+        cpu_start = cpu_time()
+        engine.run_for(idle_seconds)
+        idle_cpu = (cpu_time() - cpu_start) / idle_seconds
+
+        start.set()
+        cpu_start = cpu_time()
+        engine.run_until(lambda: not process.is_alive())
+        active_cpu = cpu_time() - cpu_start
+    except:
+        process.terminate()
+        raise
+    finally:
+        start.set()
+        process.join()
+        engine.close(tunnels)
+        listener.close()
+    return idle_cpu, active_cpu
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-t', '--tunnels', dest='tunnels', type='int',
+            action='append', help='Number of tunnels to open (repeatable, '
+            'default: 10, 100, 1000)')
+    parser.add_option('-a', '--active', dest='active', type='int',
+            default=4, help='Tunnels to push data through')
+    parser.add_option('-m', '--megabytes', dest='megabytes', type='int',
+            default=16, help='Megabytes to push through each active tunnel')
+    parser.add_option('-d', '--idle', dest='idle', type='float', default=2,
+            help='Seconds to measure with every connection idle')
+    parser.add_option('-i', '--implementation', dest='implementations',
+            action='append', choices=ENGINES.keys(),
+            help='Implementation to run (default: all)')
+    options, args = parser.parse_args()
+
+    print "fd limit %d, %d active tunnels, %d MB each" % (raise_fd_limit(),
+            options.active, options.megabytes)
+    print "%-8s %8s %18s %18s" % ('impl', 'tunnels', 'idle CPU ms/s',
+            'CPU s per 100 MB')
+    for implementation in (options.implementations
+            or sorted(ENGINES.keys())):
+        for tunnel_count in options.tunnels or (10, 100, 1000):
+            active = min(options.active, tunnel_count)
+            try:
+                idle_cpu, active_cpu = run(implementation, tunnel_count,
+                        active, options.megabytes * 1024 * 1024, options.idle)
+            except (ValueError, EnvironmentError), e:
+                print "%-8s %8d %18s" % (implementation, tunnel_count,
+                        'failed: %s' % e)
+                continue
+            print "%-8s %8d %18.2f %18.3f" % (implementation, tunnel_count,
+                    idle_cpu * 1000,
+                    active_cpu / (active * options.megabytes) * 100)
+
+
+if __name__ == '__main__':
+    main()
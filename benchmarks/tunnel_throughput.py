@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Loopback throughput benchmark for astral.net.tunnel.
+
+Pushes data from a source server through a tunnel to a sink for a number of
+concurrent streams, and reports the bytes/sec seen by each sink and the CPU
+time the tunnel process spent per stream. The source and sinks run in a child
+process so the CPU figures only cover the tunnel itself.
+
+Compares the ring buffer data path on the IOLoop with the original string
+buffer one on asyncore:
+
+    $ python benchmarks/tunnel_throughput.py --streams 4 --megabytes 64
+
+"""
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from optparse import OptionParser
+
+from engines import ENGINES
+
+CHUNK = os.urandom(64 * 1024)
+
+
+def source(listener, byte_count):
+    conn, addr = listener.accept()
+    sent = 0
+    while sent < byte_count:
+        sent += conn.send(CHUNK[:min(len(CHUNK), byte_count - sent)])
+    # wait for the sink to hang up so the tunnel never drops buffered data
+    conn.recv(1)
+    conn.close()
+
+
+def sink(port, byte_count, results):
+    conn = socket.create_connection(('127.0.0.1', port))
+    received = 0
+    start = time.time()
+    while received < byte_count:
+        data = conn.recv(256 * 1024)
+        if not data:
+            break
+        received += len(data)
+    results.put((received, time.time() - start))
+    conn.close()
+
+
+def peers(listener, ports, byte_count, results):
+    threads = []
+    for port in ports:
+        threads.append(threading.Thread(target=source,
+            args=(listener, byte_count)))
+        threads.append(threading.Thread(target=sink,
+            args=(port, byte_count, results)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run(implementation, streams, byte_count):
+    engine = ENGINES[implementation]()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(streams)
+    source_port = listener.getsockname()[1]
+    tunnels = [engine.tunnel('127.0.0.1', source_port)
+            for i in range(streams)]
+
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=peers, args=(listener,
+        [t.bind_port for t in tunnels], byte_count, results))
+    cpu_start = sum(os.times()[:2])
+    process.start()
+    engine.run_until(lambda: not process.is_alive())
+    cpu = sum(os.times()[:2]) - cpu_start
+
+    engine.close(tunnels)
+    listener.close()
+
+    rates = []
+    for i in range(streams):
+        received, elapsed = results.get()
+        rates.append(received / elapsed)
+    return rates, cpu
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-s', '--streams', dest='streams', type='int',
+            default=4, help='Concurrent streams through the tunnel')
+    parser.add_option('-m', '--megabytes', dest='megabytes', type='int',
+            default=32, help='Megabytes to push through each stream')
+    parser.add_option('-i', '--implementation', dest='implementations',
+            action='append', choices=ENGINES.keys(),
+            help='Implementation to run (default: all)')
+    options, args = parser.parse_args()
+
+    byte_count = options.megabytes * 1024 * 1024
+    print "%d streams, %d MB each" % (options.streams, options.megabytes)
+    print "%-8s %16s %18s %18s" % ('impl', 'MB/s per stream',
+            'CPU s per stream', 'CPU s per 100 MB')
+    for implementation in (options.implementations
+            or sorted(ENGINES.keys())):
+        rates, cpu = run(implementation, options.streams, byte_count)
+        print "%-8s %16.1f %18.3f %18.3f" % (implementation,
+                sum(rates) / len(rates) / 1024 / 1024, cpu / options.streams,
+                cpu / (options.streams * options.megabytes) * 100)
+
+
+if __name__ == '__main__':
+    main()